@@ -0,0 +1,543 @@
+from typing import Optional, List, Dict, Any
+from loguru import logger
+import hashlib
+import asyncio
+import random
+import ollama
+import httpx
+import json
+import time
+import re
+import os
+from metrics import ENDPOINT_REQUESTS, ENDPOINT_IN_FLIGHT, ENDPOINT_TOKENS, ENDPOINT_UP
+'''
+Inference backends.
+
+The processor only talks to an LLMBackend: chat(messages, json_schema, options) returns the
+generated text plus token counters in ollama's naming. Pick one with ENRICH_BACKEND:
+    ollama  (default) ollama server at OLLAMA_BASE_URL
+    openai  any OpenAI-compatible server (vLLM, llama.cpp server) at OPENAI_BASE_URL
+    fake    in-process, schema-conforming answers with configurable latency and errors, no GPU needed
+Several servers (one per GPU or pod) go in ENRICH_ENDPOINTS, requests are then balanced across
+them by PooledBackend.
+'''
+
+BACKEND = os.getenv("ENRICH_BACKEND", "ollama")
+# Comma separated base URLs of the ENRICH_BACKEND servers to balance over, e.g.
+# http://localhost:11434,http://localhost:11435 for two ollama instances pinned to one GPU each.
+# Empty means the single server at OLLAMA_BASE_URL / OPENAI_BASE_URL
+ENDPOINTS = [url.strip() for url in os.getenv("ENRICH_ENDPOINTS", "").split(",") if url.strip()]
+
+# Number of LLM requests kept in flight at once with ENRICH_CONCURRENCY_LIMITER=fixed. Match this to
+# OLLAMA_NUM_PARALLEL on the ollama server so every parallel slot stays busy without queueing requests
+# server side. The adaptive limiters (limiter.py) find the number themselves, up to MAX_CONCURRENCY_LIMIT
+MAX_CONCURRENCY = int(os.getenv("OLLAMA_NUM_PARALLEL", "30"))
+MAX_CONCURRENCY_LIMIT = int(os.getenv("ENRICH_MAX_CONCURRENCY", str(MAX_CONCURRENCY * 2 * max(1, len(ENDPOINTS)))))
+
+if 'APP_ENV' in os.environ and os.environ['APP_ENV'] == 'local':
+    DEFAULT_MODEL = "phi3"
+else:
+    DEFAULT_MODEL = "local-phi3-quantized"
+MODEL = os.getenv("ENRICH_MODEL", DEFAULT_MODEL)
+
+# Shared ollama client settings. OLLAMA_HOST is left alone since start.sh uses it for the server bind address
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", str(MAX_CONCURRENCY_LIMIT)))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "120"))
+
+# OpenAI-compatible server, base URL includes the /v1 prefix
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "http://localhost:8080/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "300"))
+
+# Fake backend. Latency is drawn per call from FAKE_LLM_LATENCY_DIST:
+#   fixed        always FAKE_LLM_LATENCY_MS
+#   uniform      FAKE_LLM_LATENCY_MS +/- FAKE_LLM_LATENCY_SPREAD ms
+#   exponential  mean FAKE_LLM_LATENCY_MS
+#   lognormal    median FAKE_LLM_LATENCY_MS, sigma FAKE_LLM_LATENCY_SPREAD
+FAKE_LLM_LATENCY_DIST = os.getenv("FAKE_LLM_LATENCY_DIST", "fixed")
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "0"))
+FAKE_LLM_LATENCY_SPREAD = float(os.getenv("FAKE_LLM_LATENCY_SPREAD", "0"))
+# Share of calls that raise (like a dropped connection) and that return truncated JSON
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_INVALID_RATE = float(os.getenv("FAKE_LLM_INVALID_RATE", "0"))
+# Requests the fake serves at once, the rest queue like on a real server. 0 means unlimited
+FAKE_LLM_PARALLEL = int(os.getenv("FAKE_LLM_PARALLEL", "0"))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+# Longest a single backend call may take. The pool applies it per endpoint, so a hung node counts as
+# a failure and the request moves on to another one
+LLM_TIMEOUT_SECONDS = float(os.getenv("ENRICH_LLM_TIMEOUT_SECONDS", "120"))
+
+# Endpoint pool. Retries go to a different endpoint, a node that keeps failing is skipped for a while
+ENDPOINT_RETRIES = int(os.getenv("ENRICH_ENDPOINT_RETRIES", "1"))
+ENDPOINT_FAILURE_THRESHOLD = int(os.getenv("ENRICH_ENDPOINT_FAILURE_THRESHOLD", "3"))
+ENDPOINT_COOLDOWN_SECONDS = float(os.getenv("ENRICH_ENDPOINT_COOLDOWN_SECONDS", "30"))
+HEALTH_CHECK_INTERVAL_SECONDS = float(os.getenv("ENRICH_HEALTH_CHECK_INTERVAL_SECONDS", "10"))
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("ENRICH_HEALTH_CHECK_TIMEOUT_SECONDS", "5"))
+
+
+class LLMBackendError(RuntimeError):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        # HTTP status from the server if there was one, the limiter backs off on 5xx/429
+        self.status_code = status_code
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    # The node's fault (down, overloaded, hung), so another endpoint may well succeed. A 4xx is the
+    # request's fault and would fail the same way everywhere
+    status_code = getattr(error, 'status_code', None)
+    if isinstance(status_code, int):
+        return status_code >= 500 or status_code == 429
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError, httpx.TransportError))
+
+
+class LLMBackend:
+    """
+    chat() returns {'content', 'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration'},
+    durations in nanoseconds. options use ollama's names (temperature, num_ctx, num_predict).
+    """
+    name = "base"
+    base_url = ""
+
+    def __init__(self, model: str = MODEL):
+        self.model = model
+
+    @property
+    def model_key(self) -> str:
+        # Part of the result cache key, so outputs of different backends/models never mix
+        return f"{self.name}:{self.model}"
+
+    @property
+    def call_timeout(self) -> float:
+        # Upper bound the caller puts on one chat() call
+        return LLM_TIMEOUT_SECONDS
+
+    async def chat(self, messages: List[Dict[str, str]], json_schema: Dict[str, Any], options: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def health_check(self) -> bool:
+        # Cheap request that tells whether the server is up, used by the endpoint pool
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "model": self.model, "base_url": self.base_url}
+
+    async def close(self):
+        pass
+
+
+class OllamaBackend(LLMBackend):
+    name = "ollama"
+
+    def __init__(self, model: str = MODEL, base_url: str = OLLAMA_BASE_URL, max_connections: int = OLLAMA_MAX_CONNECTIONS):
+        super().__init__(model)
+        self.base_url = base_url
+        # One long-lived client with a keep-alive pool sized to the concurrency
+        self.client = ollama.AsyncClient(
+            host=base_url,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+            ),
+        )
+        logger.info(f"Ollama backend ready for {base_url} (pool size {max_connections})")
+
+    async def chat(self, messages, json_schema, options):
+        response = await self.client.chat(model=self.model, messages=messages, options=options, format=json_schema)
+        return {
+            'content': response['message']['content'],
+            'prompt_eval_count': response.get('prompt_eval_count'),
+            'prompt_eval_duration': response.get('prompt_eval_duration'),
+            'eval_count': response.get('eval_count'),
+            'eval_duration': response.get('eval_duration'),
+        }
+
+    async def health_check(self):
+        await self.client.list()
+        return True
+
+    async def close(self):
+        await self.client.close()
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, model: str = MODEL, base_url: str = OPENAI_BASE_URL, api_key: str = OPENAI_API_KEY,
+                 max_connections: int = MAX_CONCURRENCY_LIMIT):
+        super().__init__(model)
+        self.base_url = base_url.rstrip('/')
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        logger.info(f"OpenAI-compatible backend ready for {self.base_url} (pool size {max_connections})")
+
+    async def chat(self, messages, json_schema, options):
+        # num_ctx is a server start-up setting on vLLM/llama.cpp, so only the per-request options map over
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": options.get('temperature', 0),
+            "max_tokens": options.get('num_predict'),
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": json_schema.get('title', 'output'), "schema": json_schema, "strict": True},
+            },
+        }
+        response = await self.client.post("/chat/completions", json=payload)
+        if response.status_code != 200:
+            raise LLMBackendError(f"HTTP {response.status_code}: {response.text[:200]}", status_code=response.status_code)
+        body = response.json()
+
+        usage = body.get('usage') or {}
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        # llama.cpp server also reports timings, prompt_n being the tokens it actually evaluated
+        timings = body.get('timings') or {}
+        return {
+            'content': body['choices'][0]['message']['content'],
+            'prompt_eval_count': timings.get('prompt_n', prompt_tokens - cached_tokens),
+            'prompt_eval_duration': int(timings.get('prompt_ms', 0) * 1e6),
+            'eval_count': usage.get('completion_tokens'),
+            'eval_duration': int(timings.get('predicted_ms', 0) * 1e6),
+        }
+
+    async def health_check(self):
+        response = await self.client.get("/models")
+        return response.status_code == 200
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic stand-in for load tests: answers with JSON that conforms to the requested schema,
+    echoing the product ids found in the prompt so results line up with their rows. Values,
+    latency and failures are derived from the prompt and FAKE_LLM_SEED, so a run can be repeated.
+    """
+    name = "fake"
+
+    def __init__(self, model: str = MODEL, latency_dist: str = FAKE_LLM_LATENCY_DIST, latency_ms: float = FAKE_LLM_LATENCY_MS,
+                 latency_spread: float = FAKE_LLM_LATENCY_SPREAD, error_rate: float = FAKE_LLM_ERROR_RATE,
+                 invalid_rate: float = FAKE_LLM_INVALID_RATE, parallel: int = FAKE_LLM_PARALLEL, seed: int = FAKE_LLM_SEED,
+                 base_url: str = "fake"):
+        super().__init__(model)
+        # Only a label, but it also goes into the seed so a retry on another fake endpoint can succeed
+        self.base_url = base_url
+        self.latency_dist = latency_dist
+        self.latency_ms = latency_ms
+        self.latency_spread = latency_spread
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.seed = seed
+        self._slots = asyncio.Semaphore(parallel) if parallel > 0 else None
+        self._seen_prefixes = set()
+        logger.info(f"Fake backend ready ({latency_dist} latency {latency_ms}ms, error rate {error_rate}, invalid rate {invalid_rate})")
+
+    def _latency_seconds(self, rng: random.Random) -> float:
+        if self.latency_dist == "uniform":
+            latency_ms = rng.uniform(self.latency_ms - self.latency_spread, self.latency_ms + self.latency_spread)
+        elif self.latency_dist == "exponential":
+            latency_ms = rng.expovariate(1 / self.latency_ms) if self.latency_ms > 0 else 0
+        elif self.latency_dist == "lognormal":
+            latency_ms = rng.lognormvariate(0, self.latency_spread) * self.latency_ms
+        else:
+            latency_ms = self.latency_ms
+        return max(latency_ms, 0) / 1000
+
+    def _fake_value(self, schema: Dict[str, Any], definitions: Dict[str, Any], field_name: str, rng: random.Random, ids: List[Any]):
+        if '$ref' in schema:
+            schema = definitions[schema['$ref'].split('/')[-1]]
+        if 'anyOf' in schema:
+            schema = next((option for option in schema['anyOf'] if option.get('type') != 'null'), schema['anyOf'][0])
+
+        schema_type = schema.get('type')
+        if schema_type == 'object':
+            obj = {}
+            for name, property_schema in schema.get('properties', {}).items():
+                obj[name] = self._fake_value(property_schema, definitions, name, rng, ids)
+            return obj
+        if schema_type == 'array':
+            # Packed prompts: one element per product in the prompt, each with its own id
+            elements = []
+            for item_id in ids or [None]:
+                element = self._fake_value(schema.get('items', {}), definitions, field_name, rng, [item_id])
+                elements.append(element)
+            return elements
+        if field_name == 'id' and ids and ids[0] is not None:
+            return ids[0]
+        if schema_type == 'integer':
+            return rng.randint(1, 5)
+        if schema_type == 'number':
+            return round(rng.uniform(1, 100), 2)
+        if schema_type == 'boolean':
+            return rng.random() < 0.5
+        if schema_type == 'null':
+            return None
+        return f"fake {field_name} {rng.randrange(10000)}"
+
+    async def chat(self, messages, json_schema, options):
+        prompt = '\n'.join(message['content'] for message in messages)
+        # Like a real sampler, only temperature 0 answers the same prompt the same way every time
+        sampling_noise = random.random() if options.get('temperature') else 0
+        rng = random.Random(int(hashlib.sha256(f"{self.seed}\x00{self.base_url}\x00{sampling_noise}\x00{prompt}".encode('utf-8')).hexdigest()[:16], 16))
+
+        if self._slots is not None:
+            await self._slots.acquire()
+        try:
+            latency_seconds = self._latency_seconds(rng)
+            await asyncio.sleep(latency_seconds)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+        if rng.random() < self.error_rate:
+            raise ConnectionResetError("Fake backend injected error (connection reset)")
+
+        ids = [int(item_id) if item_id.isdigit() else item_id for item_id in re.findall(r"'id': '([^']*)'", messages[-1]['content'])]
+        content = json.dumps(self._fake_value(json_schema, json_schema.get('$defs', {}), '', rng, ids))
+        if rng.random() < self.invalid_rate:
+            # Cut off somewhere, like an answer that ran into num_predict
+            content = content[:rng.randrange(1, len(content))]
+
+        # Pretend the system prompt is served from the KV cache after its first use, like a warm server
+        system_prompt = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ''
+        evaluated = prompt if system_prompt not in self._seen_prefixes else prompt[len(system_prompt):]
+        self._seen_prefixes.add(system_prompt)
+        return {
+            'content': content,
+            'prompt_eval_count': len(evaluated) // 4 + 1,
+            'prompt_eval_duration': 0,
+            'eval_count': len(content) // 4 + 1,
+            # All of the simulated latency counts as generation time
+            'eval_duration': int(latency_seconds * 1e9),
+        }
+
+
+class Endpoint:
+    # One server of a PooledBackend plus its load, counters and circuit breaker state
+    def __init__(self, backend: LLMBackend):
+        self.backend = backend
+        self.label = backend.base_url
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.eval_tokens = 0
+        self.eval_seconds = 0.0
+        self.consecutive_failures = 0
+        # Circuit breaker: closed while open_until is 0, open until that time, then half-open
+        # (one trial request) until a request succeeds or fails again
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        ENDPOINT_UP.set(1, endpoint=self.label)
+
+    @property
+    def state(self) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+
+    def available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.trial_in_flight)
+
+    def trip(self, reason: str):
+        if self.state != "open":
+            logger.warning(f"Endpoint {self.label} taken out of rotation for {ENDPOINT_COOLDOWN_SECONDS:.0f}s: {reason}")
+        self.open_until = time.monotonic() + ENDPOINT_COOLDOWN_SECONDS
+        ENDPOINT_UP.set(0, endpoint=self.label)
+
+    def record_success(self, response: Dict[str, Any]):
+        self.completed += 1
+        self.consecutive_failures = 0
+        self.eval_tokens += response.get('eval_count') or 0
+        self.eval_seconds += (response.get('eval_duration') or 0) / 1e9
+        if self.open_until:
+            logger.info(f"Endpoint {self.label} is back in rotation")
+            self.open_until = 0.0
+            ENDPOINT_UP.set(1, endpoint=self.label)
+        ENDPOINT_REQUESTS.inc(endpoint=self.label, outcome="ok")
+        ENDPOINT_TOKENS.inc(response.get('eval_count') or 0, endpoint=self.label)
+
+    def record_failure(self, error: Exception):
+        self.failed += 1
+        self.consecutive_failures += 1
+        ENDPOINT_REQUESTS.inc(endpoint=self.label, outcome="error")
+        # A failed half-open trial reopens the circuit right away
+        if self.consecutive_failures >= ENDPOINT_FAILURE_THRESHOLD or self.state == "half_open":
+            self.trip(f"{self.consecutive_failures} failures in a row, last: {type(error).__name__}: {str(error)[:120]}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "endpoint": self.label,
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "eval_tokens": self.eval_tokens,
+            # Generation speed as the server measured it, summed over its parallel slots
+            "eval_tokens_per_sec": round(self.eval_tokens / self.eval_seconds, 1) if self.eval_seconds else 0.0,
+        }
+
+
+class PooledBackend(LLMBackend):
+    """
+    Balances requests over several servers of the same kind (one per GPU or pod) running the same
+    model. Each request goes to the endpoint with the fewest requests outstanding, which also
+    evens out a faster and a slower card. Requests that fail because of the node (5xx, 429,
+    connection errors, timeouts) are retried on another endpoint, endpoints that keep failing or
+    don't answer health checks are skipped until they recover. A 4xx is raised straight away.
+    """
+    def __init__(self, backends: List[LLMBackend], retries: int = ENDPOINT_RETRIES, timeout: float = LLM_TIMEOUT_SECONDS):
+        super().__init__(backends[0].model)
+        # Same name as the members, pooled and single-server results share the result cache
+        self.name = backends[0].name
+        self.base_url = ",".join(backend.base_url for backend in backends)
+        self.endpoints = [Endpoint(backend) for backend in backends]
+        self.retries = retries
+        self.timeout = timeout
+        self._health_task: Optional[asyncio.Task] = None
+        logger.info(f"Balancing {self.name} requests over {len(self.endpoints)} endpoints: {self.base_url}")
+
+    @property
+    def call_timeout(self) -> float:
+        # Every attempt has its own timeout, the whole call may take one per endpoint tried
+        return self.timeout * (self.retries + 1)
+
+    def _pick(self, tried: List[Endpoint]) -> Optional[Endpoint]:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried and endpoint.available()]
+        if not candidates:
+            return None
+        fewest = min(endpoint.in_flight for endpoint in candidates)
+        # Random among the least loaded so equal endpoints take turns
+        return random.choice([endpoint for endpoint in candidates if endpoint.in_flight == fewest])
+
+    def _ensure_health_checks(self):
+        # Started from the first request since that's when an event loop is around
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
+            for endpoint in self.endpoints:
+                try:
+                    healthy = await asyncio.wait_for(endpoint.backend.health_check(), HEALTH_CHECK_TIMEOUT_SECONDS)
+                except Exception as e:
+                    healthy, reason = False, f"health check failed: {type(e).__name__}: {e}"
+                else:
+                    reason = "health check failed"
+                if not healthy:
+                    endpoint.trip(reason)
+                elif endpoint.state == "open":
+                    # Up again, let a trial request through instead of waiting out the cooldown
+                    endpoint.open_until = time.monotonic()
+
+    async def chat(self, messages, json_schema, options):
+        self._ensure_health_checks()
+        tried: List[Endpoint] = []
+        last_error: Optional[Exception] = None
+
+        for _ in range(self.retries + 1):
+            endpoint = self._pick(tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+            half_open = endpoint.state == "half_open"
+            endpoint.trial_in_flight = endpoint.trial_in_flight or half_open
+            endpoint.in_flight += 1
+            ENDPOINT_IN_FLIGHT.inc(endpoint=endpoint.label)
+            try:
+                response = await asyncio.wait_for(endpoint.backend.chat(messages, json_schema, options), self.timeout)
+            except Exception as e:
+                if not is_endpoint_failure(e):
+                    raise
+                endpoint.record_failure(e)
+                last_error = e
+                logger.warning(f"Request to {endpoint.label} failed ({type(e).__name__}: {str(e)[:120]}), trying another endpoint")
+                continue
+            finally:
+                endpoint.in_flight -= 1
+                ENDPOINT_IN_FLIGHT.dec(endpoint=endpoint.label)
+                if half_open:
+                    endpoint.trial_in_flight = False
+            endpoint.record_success(response)
+            return response
+
+        if last_error is not None:
+            raise last_error
+        # 503 so the concurrency limiter backs off while every node is out
+        raise LLMBackendError("No inference endpoint available, all are out of rotation", status_code=503)
+
+    async def health_check(self):
+        return any(endpoint.available() for endpoint in self.endpoints)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "endpoints": [endpoint.stats() for endpoint in self.endpoints]}
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for endpoint in self.endpoints:
+            await endpoint.backend.close()
+
+
+BACKENDS = {
+    "ollama": OllamaBackend,
+    "openai": OpenAICompatibleBackend,
+    "fake": FakeBackend,
+}
+
+_backend: Optional[LLMBackend] = None
+
+
+def create_backend(name: str = BACKEND, endpoints: Optional[List[str]] = None, **kwargs) -> LLMBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown ENRICH_BACKEND {name!r}, use one of {list(BACKENDS)}")
+    endpoints = ENDPOINTS if endpoints is None else endpoints
+    if len(endpoints) > 1:
+        return PooledBackend([BACKENDS[name](base_url=url, **kwargs) for url in endpoints])
+    if endpoints:
+        kwargs['base_url'] = endpoints[0]
+    return BACKENDS[name](**kwargs)
+
+
+def init_backend() -> LLMBackend:
+    """
+    Creates the long-lived backend shared by every request. Called on FastAPI startup.
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+
+async def close_backend():
+    """
+    Closes the shared backend and its pooled connections. Called on FastAPI shutdown.
+    """
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
+
+
+def get_backend() -> LLMBackend:
+    # Falls back to creating the backend lazily when used outside of the FastAPI app (scripts, benchmarks)
+    return _backend or init_backend()
+
+
+def set_backend(backend: LLMBackend) -> Optional[LLMBackend]:
+    # Swaps the shared backend, e.g. to compare backends on the same workload. Returns the previous one
+    global _backend
+    previous, _backend = _backend, backend
+    return previous
@@ -0,0 +1,85 @@
+'''
+Compares the old per-row dynamic UPDATE loop of /resynthesize-batch with storage.bulk_update_rows.
+
+Uses a throwaway SQLite file, nothing touches .database.db:
+    python benchmarks/bench_db_writes.py --sizes 1000 10000 100000
+
+Results tables made by storage.create_results_table key rows by an INTEGER PRIMARY KEY id, so
+an UPDATE by id is a rowid lookup. The benchmark table is built with pandas and gets a unique
+index on id to match. Pass --no-index to see the old tables, where every UPDATE was a full scan,
+but expect the 100k case to take a very long time in both modes.
+'''
+import sys
+import time
+import argparse
+import tempfile
+import pandas as pd
+from pathlib import Path
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from storage import bulk_update_rows, RESULTS_TABLE
+
+
+def build_table(engine, rows: int, with_index: bool):
+    df = pd.DataFrame({
+        'id': range(1, rows + 1),
+        'product_name': [f"Product {i}" for i in range(rows)],
+        'product_description': [f"Description {i}" for i in range(rows)],
+        'insight': None,
+        'anomaly_flag': None,
+        'quality_score': None,
+    })
+    df.to_sql(RESULTS_TABLE, engine, if_exists='replace', index=False)
+    if with_index:
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE UNIQUE INDEX idx_bench_id ON {RESULTS_TABLE} (id)"))
+    return df
+
+
+def updated_rows(df: pd.DataFrame):
+    df = df.copy()
+    df['insight'] = "Updated insight"
+    df['anomaly_flag'] = "None"
+    df['quality_score'] = 4
+    return df
+
+
+def legacy_row_loop(engine, df_updated_rows: pd.DataFrame):
+    # Same statement building as the old resynthesize_batch_rows loop
+    with engine.connect() as connection:
+        for index, row_series in df_updated_rows.iterrows():
+            row_data = row_series.to_dict()
+            set_clauses = []
+            parameters = {'id': row_data['id']}
+            for column_name, value in row_data.items():
+                if column_name != 'id':
+                    set_clauses.append(f"{column_name} = :{column_name}")
+                    parameters[column_name] = value
+            connection.execute(text(f"UPDATE {RESULTS_TABLE} SET {', '.join(set_clauses)} WHERE id = :id"), parameters)
+        connection.commit()
+
+
+def bulk(engine, df_updated_rows: pd.DataFrame):
+    bulk_update_rows(engine, df_updated_rows.to_dict(orient='records'), list(df_updated_rows.columns))
+
+
+def main(args):
+    print(f"{'rows':>8} {'mode':>8} {'seconds':>10} {'rows/sec':>12}")
+    for rows in args.sizes:
+        for name, write in (("legacy", legacy_row_loop), ("bulk", bulk)):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                engine = create_engine(f"sqlite:///{tmp_dir}/bench.db")
+                df_updated_rows = updated_rows(build_table(engine, rows, not args.no_index))
+                start = time.perf_counter()
+                write(engine, df_updated_rows)
+                elapsed = time.perf_counter() - start
+                engine.dispose()
+            print(f"{rows:>8} {name:>8} {elapsed:>10.3f} {rows / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--no-index", action="store_true")
+    main(parser.parse_args())
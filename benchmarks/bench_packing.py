@@ -0,0 +1,57 @@
+'''
+Compares rows/sec of the one-row-per-call path against packed prompts.
+
+Runs against the configured backend (ENRICH_BACKEND, ollama by default) with the result cache turned off
+so every row really goes to the model:
+    APP_ENV=local python benchmarks/bench_packing.py data/medium_products_list.csv --pack-sizes 1 4 8
+'''
+import os
+os.environ["ENRICH_CACHE_ENABLED"] = "0"
+
+import sys
+import time
+import asyncio
+import argparse
+import pandas as pd
+import numpy as np
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from processor import EnrichRequestItem, process_data_api_concurrently_async
+from backends import close_backend
+from main import DefaultProductAttributes
+
+
+def load_items(csv_path: str, rows: int):
+    df = pd.read_csv(csv_path, usecols=lambda column: column in EnrichRequestItem.model_fields)
+    df = df.replace({np.nan: None})
+    # Repeat the file until we have enough rows to get a stable number
+    records = df.to_dict(orient='records')
+    records = (records * (rows // len(records) + 1))[:rows]
+    return [EnrichRequestItem(**record, id=index + 1) for index, record in enumerate(records)]
+
+
+async def run(items, pack_size: int, concurrency: int):
+    start = time.perf_counter()
+    results = await process_data_api_concurrently_async(items, DefaultProductAttributes, concurrency, pack_size)
+    elapsed = time.perf_counter() - start
+    succeeded = sum(1 for result in results if isinstance(result, dict))
+    return elapsed, succeeded
+
+
+async def main(args):
+    items = load_items(args.csv, args.rows)
+    print(f"{'pack_size':>10} {'seconds':>10} {'rows/sec':>10} {'succeeded':>10}")
+    for pack_size in args.pack_sizes:
+        elapsed, succeeded = await run(items, pack_size, args.concurrency)
+        print(f"{pack_size:>10} {elapsed:>10.2f} {len(items) / elapsed:>10.2f} {succeeded:>10}")
+    await close_backend()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv")
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--pack-sizes", type=int, nargs="+", default=[1, 4, 8])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,393 @@
+'''
+End-to-end benchmark of the enrichment API against the fake LLM backend.
+
+Generates synthetic catalogs shaped like data/medium_products_list.csv, then drives the real
+FastAPI app in-process (upload -> enrichment, /resynthesize-batch, /update-row, PATCH /rows,
+/download-results) on a throwaway SQLite file. No GPU or ollama needed:
+    python benchmarks/bench_pipeline.py --sizes 100 10000 100000 --latency-ms 20 --output bench.jsonl
+
+Per stage it reports rows/sec, p50/p95/p99 latency (LLM calls for the enrichment stage, HTTP
+requests for the others), peak RSS and time spent in DB writes. --output appends one JSON line
+per run (with the git commit) so numbers can be compared across commits.
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+SAMPLE_CSV = REPO_DIR / "data" / "medium_products_list.csv"
+
+
+def configure_environment(args, tmp_dir: str):
+    # Read by the app modules at import time, so this has to run before importing main
+    os.environ["ENRICH_BACKEND"] = "fake"
+    os.environ["DATABASE_URL"] = f"sqlite:///{tmp_dir}/bench.db"
+    os.environ["ENRICH_CACHE_ENABLED"] = "1" if args.cache else "0"
+    os.environ["ENRICH_CACHE_PATH"] = f"{tmp_dir}/bench_cache.db"
+    os.environ["FAKE_LLM_LATENCY_DIST"] = args.latency_dist
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_LLM_LATENCY_SPREAD"] = str(args.latency_spread)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_LLM_PARALLEL"] = str(args.server_parallel)
+    os.environ["FAKE_LLM_SEED"] = str(args.seed)
+    if args.concurrency:
+        os.environ["OLLAMA_NUM_PARALLEL"] = str(args.concurrency)
+    os.environ["ENRICH_CONCURRENCY_LIMITER"] = args.limiter
+    if args.endpoints > 1:
+        # Several fake servers behind the endpoint pool, each with --server-parallel slots
+        os.environ["ENRICH_ENDPOINTS"] = ",".join(f"fake-{index}" for index in range(args.endpoints))
+    if args.pack_size:
+        os.environ["ENRICH_PACK_SIZE"] = str(args.pack_size)
+    os.environ.setdefault("APP_ENV", "local")
+
+
+# --- Synthetic catalogs ---
+
+def catalog_profile(sample_csv: Path):
+    # Column names, how often each column is filled and the words seen in it
+    import pandas as pd
+    df = pd.read_csv(sample_csv, dtype=str, on_bad_lines='skip')
+    profile = {}
+    for column in df.columns:
+        values = df[column].dropna()
+        words = [word for value in values for word in str(value).split()]
+        profile[column] = {"fill_rate": len(values) / len(df), "words": words or [column]}
+    return profile
+
+
+def write_catalog(path: str, rows: int, profile, duplicate_ratio: float, seed: int):
+    # Every row draws words from the sample columns. duplicate_ratio of the rows repeat an earlier row,
+    # which is what the deduplication and the result cache see in real catalogs
+    import csv
+    rng = random.Random(seed)
+    columns = list(profile)
+    written = []
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(columns)
+        for index in range(rows):
+            if written and rng.random() < duplicate_ratio:
+                writer.writerow(rng.choice(written))
+                continue
+            row = []
+            for column in columns:
+                column_profile = profile[column]
+                if column != "product_name" and rng.random() > column_profile["fill_rate"]:
+                    row.append("")
+                    continue
+                length = rng.randint(2, 8 if column == "product_name" else 20)
+                words = rng.choices(column_profile["words"], k=length)
+                row.append(" ".join(words) + (f" #{index}" if column == "product_name" else ""))
+            writer.writerow(row)
+            # Bounded pool of rows to duplicate from, keeps 1M-row catalogs cheap to build
+            if len(written) < 10000:
+                written.append(row)
+
+
+# --- Measurements ---
+
+def percentile(values, fraction: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def latency_summary(latencies_seconds):
+    return {
+        f"p{int(fraction * 100)}_ms": round(percentile(latencies_seconds, fraction) * 1000, 2) if latencies_seconds else None
+        for fraction in (0.5, 0.95, 0.99)
+    }
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # Not Linux: fall back to the lifetime peak (bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RssSampler:
+    # Samples RSS in the background so every stage gets its own peak, not the process lifetime max
+    def __init__(self, interval_seconds: float = 0.05):
+        self.interval_seconds = interval_seconds
+        self.peak = current_rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def start(self):
+        self._thread.start()
+
+    def reset(self):
+        self.peak = current_rss_bytes()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class DbTimer:
+    # Times every statement on the app's engine, split into writes and reads
+    WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "CREATE", "DROP", "REPLACE")
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.write_seconds = 0.0
+        self.read_seconds = 0.0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("bench_started", []).append(time.perf_counter())
+
+    def _after(self, connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info["bench_started"].pop()
+        with self._lock:
+            if statement.lstrip().upper().startswith(self.WRITE_PREFIXES):
+                self.write_seconds += elapsed
+            else:
+                self.read_seconds += elapsed
+
+    def reset(self):
+        with self._lock:
+            self.write_seconds = 0.0
+            self.read_seconds = 0.0
+
+
+class TimedBackend:
+    # Wraps the shared backend to record the latency of every LLM call
+    def __init__(self, backend):
+        self.backend = backend
+        self.latencies = []
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    async def chat(self, messages, json_schema, options):
+        start = time.perf_counter()
+        try:
+            return await self.backend.chat(messages, json_schema, options)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+class Stage:
+    def __init__(self, name: str, rss: RssSampler, db_timer: DbTimer):
+        self.name = name
+        self.rss = rss
+        self.db_timer = db_timer
+        self.latencies = []
+        self.rows = 0
+        self.extra = {}
+
+    def __enter__(self):
+        self.rss.reset()
+        self.db_timer.reset()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+
+    def timed(self, call, *args, **kwargs):
+        start = time.perf_counter()
+        response = call(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{self.name}: HTTP {response.status_code} {response.text[:200]}")
+        return response
+
+    def result(self):
+        return {
+            "stage": self.name,
+            "rows": self.rows,
+            "seconds": round(self.seconds, 4),
+            "rows_per_sec": round(self.rows / self.seconds, 2) if self.seconds else None,
+            **latency_summary(self.latencies),
+            "requests": len(self.latencies),
+            "peak_rss_mb": round(self.rss.peak / 1024 / 1024, 1),
+            "db_write_seconds": round(self.db_timer.write_seconds, 4),
+            "db_read_seconds": round(self.db_timer.read_seconds, 4),
+            **self.extra,
+        }
+
+
+# --- Stages ---
+
+def run_size(client, args, rows: int, profile, tmp_dir: str, rss: RssSampler, db_timer: DbTimer, backend: TimedBackend):
+    catalog_path = os.path.join(tmp_dir, f"catalog_{rows}.csv")
+    from limiter import get_limiter
+    write_catalog(catalog_path, rows, profile, args.duplicate_ratio, args.seed)
+    schema_config_str = json.dumps({"mode": "defaults", "fields": []})
+    rng = random.Random(args.seed)
+    results = []
+
+    with Stage("enrich", rss, db_timer) as stage:
+        backend.latencies = []
+        with open(catalog_path, "rb") as catalog:
+            files = {"file": ("catalog.csv", catalog, "text/csv")}
+            data = {"schema_config_str": schema_config_str}
+            if args.mode == "sync":
+                response = stage.timed(client.post, "/enrich-products", files=files, data=data)
+                dataset_id = response.headers["x-dataset-id"]
+                stage.extra["unique_items"] = int(response.headers["x-unique-items"])
+            else:
+                job = stage.timed(client.post, "/jobs/enrich-products", files=files, data=data).json()
+                dataset_id = job["dataset_id"]
+                while True:
+                    progress = client.get(f"/jobs/{job['job_id']}").json()
+                    if progress["status"] in ("completed", "failed"):
+                        break
+                    time.sleep(args.poll_seconds)
+                if progress["status"] == "failed":
+                    raise RuntimeError(f"enrich job failed: {progress['error']}")
+                stage.extra["unique_items"] = progress["stats"].get("unique_items")
+                stage.extra["failures"] = progress["failures"]
+    stage.rows = client.get("/rows", params={"dataset_id": dataset_id, "limit": 1}).json()["total"]
+    # Enrichment latency is per LLM call, the upload itself is a single request
+    stage.latencies = backend.latencies
+    stage.extra["llm_calls"] = len(backend.latencies)
+    stage.extra["concurrency_limit"] = get_limiter().current_limit
+    results.append(stage.result())
+    total_rows = stage.rows
+    params = {"dataset_id": dataset_id}
+
+    def random_page(limit: int):
+        offset = rng.randrange(max(total_rows - limit, 0) + 1)
+        return client.get("/rows", params={**params, "offset": offset, "limit": limit}).json()["rows"]
+
+    pages = [random_page(args.resynth_batch) for _ in range(args.resynth_requests)]
+    with Stage("resynthesize-batch", rss, db_timer) as stage:
+        for page in pages:
+            rows_to_process = [{key: row[key] for key in ("id", "product_name", "product_description") if key in row} for row in page]
+            stage.timed(client.post, "/resynthesize-batch", params=params, json=rows_to_process)
+            stage.rows += len(rows_to_process)
+    results.append(stage.result())
+
+    edits = [rng.randint(1, total_rows) for _ in range(args.edit_requests)]
+    with Stage("update-row", rss, db_timer) as stage:
+        for row_id in edits:
+            stage.timed(client.put, "/update-row", params=params, json={"id": row_id, "insight": f"edited {row_id}"})
+            stage.rows += 1
+    results.append(stage.result())
+
+    with Stage("patch-rows", rss, db_timer) as stage:
+        for start in range(0, len(edits), args.patch_batch):
+            deltas = [{"id": row_id, "quality_score": 5} for row_id in edits[start:start + args.patch_batch]]
+            stage.timed(client.patch, "/rows", params=params, json=deltas)
+            stage.rows += len(deltas)
+    results.append(stage.result())
+
+    for export_format in args.export_formats:
+        with Stage(f"download-results[{export_format}]", rss, db_timer) as stage:
+            response = stage.timed(client.get, "/download-results", params={**params, "format": export_format})
+            stage.rows = total_rows
+            stage.extra["bytes"] = len(response.content)
+        results.append(stage.result())
+
+    for result in results:
+        result["catalog_rows"] = rows
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_table(results):
+    header = f"{'rows':>8} {'stage':<24} {'rows/sec':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rss MB':>8} {'db write s':>10}"
+    print(header)
+    for result in results:
+        def fmt(value, spec):
+            return format(value, spec) if value is not None else "-"
+        print(
+            f"{result['catalog_rows']:>8} {result['stage']:<24} {fmt(result['rows_per_sec'], '>10.1f')} "
+            f"{fmt(result['p50_ms'], '>9.1f')} {fmt(result['p95_ms'], '>9.1f')} {fmt(result['p99_ms'], '>9.1f')} "
+            f"{result['peak_rss_mb']:>8.1f} {result['db_write_seconds']:>10.3f}"
+        )
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configure_environment(args, tmp_dir)
+        sys.path.insert(0, str(REPO_DIR))
+        from loguru import logger
+        logger.remove()
+        logger.add(sys.stderr, level=args.log_level)
+
+        import main as app_module
+        from backends import init_backend, set_backend
+        from fastapi.testclient import TestClient
+
+        profile = catalog_profile(Path(args.sample_csv))
+        rss = RssSampler()
+        rss.start()
+        db_timer = DbTimer(app_module.db_engine)
+        all_results = []
+        with TestClient(app_module.app) as client:
+            backend = TimedBackend(init_backend())
+            set_backend(backend)
+            for rows in args.sizes:
+                all_results.extend(run_size(client, args, rows, profile, tmp_dir, rss, db_timer, backend))
+            set_backend(backend.backend)
+        rss.stop()
+
+    print_table(all_results)
+    if args.output:
+        record = {
+            "benchmark": "pipeline",
+            "commit": git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "args": {key: value for key, value in vars(args).items() if key != "output"},
+            "results": all_results,
+        }
+        with open(args.output, "a", encoding="utf-8") as output:
+            output.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--sample-csv", default=str(SAMPLE_CSV))
+    parser.add_argument("--mode", choices=["job", "sync"], default="job", help="background job (what the UI uses) or the synchronous endpoint")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--cache", action="store_true", help="keep the result cache on (off by default so every row hits the backend)")
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--limiter", default="gradient", choices=["gradient", "aimd", "fixed"], help="concurrency limiter algorithm")
+    parser.add_argument("--pack-size", type=int, default=None)
+    parser.add_argument("--latency-dist", default="lognormal", choices=["fixed", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--endpoints", type=int, default=1, help="number of fake servers to balance over")
+    parser.add_argument("--server-parallel", type=int, default=30, help="requests the fake backend serves at once")
+    parser.add_argument("--resynth-requests", type=int, default=20)
+    parser.add_argument("--resynth-batch", type=int, default=20)
+    parser.add_argument("--edit-requests", type=int, default=200)
+    parser.add_argument("--patch-batch", type=int, default=20)
+    parser.add_argument("--export-formats", nargs="+", default=["csv", "csv.gz"])
+    parser.add_argument("--poll-seconds", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="append the results as one JSON line to this file")
+    main(parser.parse_args())
@@ -0,0 +1,110 @@
+from typing import Dict, Any
+import math
+import os
+'''
+Token budgets for LLM calls, worked out once per output schema.
+
+ollama reserves num_ctx tokens of KV cache for every parallel slot, so total VRAM for the cache is
+about num_ctx x OLLAMA_NUM_PARALLEL: a context sized to what a schema actually needs leaves room
+for more slots. The budget is the smallest context that is still safe for every row of a run:
+    (system prompt + the longest possible user prompt, every input field trimmed to
+    ENRICH_MAX_FIELD_TOKENS) x a prompt safety factor + num_predict
+rounded up to a multiple of 128. The prompt factor covers the 4-chars-per-token estimate running
+short on numbers, codes and non-English text. num_predict comes from the output schema: per-field
+estimates for the JSON the model has to write, times an output safety factor. Both stay fixed for
+the whole run since ollama reloads the model when num_ctx changes, and the coarse step keeps small
+schema edits from changing num_ctx. ENRICH_NUM_CTX / ENRICH_NUM_PREDICT pin them to fixed values instead.
+'''
+
+CHARS_PER_TOKEN = 4
+# Longest input field value sent to the model, longer descriptions are cut at a word boundary
+MAX_FIELD_TOKENS = int(os.getenv("ENRICH_MAX_FIELD_TOKENS", "160"))
+# Expected length of one free-text output field without a maxLength (the prompt asks for short answers)
+STRING_FIELD_TOKENS = int(os.getenv("ENRICH_STRING_FIELD_TOKENS", "48"))
+OUTPUT_SAFETY_FACTOR = float(os.getenv("ENRICH_OUTPUT_SAFETY_FACTOR", "1.5"))
+PROMPT_SAFETY_FACTOR = float(os.getenv("ENRICH_PROMPT_SAFETY_FACTOR", "1.3"))
+# 0 = work it out from the schema
+NUM_CTX_OVERRIDE = int(os.getenv("ENRICH_NUM_CTX", "0"))
+NUM_PREDICT_OVERRIDE = int(os.getenv("ENRICH_NUM_PREDICT", "0"))
+# Rounding keeps small schema edits from changing num_ctx (and reloading the model)
+NUM_CTX_STEP = 128
+NUM_PREDICT_STEP = 32
+TRIM_MARKER = " [...]"
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough rule of thumb for English text with llama/phi tokenizers: ~4 characters per token
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def round_up(value: float, step: int) -> int:
+    return int(math.ceil(value / step) * step)
+
+
+def trim_to_tokens(text: str, max_tokens: int = MAX_FIELD_TOKENS) -> str:
+    # Cut at the last word boundary that fits, and say so, the model shouldn't read a cut-off word as data
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars - len(TRIM_MARKER)]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut.rstrip() + TRIM_MARKER
+
+
+def estimate_value_tokens(schema: Dict[str, Any], definitions: Dict[str, Any]) -> int:
+    # Tokens the model writes for one JSON value of this schema
+    if '$ref' in schema:
+        return estimate_value_tokens(definitions.get(schema['$ref'].split('/')[-1], {}), definitions)
+    for key in ('anyOf', 'oneOf'):
+        if key in schema:
+            return max(estimate_value_tokens(option, definitions) for option in schema[key])
+    if 'enum' in schema:
+        return max(estimate_tokens(str(value)) for value in schema['enum']) + 1
+    if 'const' in schema:
+        return estimate_tokens(str(schema['const'])) + 1
+
+    schema_type = schema.get('type')
+    if schema_type == 'object':
+        properties = schema.get('properties', {})
+        # "key": value, per property plus the braces
+        return 2 + sum(estimate_tokens(name) + 3 + estimate_value_tokens(value, definitions) for name, value in properties.items())
+    if schema_type == 'array':
+        items = schema.get('maxItems', 3)
+        return 2 + items * (estimate_value_tokens(schema.get('items', {}), definitions) + 1)
+    if schema_type == 'string':
+        if 'maxLength' in schema:
+            return estimate_tokens('x' * schema['maxLength']) + 2
+        return STRING_FIELD_TOKENS
+    if schema_type in ('integer', 'number'):
+        return 6
+    if schema_type in ('boolean', 'null'):
+        return 2
+    return STRING_FIELD_TOKENS
+
+
+class TokenBudget:
+    def __init__(self, system_prompt: str, json_schema: Dict[str, Any], input_fields: Dict[str, int], prompt_overhead: str):
+        # input_fields: name -> most tokens its value can take in the prompt
+        self.system_tokens = estimate_tokens(system_prompt)
+        self.output_tokens = estimate_value_tokens(json_schema, json_schema.get('$defs', {}))
+        # Worst case user prompt: the fixed text plus every field at its trimmed maximum
+        self.max_prompt_tokens = estimate_tokens(prompt_overhead) + sum(
+            estimate_tokens(f"   '{name}': ''\n") + max_tokens for name, max_tokens in input_fields.items()
+        )
+        self.num_predict = NUM_PREDICT_OVERRIDE or round_up(self.output_tokens * OUTPUT_SAFETY_FACTOR, NUM_PREDICT_STEP)
+        self.num_ctx = NUM_CTX_OVERRIDE or round_up((self.system_tokens + self.max_prompt_tokens) * PROMPT_SAFETY_FACTOR + self.num_predict, NUM_CTX_STEP)
+
+    def max_num_predict(self, prompt: str, num_ctx: int = 0) -> int:
+        # Most output that still fits next to this prompt, for retries that need more room
+        prompt_tokens = (self.system_tokens + estimate_tokens(prompt)) * PROMPT_SAFETY_FACTOR
+        return max(self.num_predict, int((num_ctx or self.num_ctx) - prompt_tokens))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "num_ctx": self.num_ctx,
+            "num_predict": self.num_predict,
+            "system_tokens": self.system_tokens,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "estimated_output_tokens": self.output_tokens,
+        }
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+from loguru import logger
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+import os
+'''
+Content-addressed cache for validated LLM outputs.
+
+Two tiers: an in-memory LRU in front of a SQLite file that lives next to .database.db,
+so repeat uploads of the same catalog skip inference even after a restart.
+
+Writes go to memory right away and reach the disk tier in batches, one transaction per
+ENRICH_CACHE_WRITE_BATCH results (and at the end of a run). The event loop only ever touches the
+memory tier, disk lookups and flushes are run in a thread by the caller (see processor.py).
+'''
+
+CACHE_ENABLED = os.getenv("ENRICH_CACHE_ENABLED", "1") == "1"
+CACHE_PATH = os.getenv("ENRICH_CACHE_PATH", "./.cache.db")
+CACHE_MEMORY_ITEMS = int(os.getenv("ENRICH_CACHE_MEMORY_ITEMS", "10000"))
+CACHE_DISK_ITEMS = int(os.getenv("ENRICH_CACHE_DISK_ITEMS", "1000000"))
+CACHE_TTL_SECONDS = float(os.getenv("ENRICH_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+# Results written to the disk tier per transaction
+CACHE_WRITE_BATCH = int(os.getenv("ENRICH_CACHE_WRITE_BATCH", "100"))
+
+# Prune the disk tier once every N writes instead of on every insert
+PRUNE_EVERY = 1000
+
+
+def make_cache_key(*parts: Any) -> str:
+    # Dicts (json schemas) are serialized with sorted keys so the hash is byte-stable
+    hasher = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True, default=str)
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\x00")
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path: str = CACHE_PATH, max_memory_items: int = CACHE_MEMORY_ITEMS,
+                 max_disk_items: int = CACHE_DISK_ITEMS, ttl_seconds: float = CACHE_TTL_SECONDS,
+                 write_batch: int = CACHE_WRITE_BATCH):
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl_seconds = ttl_seconds
+        self.write_batch = write_batch
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        # Written but not on disk yet: key -> (serialized value, created_at)
+        self._pending: Dict[str, tuple] = {}
+        self._writes_since_prune = 0
+        # Two locks so the event loop never waits on disk I/O: the memory lock is only held for
+        # dict operations, the disk lock for the SQLite connection
+        self._memory_lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_result_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_result_cache_created ON llm_result_cache (created_at)")
+        self._conn.commit()
+
+    def _remember(self, key: str, value: Dict[str, Any], created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_from_memory(self, key: str) -> Optional[Dict[str, Any]]:
+        # Memory tier only, never blocks on the disk. A miss here isn't counted, get() decides that
+        now = time.time()
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return dict(value)
+                del self._memory[key]
+            return None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        # Both tiers, may read from disk: call it from a thread when on the event loop
+        value = self.get_from_memory(key)
+        if value is not None:
+            return value
+
+        now = time.time()
+        with self._memory_lock:
+            row = self._pending.get(key)
+        if row is None:
+            with self._disk_lock:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM llm_result_cache WHERE key = ?", (key,)
+                ).fetchone()
+        with self._memory_lock:
+            if row is not None and now - row[1] <= self.ttl_seconds:
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                self.hits += 1
+                return dict(value)
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Dict[str, Any]) -> bool:
+        # Memory only, returns True once enough writes are pending that flush() should run
+        now = time.time()
+        with self._memory_lock:
+            self._remember(key, dict(value), now)
+            self._pending[key] = (json.dumps(value, default=str), now)
+            return len(self._pending) >= self.write_batch
+
+    def flush(self):
+        # Writes the pending results in one transaction
+        with self._memory_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        now = time.time()
+        with self._disk_lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO llm_result_cache (key, value, created_at) VALUES (?, ?, ?)",
+                [(key, value, created_at) for key, (value, created_at) in pending.items()],
+            )
+            self._conn.commit()
+            self._writes_since_prune += len(pending)
+            if self._writes_since_prune >= PRUNE_EVERY:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        # TTL first, then trim the oldest entries down to the size limit
+        self._conn.execute("DELETE FROM llm_result_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._conn.execute(
+            "DELETE FROM llm_result_cache WHERE key IN ("
+            "SELECT key FROM llm_result_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_items,),
+        )
+        self._conn.commit()
+        self._writes_since_prune = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._disk_lock:
+            disk_items = self._conn.execute("SELECT COUNT(*) FROM llm_result_cache").fetchone()[0]
+        with self._memory_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "disk_items": disk_items,
+                "pending_writes": len(self._pending),
+            }
+
+    def close(self):
+        self.flush()
+        with self._disk_lock:
+            self._conn.close()
+
+
+_result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    # Returns None when caching is switched off with ENRICH_CACHE_ENABLED=0
+    global _result_cache
+    if not CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        _result_cache = ResultCache()
+        logger.info(f"Enrichment result cache opened at {CACHE_PATH}")
+    return _result_cache
+
+
+def close_result_cache():
+    global _result_cache
+    if _result_cache is not None:
+        _result_cache.close()
+        _result_cache = None
@@ -1,4 +1,4 @@
-from dash import Input, Output, State, clientside_callback, html, dcc, dash_table
+from dash import Input, Output, State, Patch, clientside_callback, html, dcc, dash_table, no_update
 from dash.exceptions import PreventUpdate
 import csv
 from assets.css.styles import *
@@ -9,6 +9,121 @@ import json
 import io 
 import os
 
+def dataset_params(job_store):
+    # Every backend call is scoped to the dataset of the job that filled the table
+    if job_store and job_store.get('dataset_id'):
+        return {'dataset_id': job_store['dataset_id']}
+    return {}
+
+
+def fetch_rows_page(job_store, page_current=0, page_size=20, sort_by=None, filter_query=''):
+    # One page of the dataset from /rows, sorting and filtering are done by the database
+    params = {
+        **dataset_params(job_store),
+        'offset': page_current * page_size,
+        'limit': page_size,
+        'sort': [('-' if sort['direction'] == 'desc' else '') + sort['column_id'] for sort in (sort_by or [])],
+    }
+    if filter_query:
+        params['filter'] = filter_query
+    response = requests.get("http://localhost:8000/rows", params=params, timeout=60)
+    if response.status_code != 200:
+        logger.error(f"Fetching rows page failed: {response.text}")
+        return None
+    return response.json()
+
+
+def diff_row_edits(current_data, previous_data):
+    # Cell-level deltas keyed by row id, only the cells that actually changed
+    previous_by_id = {row.get('id'): row for row in previous_data}
+    deltas = {}
+    for row in current_data:
+        previous_row = previous_by_id.get(row.get('id'))
+        if previous_row is None:
+            continue
+        changed_cells = {column: value for column, value in row.items() if previous_row.get(column) != value}
+        if changed_cells:
+            deltas[str(row['id'])] = changed_cells
+    return deltas
+
+
+# Written by the enrichment run (ok / repaired / cached / failed, attempts, last error), not by the user
+ROW_STATUS_COLUMNS = ('enrich_status', 'enrich_attempts', 'enrich_error')
+# Natural key of the row (sku or a hash of the product fields), shown first and never editable
+ROW_KEY_COLUMN = 'row_key'
+FAILED_ROW_BG_COLOR = '#4a2328'
+
+
+def build_table_layout(csv_header_sequence, returned_columns):
+    # Works out column order and the synthesized-column styling for the enriched table
+
+    # --- Column Ordering Logic (Your Solution) ---
+    all_returned_keys_set = set(returned_columns)
+
+    original_column_order = [ROW_KEY_COLUMN] if ROW_KEY_COLUMN in all_returned_keys_set else []
+    original_column_order += [
+        col for col in csv_header_sequence 
+        if col in all_returned_keys_set and col != ROW_KEY_COLUMN
+    ]
+
+    # 2. Identify new columns NOT present in the original order list
+    original_set = set(original_column_order) 
+    new_columns = sorted(list(all_returned_keys_set - original_set))
+
+    # 3. Combine the lists: Original order first, new columns appended at the end
+    final_display_order = original_column_order + new_columns
+
+    # 4. Filter out the 'id' column from the final display list
+    columns_to_display = [col for col in final_display_order if col != 'id']
+
+    # 5. Create the dynamic columns list using the guaranteed order
+    dynamic_columns = [
+        {"name": i, "id": i, **({"editable": False} if i in ROW_STATUS_COLUMNS or i == ROW_KEY_COLUMN else {})}
+        for i in columns_to_display
+    ]
+
+    # 6. Calculate the index where synthesized columns start for styling purposes
+    synth_start_index = len(original_column_order) 
+
+    # --- Styling Logic (Combined Solution) ---
+    data_conditional_styles = [
+        { 
+            'if': {'state': 'active'}, 
+            'backgroundColor': '#FFD700', 
+            'color': 'black', 
+            'border': '1px solid #FFD700',
+            'textAlign': 'left' # <--- ADDED HERE
+        }
+    ]            
+    header_conditional_styles = []
+
+    SYNTH_BG_COLOR = '#1a252f' 
+    SYNTH_TEXT_COLOR = '#95a5a6' # A contrasting light gray color
+
+    if columns_to_display and synth_start_index is not None:
+        for i in range(synth_start_index, len(columns_to_display)):
+            col_id = columns_to_display[i]
+            data_conditional_styles.append({
+                'if': {'column_id': col_id}, 
+                'backgroundColor': SYNTH_BG_COLOR, 
+                'color': SYNTH_TEXT_COLOR, # <-- Use the contrasting color here
+            })
+            header_conditional_styles.append({
+                'if': {'column_id': col_id}, 
+                'backgroundColor': SYNTH_BG_COLOR, 
+                'color': SYNTH_TEXT_COLOR, # <-- Use the contrasting color here
+            })
+
+    # Rows the model couldn't fill stand out, select them and resynthesize. Last so it wins over the column colors
+    if 'enrich_status' in columns_to_display:
+        data_conditional_styles.append({
+            'if': {'filter_query': '{enrich_status} = failed'},
+            'backgroundColor': FAILED_ROW_BG_COLOR,
+        })
+
+    return dynamic_columns, data_conditional_styles, header_conditional_styles
+
+
 def register_data_callbacks(app_dash):
 
     @app_dash.callback(
@@ -21,10 +136,8 @@ def register_data_callbacks(app_dash):
 
     @app_dash.callback(
             Output("upload-status-message", "children", allow_duplicate=True),
-            Output("enriched-data-table", "data"),
-            Output("enriched-data-table", "columns"), 
-            Output("enriched-data-table", "style_data_conditional"), # <-- Add this output
-            Output("enriched-data-table", "style_header_conditional"), # <-- Add this output
+            Output("enrichment-job-store", "data"),
+            Output("job-poll-interval", "disabled"),
             Input('submit-button', 'n_clicks'),
             State('upload-data', 'contents'),
             State('upload-data', 'filename'),
@@ -34,8 +147,8 @@ def register_data_callbacks(app_dash):
         )
     def enrich_data(n_clicks, contents, filename, mode_selection, custom_schema_data):
 
-        # ... (omitted environment variable logic for fastapi_endpoint) ...
-        fastapi_endpoint = "http://localhost:8000/enrich-products" # Define your endpoint here
+        # The backend queues a job and answers right away, progress is polled by poll_enrichment_job
+        fastapi_endpoint = "http://localhost:8000/jobs/enrich-products" # Define your endpoint here
 
         content_type, content_string = contents.split(',')
         decoded = base64.b64decode(content_string)
@@ -46,11 +159,11 @@ def register_data_callbacks(app_dash):
             reader = csv.reader(decoded_io)
             csv_header_sequence = next(reader)
         except Exception as e:
-            return html.Div(f"Error reading CSV headers: {str(e)}", style={'color': 'red'}), [], [], [], [] # Handle error returns with empty styles
+            return html.Div(f"Error reading CSV headers: {str(e)}", style={'color': 'red'}), None, True
 
         if mode_selection == 'custom':
             if not custom_schema_data:
-                return html.Div("Error: Custom schema selected but no fields added.", style={'color': 'red'}), [], [], [], []
+                return html.Div("Error: Custom schema selected but no fields added.", style={'color': 'red'}), None, True
             schema_payload_dict = {'mode': 'custom', 'fields': custom_schema_data}
         else: 
             schema_payload_dict = {'mode': 'defaults', 'fields': []}
@@ -68,82 +181,76 @@ def register_data_callbacks(app_dash):
         
         logger.info("Posting from Dash to fastapi endpoint")
 
-        response = requests.post(fastapi_endpoint, files=files, data=data)
+        response = requests.post(fastapi_endpoint, files=files, data=data, timeout=60)
         
         if response.status_code == 200:
-            enriched_data_list = response.json()
-            num_items = len(enriched_data_list)
-
-            if num_items == 0:
-                # Return empty styles for 0 items processed scenario
-                return "Processed 0 items.", [], [], [], [] 
-
-            # --- Column Ordering Logic (Your Solution) ---
-            all_returned_keys_set = set(enriched_data_list[0].keys())
-            
-            original_column_order = [
-                col for col in csv_header_sequence 
-                if col in all_returned_keys_set
-            ]
-
-            # 2. Identify new columns NOT present in the original order list
-            original_set = set(original_column_order) 
-            new_columns = sorted(list(all_returned_keys_set - original_set))
-
-            # 3. Combine the lists: Original order first, new columns appended at the end
-            final_display_order = original_column_order + new_columns
-            
-            # 4. Filter out the 'id' column from the final display list
-            columns_to_display = [col for col in final_display_order if col != 'id']
-
-            # 5. Create the dynamic columns list using the guaranteed order
-            dynamic_columns = [{"name": i, "id": i} for i in columns_to_display]
-            
-            # 6. Calculate the index where synthesized columns start for styling purposes
-            synth_start_index = len(original_column_order) 
-            
-            # --- Styling Logic (Combined Solution) ---
-            data_conditional_styles = [
-                { 
-                    'if': {'state': 'active'}, 
-                    'backgroundColor': '#FFD700', 
-                    'color': 'black', 
-                    'border': '1px solid #FFD700',
-                    'textAlign': 'left' # <--- ADDED HERE
-                }
-            ]            
-            header_conditional_styles = []
-
-            SYNTH_BG_COLOR = '#1a252f' 
-            SYNTH_TEXT_COLOR = '#95a5a6' # A contrasting light gray color
-
-            if columns_to_display and synth_start_index is not None:
-                for i in range(synth_start_index, len(columns_to_display)):
-                    col_id = columns_to_display[i]
-                    data_conditional_styles.append({
-                        'if': {'column_id': col_id}, 
-                        'backgroundColor': SYNTH_BG_COLOR, 
-                        'color': SYNTH_TEXT_COLOR, # <-- Use the contrasting color here
-                    })
-                    header_conditional_styles.append({
-                        'if': {'column_id': col_id}, 
-                        'backgroundColor': SYNTH_BG_COLOR, 
-                        'color': SYNTH_TEXT_COLOR, # <-- Use the contrasting color here
-                    })
-
-
-            # --- Return all outputs ---
-            return (
-                f"Successfully processed {num_items} items!",
-                enriched_data_list,                          
-                dynamic_columns,
-                data_conditional_styles, # Return the generated data styles
-                header_conditional_styles # Return the generated header styles
-            )
+            job = response.json()
+            job_store = {'job_id': job['job_id'], 'dataset_id': job['dataset_id'], 'csv_header_sequence': csv_header_sequence}
+            return f"Enrichment job queued for {job['total_rows']} items...", job_store, False
         else:
             error_detail = response.json().get("detail", "Unknown error")
-            # Handle error returns with empty styles
-            return html.Div(f"Error from API: {error_detail}", style={'color': 'red'}), [], [], [], []
+            return html.Div(f"Error from API: {error_detail}", style={'color': 'red'}), None, True
+
+    @app_dash.callback(
+            Output("upload-status-message", "children", allow_duplicate=True),
+            Output("enriched-data-table", "page_current"),
+            Output("enriched-data-table", "columns"), 
+            Output("enriched-data-table", "style_data_conditional"),
+            Output("enriched-data-table", "style_header_conditional"),
+            Output("job-poll-interval", "disabled", allow_duplicate=True),
+            Input('job-poll-interval', 'n_intervals'),
+            State('enrichment-job-store', 'data'),
+            prevent_initial_call=True
+        )
+    def poll_enrichment_job(n_intervals, job_store):
+        if not job_store:
+            raise PreventUpdate
+
+        fastapi_endpoint = f"http://localhost:8000/jobs/{job_store['job_id']}"
+        response = requests.get(fastapi_endpoint, timeout=10)
+        if response.status_code != 200:
+            error_detail = response.json().get("detail", "Unknown error")
+            return html.Div(f"Error from API: {error_detail}", style={'color': 'red'}), no_update, [], [], [], True
+
+        job = response.json()
+        if job['status'] in ('queued', 'running'):
+            eta = f", ETA {job['eta_seconds']:.0f}s" if job['eta_seconds'] is not None else ""
+            message = (
+                f"Enriching: {job['rows_done']}/{job['total_rows']} rows "
+                f"({job['rows_per_sec']} rows/sec{eta}, {job['failures']} failures)"
+            )
+            return message, no_update, no_update, no_update, no_update, False
+
+        if job['status'] == 'failed':
+            return html.Div(f"Enrichment job failed: {job['error']}", style={'color': 'red'}), no_update, [], [], [], True
+
+        # Completed: results are already in the database. Only the column layout and row count are
+        # needed here, resetting page_current makes load_table_page fetch the first page
+        first_row = fetch_rows_page(job_store, page_size=1)
+        num_items = first_row['total'] if first_row else 0
+
+        if num_items == 0:
+            # Return empty styles for 0 items processed scenario
+            return "Processed 0 items.", 0, [], [], [], True
+
+        dynamic_columns, data_conditional_styles, header_conditional_styles = build_table_layout(
+            job_store['csv_header_sequence'], first_row['columns']
+        )
+
+        status_message = f"Successfully processed {num_items} items!"
+        if 'unique_items' in job['stats']:
+            dedup_percent = job['stats']['dedup_ratio'] * 100
+            status_message += f" ({job['stats']['unique_items']} unique, {dedup_percent:.0f}% deduplicated)"
+
+        # --- Return all outputs ---
+        return (
+            status_message,
+            0,
+            dynamic_columns,
+            data_conditional_styles, # Return the generated data styles
+            header_conditional_styles, # Return the generated header styles
+            True
+        )
 
     @app_dash.callback(
         Output('download-button', 'disabled'),
@@ -157,10 +264,11 @@ def register_data_callbacks(app_dash):
 
     clientside_callback(
         """
-        function(n_clicks) {
+        function(n_clicks, job_store) {
             if (n_clicks > 0) {
                 // This forces the browser to navigate to the URL and initiate the download prompt
-                window.location.href = '/download-results'; 
+                var query = (job_store && job_store.dataset_id) ? '?dataset_id=' + encodeURIComponent(job_store.dataset_id) : '';
+                window.location.href = '/download-results' + query; 
             }
             // Return a dummy value, since the action is handled client-side
             return '';
@@ -168,44 +276,77 @@ def register_data_callbacks(app_dash):
         """,
         Output('url', 'href'), 
         Input('download-button', 'n_clicks'),
+        State('enrichment-job-store', 'data'),
         prevent_initial_call=True
     )
 
     @app_dash.callback(
-    Output('upload-status-message', 'children', allow_duplicate=True),
-    Output('refresh-trigger', 'data'), # <-- Add this output
-    Input('enriched-data-table', 'data'),
-    State('enriched-data-table', 'data_previous'),
-    State('refresh-trigger', 'data') # <-- Add this state
+        Output('pending-edits-store', 'data'),
+        Output('edit-flush-interval', 'disabled'),
+        Input('enriched-data-table', 'data_timestamp'), # Only changes on user edits, not on page loads
+        State('enriched-data-table', 'data'),
+        State('enriched-data-table', 'data_previous'),
+        State('pending-edits-store', 'data'),
+        prevent_initial_call=True
     )
-    def update_database_full_row(current_data, previous_data, trigger_data):
+    def record_row_edits(data_timestamp, current_data, previous_data, pending_edits):
         if current_data is None or previous_data is None:
             raise PreventUpdate
 
-        # This finds the difference based on comparing list lengths/content
-        # A simplified way to find *which* specific row was just edited
-        changed_row = next((row for row in current_data if row not in previous_data), None)
+        deltas = diff_row_edits(current_data, previous_data)
+        if not deltas:
+            raise PreventUpdate
+
+        # Queue the changed cells, edits made before the flush interval fires go out in the same PATCH
+        pending_edits = pending_edits or {}
+        for row_id, changed_cells in deltas.items():
+            pending_edits[row_id] = {**pending_edits.get(row_id, {}), **changed_cells}
+        return pending_edits, False
+
+    @app_dash.callback(
+        Output('upload-status-message', 'children', allow_duplicate=True),
+        Output('enriched-data-table', 'data', allow_duplicate=True),
+        Output('pending-edits-store', 'data', allow_duplicate=True),
+        Output('edit-flush-interval', 'disabled', allow_duplicate=True),
+        Input('edit-flush-interval', 'n_intervals'),
+        State('pending-edits-store', 'data'),
+        State('enriched-data-table', 'data'),
+        State('enrichment-job-store', 'data'),
+        prevent_initial_call=True
+    )
+    def flush_row_edits(n_intervals, pending_edits, table_data, job_store):
+        if not pending_edits:
+            return no_update, no_update, no_update, True
+
+        if os.environ['APP_ENV'] == 'local':
+
+            fastapi_endpoint = "http://0.0.0.0:8000/rows"
 
-        if changed_row:
-            # We found the dictionary of the entire row that was modified
-            payload = changed_row 
-            if os.environ['APP_ENV'] == 'local':
+        else:
+            runpod = os.getenv("RUNPOD_ID")
 
-                fastapi_endpoint = "http://0.0.0.0:8000/update-row"
+            fastapi_endpoint = f"https://{runpod}-8000.proxy.runpod.net/rows"
 
-            else:
-                runpod = os.getenv("RUNPOD_ID")
+        deltas = [{'id': int(row_id), **changed_cells} for row_id, changed_cells in pending_edits.items()]
+        response = requests.patch(fastapi_endpoint, json=deltas, params=dataset_params(job_store), timeout=30)
 
-                fastapi_endpoint = f"https://{runpod}-8000.proxy.runpod.net/update-row"
+        # Only drop the edits that were sent, anything recorded meanwhile goes out on the next tick.
+        # The interval stays on and switches itself off on the first tick with nothing pending
+        sent_edits = Patch()
+        for row_id in pending_edits:
+            del sent_edits[row_id]
 
-            response = requests.put(fastapi_endpoint, json=payload)
-            
-            if response.status_code == 200:
-                return f"Updated row {changed_row.get('product_name', 'N/A')} in the database.", trigger_data + 1 
-            else:
-                return f"Error updating database: {response.json().get('detail', 'Unknown error')}", trigger_data
+        if response.status_code != 200:
+            return f"Error updating database: {response.json().get('detail', 'Unknown error')}", no_update, sent_edits, no_update
 
-        raise PreventUpdate 
+        # Patch just the returned rows into the visible page, no reload
+        updated_rows = {row['id']: row for row in response.json()['rows']}
+        patched_data = Patch()
+        for index, row in enumerate(table_data or []):
+            if row.get('id') in updated_rows:
+                patched_data[index] = updated_rows[row['id']]
+
+        return f"Saved edits to {len(updated_rows)} row(s).", patched_data, sent_edits, no_update
 
     @app_dash.callback(
         Output('upload-status-message', 'children', allow_duplicate=True),
@@ -213,9 +354,10 @@ def register_data_callbacks(app_dash):
         Input('batch-resynth-button', 'n_clicks'), # The new button's n_clicks is the input
         State('enriched-data-table', 'data'),      # The full dataset in the table
         State('enriched-data-table', 'selected_rows'), # The indices of selected rows
-        State('refresh-trigger', 'data')
+        State('refresh-trigger', 'data'),
+        State('enrichment-job-store', 'data')
     )
-    def handle_batch_resynthesis(n_clicks, table_data, selected_row_indices, trigger_data):
+    def handle_batch_resynthesis(n_clicks, table_data, selected_row_indices, trigger_data, job_store):
         if n_clicks is None or n_clicks == 0:
             raise PreventUpdate
 
@@ -231,7 +373,7 @@ def register_data_callbacks(app_dash):
 
         logger.info("test from inside resynth function")
         # Send the list of dictionaries as a JSON payload
-        response = requests.post(fastapi_endpoint, json=rows_to_process)
+        response = requests.post(fastapi_endpoint, json=rows_to_process, params=dataset_params(job_store))
 
         if response.status_code == 200:
             # Increment trigger and return success message
@@ -244,27 +386,28 @@ def register_data_callbacks(app_dash):
 
     @app_dash.callback(
         Output('enriched-data-table', 'data', allow_duplicate=True), 
-        Input('refresh-trigger', 'data')       
+        Output('enriched-data-table', 'page_count'),
+        Output('enriched-data-table', 'selected_rows'),
+        Input('enriched-data-table', 'page_current'),
+        Input('enriched-data-table', 'page_size'),
+        Input('enriched-data-table', 'sort_by'),
+        Input('enriched-data-table', 'filter_query'),
+        Input('refresh-trigger', 'data'),
+        State('enrichment-job-store', 'data'),
+        prevent_initial_call=True
     )
-    def refresh_table_data_from_db(n_triggers):
-        # Prevents running when the app first loads (n_triggers is None or 0 initially)
-        if n_triggers is None or n_triggers == 0:
+    def load_table_page(page_current, page_size, sort_by, filter_query, n_triggers, job_store):
+        # Runs on paging/sorting/filtering and after every edit, and only ever loads the visible page
+        if not job_store:
             raise PreventUpdate
-            
-        # Determine the FastAPI endpoint URL to GET ALL data from the DB
-        # You need this endpoint to exist in app_fastapi.py, e.g., "/get-all-data-json"
-        fastapi_endpoint = "http://localhost:8000/get-all-data-json" 
-        
-        # Send a GET request to the backend to retrieve the *entire* dataset
-        response = requests.get(fastapi_endpoint)
-        
-        if response.status_code == 200:
-            # The data returned is a list of dictionaries (JSON)
-            # This repopulates the entire Dash DataTable UI with the freshest data
-            return response.json() 
-        else:
 
-            return [] 
+        page = fetch_rows_page(job_store, page_current or 0, page_size, sort_by, filter_query)
+        if page is None:
+            return [], 0, []
+
+        page_count = max(1, -(-page['total'] // page_size))
+        # Selection indices point into the page data, so they don't carry over to another page
+        return page['rows'], page_count, []
 
     @app_dash.callback(
         Output('custom-schema-wrapper', 'style'),
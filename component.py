@@ -8,6 +8,12 @@ user_interface = html.Div(
         dcc.Store(id='refresh-trigger', data=0),
        # This stores the list of custom schema fields globally
         dcc.Store(id='custom-schema-store', data=[]), 
+        # Background enrichment job being polled (job id + original CSV header order)
+        dcc.Store(id='enrichment-job-store', data=None),
+        dcc.Interval(id='job-poll-interval', interval=1000, disabled=True),
+        # Cell edits waiting to be sent, flushed as one PATCH when the debounce interval fires
+        dcc.Store(id='pending-edits-store', data={}),
+        dcc.Interval(id='edit-flush-interval', interval=500, disabled=True),
 
         # --- Upload Row ---
         html.Div(
@@ -98,7 +104,16 @@ user_interface = html.Div(
                     id='enriched-data-table',
                     data=[],      
                     columns=[],    
+                    # Paging, sorting and filtering happen in SQL via /rows, the grid only holds the visible page
+                    page_action='custom',
+                    page_current=0,
                     page_size=20,
+                    page_count=0,
+                    sort_action='custom',
+                    sort_mode='multi',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
                     style_table={
                         'overflowX': 'auto',
                     },
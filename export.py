@@ -0,0 +1,201 @@
+from sqlalchemy import text, inspect
+from sqlalchemy.engine import Engine
+from typing import List, Iterator, Tuple, Any
+from loguru import logger
+from storage import quote_column, HIDDEN_COLUMNS
+import csv
+import io
+import itertools
+import os
+import zlib
+'''
+Streaming exports of a results table.
+
+Rows are read through a streaming cursor in batches and every batch is encoded and handed to
+the response as soon as it is ready, so a download never holds the whole dataset in memory.
+CSV (optionally gzipped) needs nothing extra, Parquet and Arrow IPC need pyarrow installed.
+'''
+
+EXPORT_BATCH_ROWS = int(os.getenv("ENRICH_EXPORT_BATCH_ROWS", "5000"))
+
+# format -> (file extension, media type)
+EXPORT_FORMATS = {
+    "csv": ("csv", "text/csv"),
+    "csv.gz": ("csv.gz", "application/gzip"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "arrow": ("arrows", "application/vnd.apache.arrow.stream"),
+}
+
+
+class ExportUnavailable(RuntimeError):
+    pass
+
+
+def export_columns(engine: Engine, table_name: str, exclude_columns: Tuple[str, ...] = HIDDEN_COLUMNS) -> List[Tuple[str, str]]:
+    # (name, declared SQL type) pairs, the types drive the Arrow schema
+    return [
+        (column['name'], str(column['type']).upper())
+        for column in inspect(engine).get_columns(table_name)
+        if column['name'] not in exclude_columns
+    ]
+
+
+def table_has_rows(engine: Engine, table_name: str) -> bool:
+    with engine.connect() as connection:
+        return connection.execute(text(f"SELECT 1 FROM {quote_column(table_name)} LIMIT 1")).first() is not None
+
+
+def iter_row_batches(engine: Engine, table_name: str, columns: List[str], batch_rows: int = EXPORT_BATCH_ROWS) -> Iterator[List[Tuple[Any, ...]]]:
+    # The connection stays open for the whole download. Under WAL it reads a stable snapshot
+    # and doesn't block the job writing to other tables
+    select_list = ', '.join(quote_column(column) for column in columns)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            text(f"SELECT {select_list} FROM {quote_column(table_name)} ORDER BY id")
+        )
+        for partition in result.partitions(batch_rows):
+            yield [tuple(row) for row in partition]
+
+
+def iter_csv(engine: Engine, table_name: str) -> Iterator[bytes]:
+    columns = [name for name, _ in export_columns(engine, table_name)]
+    buffer = io.StringIO()
+    # Same layout as the old pandas to_csv export: '\n' line endings, NULL as an empty cell
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    writer.writerow(columns)
+    for batch in iter_row_batches(engine, table_name, columns):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_csv_gzip(engine: Engine, table_name: str) -> Iterator[bytes]:
+    # wbits=31 writes a gzip header/trailer, so the output is a regular .csv.gz file
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in iter_csv(engine, table_name):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _ChunkSink:
+    # Minimal writable file for pyarrow. Written bytes are collected until the caller drains them
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable("Parquet and Arrow exports need pyarrow, install it with: pip install pyarrow")
+    return pyarrow
+
+
+def _arrow_schema(pa, columns: List[Tuple[str, str]]):
+    arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64()}
+    return pa.schema([(name, arrow_types.get(sql_type, pa.string())) for name, sql_type in columns])
+
+
+def _coerce_value(value, arrow_type, pa):
+    # SQLite columns are loosely typed, an INTEGER column can hold text that was PATCHed in by hand.
+    # Anything that doesn't convert cleanly becomes null instead of failing the whole export
+    if value is None:
+        return None
+    try:
+        if pa.types.is_integer(arrow_type):
+            number = float(value)
+            return int(number) if number.is_integer() else None
+        if pa.types.is_floating(arrow_type):
+            return float(value)
+        return str(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _arrow_array(pa, values: List[Any], field):
+    try:
+        return pa.array(values, type=field.type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+        coerced = [_coerce_value(value, field.type, pa) for value in values]
+        dropped = sum(1 for value, new in zip(values, coerced) if value is not None and new is None)
+        if dropped:
+            logger.warning(f"Export: {dropped} value(s) in column {field.name!r} are not {field.type}, written as null")
+        return pa.array(coerced, type=field.type)
+
+
+def _iter_arrow_format(engine: Engine, table_name: str, open_writer) -> Iterator[bytes]:
+    pa = _import_pyarrow()
+    columns = export_columns(engine, table_name)
+    schema = _arrow_schema(pa, columns)
+    column_names = [name for name, _ in columns]
+
+    sink = _ChunkSink()
+    writer = open_writer(pa, pa.PythonFile(sink, mode='w'), schema)
+    for batch in iter_row_batches(engine, table_name, column_names):
+        # One record batch (one Parquet row group) per DB batch
+        arrays = [_arrow_array(pa, [row[index] for row in batch], schema.field(index)) for index in range(len(column_names))]
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+def iter_parquet(engine: Engine, table_name: str) -> Iterator[bytes]:
+    return _iter_arrow_format(engine, table_name, lambda pa, sink, schema: pa.parquet.ParquetWriter(sink, schema))
+
+
+def iter_arrow_stream(engine: Engine, table_name: str) -> Iterator[bytes]:
+    return _iter_arrow_format(engine, table_name, lambda pa, sink, schema: pa.ipc.new_stream(sink, schema))
+
+
+def _primed(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    # Encode the first batch right away, so an export that fails does so before the 200 is sent
+    # and not as a truncated (or empty) download
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return iter(())
+    return itertools.chain([first_chunk], chunks)
+
+
+def iter_export(engine: Engine, table_name: str, export_format: str) -> Iterator[bytes]:
+    if export_format == "csv":
+        return _primed(iter_csv(engine, table_name))
+    if export_format == "csv.gz":
+        return _primed(iter_csv_gzip(engine, table_name))
+    # Checked up front so a missing pyarrow is an error response, not a broken download
+    _import_pyarrow()
+    if export_format == "parquet":
+        return _primed(iter_parquet(engine, table_name))
+    return _primed(iter_arrow_stream(engine, table_name))
@@ -0,0 +1,202 @@
+from fastapi import HTTPException, UploadFile
+from pydantic import ValidationError
+from typing import List, Iterator, Tuple, Dict, Optional, Callable
+from processor import EnrichRequestItem
+from cache import make_cache_key
+from storage import ROW_KEY_COLUMN
+from metrics import timed
+from loguru import logger
+import pandas as pd
+import numpy as np
+import tempfile
+import os
+'''
+Chunked CSV ingestion for uploads.
+
+The upload is spooled to a temp file in fixed-size chunks and parsed with pandas' C engine
+in row chunks, keeping only the EnrichRequestItem columns of each chunk. Items are produced
+lazily so the enrichment scheduler pulls rows as it has free slots instead of holding the whole file.
+
+Every row also gets a natural key (row_key), what a dataset knows it by across uploads:
+    <column>   the value of a CSV column such as sku, rows with it blank fall back to the hash
+    hash       a hash of the row's item fields, identical products get the same key
+    position   the row number, the old behaviour
+    auto       sku when the file has that column, hash otherwise (default, ENRICH_ROW_KEY)
+A key that repeats within the file gets a #2, #3... suffix, so every row stays addressable.
+'''
+
+REQUIRED_FIELD = "product_name"
+UPLOAD_CHUNK_BYTES = int(os.getenv("ENRICH_UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+CSV_CHUNK_ROWS = int(os.getenv("ENRICH_CSV_CHUNK_ROWS", "5000"))
+ROW_KEY = os.getenv("ENRICH_ROW_KEY", "auto")
+AUTO_KEY_COLUMN = "sku"
+# 64 bits of the sha256, plenty for a catalog and still readable in the grid
+HASH_KEY_CHARS = 16
+
+
+async def spool_upload_to_disk(file: UploadFile) -> str:
+    # Background jobs outlive the request (and the UploadFile), so they read from their own copy
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as spooled:
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            spooled.write(chunk)
+    return spooled.name
+
+
+def remove_spooled_upload(csv_path: str):
+    try:
+        os.remove(csv_path)
+    except OSError:
+        pass
+
+
+def resolve_row_key(header: List[str], requested: Optional[str] = None) -> str:
+    row_key = (requested or ROW_KEY).strip()
+    if row_key == 'auto':
+        return AUTO_KEY_COLUMN if AUTO_KEY_COLUMN in header else 'hash'
+    if row_key in ('hash', 'position'):
+        return row_key
+    if row_key not in header:
+        raise HTTPException(status_code=400, detail=f"Row key column '{row_key}' is not in the CSV.")
+    return row_key
+
+
+def validate_csv_upload(csv_path: str, row_key: Optional[str] = None) -> Tuple[List[str], str]:
+    # Only the header and first row are read here, so bad uploads still fail fast with a 400.
+    # Returns the columns to keep and the resolved row key
+    try:
+        df_head = pd.read_csv(csv_path, nrows=1, dtype=str, encoding='utf-8', on_bad_lines='skip')
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error parsing CSV: {str(e)}")
+
+    if df_head.empty:
+        raise HTTPException(status_code=400, detail="CSV file is empty.")
+
+    # 'id' is always assigned by us, never taken from the file
+    expected_fields = set(EnrichRequestItem.model_fields.keys()) - {'id'}
+    columns_to_keep = [column for column in df_head.columns if column in expected_fields]
+    if REQUIRED_FIELD not in columns_to_keep:
+        raise HTTPException(status_code=400, detail=f"CSV must contain the required column: '{REQUIRED_FIELD}'.")
+
+    row_key = resolve_row_key(list(df_head.columns), row_key)
+    # A key column is kept next to the item fields so it shows up in the grid and the exports
+    if row_key not in ('hash', 'position') and row_key not in columns_to_keep:
+        columns_to_keep.append(row_key)
+    return columns_to_keep, row_key
+
+
+class RowKeys:
+    """
+    Works out the natural key of every row of one upload, see the module docstring.
+    Remembers the keys it handed out to number repeats, so it lives as long as the upload.
+    """
+    def __init__(self, row_key: str, columns_to_keep: List[str]):
+        self.row_key = row_key
+        # The hash covers the item fields only, a key column like sku isn't part of the product data
+        self.hash_fields = [column for column in columns_to_keep if column in EnrichRequestItem.model_fields and column != 'id']
+        # Every key handed out so far, and the next suffix to try per repeated key
+        self._used: set = set()
+        self._next_suffix: Dict[str, int] = {}
+
+    def hash_key(self, record: dict) -> str:
+        return make_cache_key({field: record.get(field) for field in self.hash_fields})[:HASH_KEY_CHARS]
+
+    def keys_for(self, df_chunk: pd.DataFrame) -> List[str]:
+        if self.row_key == 'position':
+            return [str(row_id) for row_id in df_chunk['id']]
+
+        keys = []
+        for record in df_chunk.to_dict(orient='records'):
+            key = record.get(self.row_key) if self.row_key != 'hash' else None
+            key = str(key).strip() if key is not None and not pd.isna(key) else ''
+            if not key:
+                key = self.hash_key(record)
+            keys.append(self._unique(key))
+        return keys
+
+    def _unique(self, key: str) -> str:
+        # A suffixed key can clash with a real one (A, A, A#2), so keep counting until it's free
+        if key in self._used:
+            suffix = self._next_suffix.get(key, 2)
+            while f"{key}#{suffix}" in self._used:
+                suffix += 1
+            self._next_suffix[key] = suffix + 1
+            key = f"{key}#{suffix}"
+        self._used.add(key)
+        return key
+
+
+def estimate_csv_rows(csv_path: str) -> int:
+    # Newline count, good enough for progress/ETA. Quoted multi-line cells make it an overestimate
+    newlines = 0
+    with open(csv_path, 'rb') as csv_file:
+        while chunk := csv_file.read(UPLOAD_CHUNK_BYTES):
+            newlines += chunk.count(b'\n')
+    return max(newlines - 1, 0)
+
+
+def iter_csv_chunks(csv_path: str, columns_to_keep: List[str], chunk_rows: int = CSV_CHUNK_ROWS,
+                    row_keys: Optional[RowKeys] = None) -> Iterator[pd.DataFrame]:
+    # Every cell is read as a string, the item fields are all text and this skips type inference.
+    # Columns are selected per chunk rather than with usecols, which would stop malformed lines being skipped
+    reader = pd.read_csv(
+        csv_path,
+        dtype=str,
+        engine='c',
+        encoding='utf-8',
+        on_bad_lines='skip',
+        chunksize=chunk_rows,
+    )
+    next_id = 1
+    with reader:
+        while True:
+            with timed("csv_parse"):
+                df_chunk = next(reader, None)
+                if df_chunk is None:
+                    break
+                df_chunk = df_chunk[columns_to_keep].replace({np.nan: None})
+                df_chunk['id'] = range(next_id, next_id + len(df_chunk))
+                if row_keys is not None:
+                    df_chunk[ROW_KEY_COLUMN] = row_keys.keys_for(df_chunk)
+            next_id += len(df_chunk)
+            yield df_chunk
+
+
+def items_from_chunk(df_chunk: pd.DataFrame) -> Tuple[List[EnrichRequestItem], Dict[int, str]]:
+    # The chunk's items, and the validation error of every row that didn't make one by its id.
+    # One bad row (e.g. no product_name) doesn't reject a whole upload, it is stored as a failed row
+    items = []
+    rejected = {}
+    with timed("item_build"):
+        for row in df_chunk.to_dict(orient='records'):
+            try:
+                items.append(EnrichRequestItem(**row))
+            except Exception as e:
+                if isinstance(e, ValidationError):
+                    # 'product_name: Input should be a valid string' instead of pydantic's multi-line report
+                    e = '; '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                logger.warning(f"Rejected CSV row {row.get('id')}: {e}")
+                rejected[row['id']] = f"Invalid CSV row: {e}"
+    return items, rejected
+
+
+def parse_csv_upload(csv_path: str, row_key: Optional[str] = None,
+                     prepare_chunk: Optional[Callable[[pd.DataFrame], None]] = None) -> Tuple[pd.DataFrame, List[EnrichRequestItem], Dict[int, str]]:
+    # Eager variant for the synchronous endpoint, which needs every row for its merge anyway.
+    # prepare_chunk can renumber a chunk's ids (by row key) before its items are built.
+    # Returns every row, the valid ones as items and the validation errors of the rest by id
+    columns_to_keep, row_key = validate_csv_upload(csv_path, row_key)
+    df_chunks = list(iter_csv_chunks(csv_path, columns_to_keep, row_keys=RowKeys(row_key, columns_to_keep)))
+
+    items_for_processing = []
+    rejected_rows = {}
+    for df_chunk in df_chunks:
+        if prepare_chunk is not None:
+            prepare_chunk(df_chunk)
+        items, rejected = items_from_chunk(df_chunk)
+        items_for_processing.extend(items)
+        rejected_rows.update(rejected)
+    if not items_for_processing:
+        first_error = next(iter(rejected_rows.values()), "no rows")
+        raise HTTPException(status_code=422, detail=f"Data validation error in CSV rows, none of them is valid: {first_error}")
+    df_filtered = pd.concat(df_chunks, ignore_index=True)
+    return df_filtered, items_for_processing, rejected_rows
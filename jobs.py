@@ -0,0 +1,159 @@
+from typing import Optional, Dict, Any, Callable, Awaitable
+from collections import OrderedDict
+from loguru import logger
+from metrics import RunSummary
+import asyncio
+import uuid
+import time
+import os
+'''
+In-process background jobs for long enrichment runs.
+
+POST endpoints submit a job and return its id right away, a small pool of workers runs
+the jobs one by one and GET /jobs/{id} reads the progress counters below. Streamed runs
+have a client waiting on the rows, so they start right away instead of queueing.
+'''
+
+# Jobs running at the same time. They all share the same GPU, so keep this small
+MAX_CONCURRENT_JOBS = int(os.getenv("ENRICH_MAX_CONCURRENT_JOBS", "1"))
+# Finished jobs kept around for polling before the oldest ones are forgotten
+MAX_FINISHED_JOBS = int(os.getenv("ENRICH_MAX_FINISHED_JOBS", "100"))
+
+
+class EnrichmentJob:
+    def __init__(self, total_rows: int, dataset_id: Optional[str] = None):
+        self.job_id = uuid.uuid4().hex
+        # Results table the job writes to, a new dataset per upload unless told otherwise
+        self.dataset_id = dataset_id or self.job_id
+        self.status = "queued" # queued -> running -> completed / failed
+        self.total_rows = total_rows
+        self.rows_done = 0
+        self.failures = 0
+        # Rows an incremental re-upload kept from the previous run instead of enriching again
+        self.rows_reused = 0
+        # Rows that weren't valid input, stored as failed without an LLM call
+        self.rows_rejected = 0
+        self.error: Optional[str] = None
+        self.stats: Dict[str, Any] = {}
+        # Stage timings of this job's run, live while it is running
+        self.timings: Optional[RunSummary] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def record_result(self, result):
+        self.rows_done += 1
+        if not isinstance(result, dict):
+            self.failures += 1
+
+    def record_reused(self, count: int):
+        self.rows_done += count
+        self.rows_reused += count
+
+    def record_rejected(self, count: int):
+        self.rows_done += count
+        self.failures += count
+        self.rows_rejected += count
+
+    def progress(self) -> Dict[str, Any]:
+        rows_per_sec = 0.0
+        eta_seconds = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            if elapsed > 0:
+                rows_per_sec = self.rows_done / elapsed
+            if rows_per_sec > 0 and self.status == "running":
+                eta_seconds = round((self.total_rows - self.rows_done) / rows_per_sec, 1)
+
+        return {
+            "job_id": self.job_id,
+            "dataset_id": self.dataset_id,
+            "status": self.status,
+            "total_rows": self.total_rows,
+            "rows_done": self.rows_done,
+            "failures": self.failures,
+            "rows_reused": self.rows_reused,
+            "rows_rejected": self.rows_rejected,
+            "rows_per_sec": round(rows_per_sec, 2),
+            "eta_seconds": eta_seconds,
+            "error": self.error,
+            "stats": self.stats,
+            "timings": self.timings.as_dict() if self.timings is not None else {},
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers: int = MAX_CONCURRENT_JOBS):
+        self.max_workers = max_workers
+        self.jobs: "OrderedDict[str, EnrichmentJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        # Jobs started with run_now, outside the queue
+        self._direct_runs = set()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+
+    async def stop(self):
+        tasks = self._workers + list(self._direct_runs)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, job: EnrichmentJob, run: Callable[[EnrichmentJob], Awaitable[None]]) -> EnrichmentJob:
+        self.jobs[job.job_id] = job
+        self._forget_finished_jobs()
+        self._queue.put_nowait((job, run))
+        logger.info(f"Queued job {job.job_id} with {job.total_rows} rows")
+        return job
+
+    def run_now(self, job: EnrichmentJob, run: Callable[[EnrichmentJob], Awaitable[None]]) -> EnrichmentJob:
+        # Skips the queue, for runs with a client waiting on them. LLM calls still go through the
+        # shared concurrency limiter, so this shares the GPU with the queued jobs instead of adding load
+        self.jobs[job.job_id] = job
+        self._forget_finished_jobs()
+        task = asyncio.create_task(self._run(job, run))
+        self._direct_runs.add(task)
+        task.add_done_callback(self._direct_runs.discard)
+        logger.info(f"Started job {job.job_id} with {job.total_rows} rows outside the queue")
+        return job
+
+    def get(self, job_id: str) -> Optional[EnrichmentJob]:
+        return self.jobs.get(job_id)
+
+    def status_counts(self) -> Dict[str, int]:
+        counts = {"queued": 0, "running": 0, "completed": 0, "failed": 0}
+        for job in self.jobs.values():
+            counts[job.status] += 1
+        return counts
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ("completed", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    async def _run(self, job: EnrichmentJob, run: Callable[[EnrichmentJob], Awaitable[None]]):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            await run(job)
+            job.status = "completed"
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+
+    async def _worker(self):
+        while True:
+            job, run = await self._queue.get()
+            try:
+                await self._run(job, run)
+            finally:
+                self._queue.task_done()
+
+
+job_manager = JobManager()
@@ -0,0 +1,236 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any
+from loguru import logger
+from backends import MAX_CONCURRENCY, MAX_CONCURRENCY_LIMIT
+from metrics import LLM_CONCURRENCY_LIMIT, LLM_OVERLOADS
+import asyncio
+import httpx
+import math
+import re
+import time
+import os
+'''
+Adaptive limit on LLM requests in flight.
+
+How many parallel requests a server handles well depends on the GPU, the model, the KV cache
+settings and how long the outputs of the current schema are, so instead of a hand-tuned
+constant the limit is learned from the backend's latency, like Netflix's concurrency-limits:
+    gradient  (default) compares recent latency with the unloaded baseline. Grows while they
+              match, shrinks in proportion once requests start queueing
+    aimd      +1 per round of successful requests, x0.9 when latency passes the baseline tolerance
+    fixed     stays at OLLAMA_NUM_PARALLEL, the old behaviour
+Both adaptive ones start at ENRICH_INITIAL_CONCURRENCY and double until latency starts to rise.
+Timeouts, 5xx/429 responses and out of memory errors always cut the limit. Latency is measured
+per generated token when the backend reports eval_count, so a schema with longer outputs isn't
+mistaken for an overloaded server.
+'''
+
+LIMITER_ALGORITHM = os.getenv("ENRICH_CONCURRENCY_LIMITER", "gradient")
+MIN_CONCURRENCY = int(os.getenv("ENRICH_MIN_CONCURRENCY", "1"))
+# Adaptive limiters start low to measure unloaded latency first, then ramp up (see slow start below)
+INITIAL_CONCURRENCY = int(os.getenv("ENRICH_INITIAL_CONCURRENCY", "4"))
+# How much slower than the baseline recent requests may get before the limit comes down
+LATENCY_TOLERANCE = float(os.getenv("ENRICH_LATENCY_TOLERANCE", "1.5"))
+# Multiplier applied on overload errors (and in aimd on high latency)
+BACKOFF_RATIO = float(os.getenv("ENRICH_BACKOFF_RATIO", "0.9"))
+OVERLOAD_BACKOFF_RATIO = float(os.getenv("ENRICH_OVERLOAD_BACKOFF_RATIO", "0.75"))
+
+# Error text ollama/llama.cpp/vLLM use when the model or KV cache doesn't fit in VRAM
+OOM_MARKERS = ("out of memory", "oom", "cuda error", "insufficient memory", "failed to allocate")
+# Whole words only, a bare "oom" would also match "room", "zoom" or "bloom" in unrelated errors
+OOM_PATTERN = re.compile(r"\b(?:" + "|".join(re.escape(marker) for marker in OOM_MARKERS) + r")\b")
+
+
+def is_overload_error(error: BaseException) -> bool:
+    # Errors that mean "too much load", as opposed to a bad request or an unparseable answer
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, httpx.TimeoutException, httpx.RemoteProtocolError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    if isinstance(status_code, int) and (status_code >= 500 or status_code == 429):
+        return True
+    return OOM_PATTERN.search(str(error).lower()) is not None
+
+
+class LimiterSample:
+    # Filled in by the caller while it holds a slot, read back when the slot is released
+    def __init__(self):
+        self.started = time.monotonic()
+        self.output_tokens: Optional[int] = None
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, algorithm: str = LIMITER_ALGORITHM, initial_limit: Optional[int] = None,
+                 min_limit: int = MIN_CONCURRENCY, max_limit: int = MAX_CONCURRENCY_LIMIT,
+                 tolerance: float = LATENCY_TOLERANCE):
+        if algorithm not in ("gradient", "aimd", "fixed"):
+            raise ValueError(f"Unknown ENRICH_CONCURRENCY_LIMITER {algorithm!r}, use gradient, aimd or fixed")
+        self.algorithm = algorithm
+        if initial_limit is None:
+            initial_limit = MAX_CONCURRENCY if algorithm == "fixed" else INITIAL_CONCURRENCY
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit if algorithm != "fixed" else initial_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self._waiters: deque = deque()
+
+        # Latency baseline (slow EMA) and the current window of samples
+        self.baseline: Optional[float] = None
+        self._window_total = 0.0
+        self._window_count = 0
+        self._window_peak_in_flight = 0
+        # Requests started before the last cut don't cut again, one overload burst = one decrease
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self.overloads = 0
+        LLM_CONCURRENCY_LIMIT.set(self.current_limit)
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        sample = LimiterSample()
+        try:
+            yield sample
+        except asyncio.CancelledError:
+            self._release()
+            raise
+        except Exception as e:
+            self._release()
+            if is_overload_error(e):
+                self._on_overload(sample, e)
+            raise
+        else:
+            self._release()
+            self._on_success(sample)
+
+    async def _acquire(self):
+        while self.in_flight >= self.current_limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self.in_flight += 1
+        self._window_peak_in_flight = max(self._window_peak_in_flight, self.in_flight)
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free_slots = self.current_limit - self.in_flight
+        while free_slots > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
+
+    def _set_limit(self, limit: float):
+        previous = self.current_limit
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        if self.current_limit != previous:
+            LLM_CONCURRENCY_LIMIT.set(self.current_limit)
+            logger.debug(f"LLM concurrency limit {previous} -> {self.current_limit}")
+        # A higher limit lets queued requests through right away
+        self._wake_waiters()
+
+    def _on_overload(self, sample: LimiterSample, error: BaseException):
+        self.overloads += 1
+        LLM_OVERLOADS.inc()
+        self._slow_start = False
+        if self.algorithm == "fixed" or sample.started < self._last_decrease or self.current_limit <= self.min_limit:
+            return
+        self._last_decrease = time.monotonic()
+        logger.warning(f"Backend overloaded ({type(error).__name__}: {str(error)[:120]}), lowering concurrency from {self.current_limit}")
+        self._set_limit(self.limit * OVERLOAD_BACKOFF_RATIO)
+
+    def _on_success(self, sample: LimiterSample):
+        if self.algorithm == "fixed":
+            return
+        latency = time.monotonic() - sample.started
+        # Seconds per generated token evens out short and long outputs of the same schema
+        if sample.output_tokens:
+            latency /= sample.output_tokens
+
+        self._window_total += latency
+        self._window_count += 1
+        # Update once per round of requests (about half the limit), not on every response
+        if self._window_count < max(10, self.current_limit // 2):
+            return
+
+        window_latency = self._window_total / self._window_count
+        saturated = self._window_peak_in_flight >= self.current_limit / 2
+        self._window_total = 0.0
+        self._window_count = 0
+        self._window_peak_in_flight = self.in_flight
+
+        # Baseline = latency when nothing queues in front of a request. It follows lower windows
+        # quickly (but not all the way, one lucky window shouldn't set it) and creeps up very
+        # slowly, so a different model or schema eventually gets a fresh baseline
+        if self.baseline is None:
+            self.baseline = window_latency
+        elif window_latency < self.baseline:
+            self.baseline += (window_latency - self.baseline) * 0.25
+        else:
+            self.baseline += (window_latency - self.baseline) * 0.001
+        latency_rising = window_latency > self.baseline * self.tolerance
+        if latency_rising:
+            self._slow_start = False
+
+        if self._slow_start:
+            # Like TCP slow start: double while latency stays flat, so a big GPU is found in a few rounds
+            if saturated:
+                self._set_limit(self.limit * 2)
+        elif self.algorithm == "aimd":
+            if latency_rising and sample.started >= self._last_decrease:
+                self._last_decrease = time.monotonic()
+                self._set_limit(self.limit * BACKOFF_RATIO)
+            elif not latency_rising and saturated:
+                self._set_limit(self.limit + 1)
+        else:
+            # Gradient2: <1 when latency rises above the baseline, then the limit shrinks with it.
+            # sqrt(limit) of headroom keeps a small queue so the server never idles between requests
+            gradient = max(0.5, min(1.0, self.tolerance * self.baseline / window_latency))
+            new_limit = self.limit * gradient + math.sqrt(self.limit)
+            if gradient >= 1.0 and not saturated:
+                # Not using the slots we already have, growing wouldn't tell us anything
+                new_limit = self.limit
+            self._set_limit(self.limit * 0.8 + new_limit * 0.2)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "algorithm": self.algorithm,
+            "limit": self.current_limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "overloads": self.overloads,
+            "baseline_latency": self.baseline,
+        }
+
+
+_limiter: Optional[AdaptiveConcurrencyLimiter] = None
+
+
+def get_limiter() -> AdaptiveConcurrencyLimiter:
+    # One limiter per process: every job and request shares the same server, so they share its limit
+    global _limiter
+    if _limiter is None:
+        _limiter = AdaptiveConcurrencyLimiter()
+    return _limiter
+
+
+def set_limiter(limiter: AdaptiveConcurrencyLimiter) -> Optional[AdaptiveConcurrencyLimiter]:
+    # For benchmarks comparing algorithms. Returns the previous one
+    global _limiter
+    previous, _limiter = _limiter, limiter
+    return previous
@@ -1,12 +1,27 @@
 # Middleware
-from fastapi import FastAPI, HTTPException, File, UploadFile, Body, Form
-from fastapi.responses import Response
+from fastapi import FastAPI, HTTPException, File, UploadFile, Body, Form, Query, Request
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel, Field, create_model
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Callable, Awaitable, Any, Tuple
+from contextlib import asynccontextmanager, contextmanager
 
 
 # Backend
-from processor import EnrichRequestItem, process_data_api_concurrently_async
+from processor import EnrichRequestItem, LLMCallFailed, process_data_api_concurrently_async, process_data_deduplicated_async, llm_usage_totals, result_row, row_fingerprint
+from backends import init_backend, close_backend, get_backend
+from limiter import get_limiter
+from cache import get_result_cache, close_result_cache, make_cache_key
+from schemas import schema_registry
+from metrics import registry as metrics_registry, run_summary, timed, JOBS, CACHE_LOOKUPS
+from jobs import EnrichmentJob, job_manager
+from storage import (bulk_update_rows, configure_sqlite, create_results_table, insert_rows, results_table_columns,
+                     results_table_name, ensure_datasets_table, register_dataset, get_dataset, list_datasets,
+                     query_rows, RowQueryError, apply_row_deltas, fetch_rows_by_id, table_columns, ROW_STATUS_COLUMNS,
+                     FINGERPRINT_COLUMN, HIDDEN_COLUMNS, ROW_KEY_COLUMN, archive_results_table, restore_results_table,
+                     drop_results_table, fetch_rows_by_key, reusable_result, max_row_id)
+from export import EXPORT_FORMATS, ExportUnavailable, iter_export, table_has_rows
+from ingest import (spool_upload_to_disk, remove_spooled_upload, validate_csv_upload, estimate_csv_rows, iter_csv_chunks,
+                    items_from_chunk, parse_csv_upload, RowKeys)
 from a2wsgi import WSGIMiddleware
 from sqlalchemy import create_engine, text
 
@@ -15,7 +30,10 @@ from pathlib import Path
 from loguru import logger
 import pandas as pd
 import numpy as np
-import io 
+import itertools
+import asyncio
+import json
+import uuid
 import os
 
 # Dash
@@ -92,12 +110,24 @@ else:
 
 OUTPUT_DIR = BASE_DIR / "data"
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled inference backend (ENRICH_BACKEND) for the lifetime of the server, shared by every endpoint
+    init_backend()
+    ensure_datasets_table(db_engine)
+    await job_manager.start()
+    yield
+    await job_manager.stop()
+    await close_backend()
+    close_result_cache()
+
+app = FastAPI(lifespan=lifespan)
 
 dash_app_instance = create_app_dash()
 
 app.mount("/dash/", WSGIMiddleware(dash_app_instance.server))
 db_engine = create_engine(os.getenv("DATABASE_URL", "sqlite:///./.database.db"))
+configure_sqlite(db_engine)
 
 
 # Produced for user. Increased tokens used by a lot
@@ -120,16 +150,20 @@ class SchemaPayload(BaseModel):
     fields: List[CustomField]
 
 
-@app.post("/enrich-products", summary="Enrich a list of product items")
-async def upload_and_enrich_csv_endpoint(file: UploadFile = File(...), schema_config_str: str = Form(...)):
-
-    logger.info("Receiving post from Dash inside fastapi")
-
+def build_output_schema(schema_config_str: str):
     try:
         schema_data = SchemaPayload.model_validate_json(schema_config_str)
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Invalid JSON format for schema_config: {str(e)}")
-    
+    if schema_data.mode not in ('defaults', 'custom'):
+        raise HTTPException(status_code=400, detail="Invalid schema mode provided.")
+
+    # Compiled once per distinct payload (model, JSON schema, system prompt), then reused from the registry.
+    # Keyed on the parsed payload so formatting differences in the JSON string don't matter
+    return schema_registry.get_or_compile(make_cache_key(schema_data.model_dump()), lambda: build_output_model(schema_data))
+
+
+def build_output_model(schema_data: SchemaPayload):
     # --- LOGIC TO DETERMINE THE PYDANTIC MODEL DYNAMICALLY ---
     if schema_data.mode == 'defaults':
         output_schema = DefaultProductAttributes # Use your hardcoded default
@@ -142,119 +176,496 @@ async def upload_and_enrich_csv_endpoint(file: UploadFile = File(...), schema_co
             fields_dict[field.name] = (Optional[str], Field(description=field.description))
 
         output_schema = create_model('DynamicProductAttributes', **fields_dict)
-    else:
-        raise HTTPException(status_code=400, detail="Invalid schema mode provided.")
 
-    content = await file.read()
-    try:
-        df_original = pd.read_csv(io.StringIO(content.decode('utf-8')), engine='python', on_bad_lines='skip') 
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error parsing CSV: {str(e)}")
+    return output_schema
+
+
+def create_dataset(dataset_id: str, schema_config_str: str, input_columns: List[str], output_schema) -> str:
+    # Registers the dataset and creates its own results table, other datasets are never touched
+    dataset = register_dataset(db_engine, dataset_id, schema_config_str)
+    create_results_table(db_engine, input_columns, output_schema.model, dataset['table_name'])
+    return dataset['table_name']
 
-    if df_original.empty:
-        raise HTTPException(status_code=400, detail="CSV file is empty.")
-    
 
-    expected_fields = set(EnrichRequestItem.model_fields.keys())
-    csv_columns = set(df_original.columns)
-    valid_columns_to_keep = list(expected_fields.intersection(csv_columns))
-    REQUIRED_FIELD = "product_name" 
-    if REQUIRED_FIELD not in valid_columns_to_keep:
-        raise HTTPException(status_code=400, detail=f"CSV must contain the required column: '{REQUIRED_FIELD}'.")
-    df_filtered = df_original[valid_columns_to_keep]
+def write_dataset(dataset_id: str, schema_config_str: str, input_columns: List[str], output_schema, rows: List[dict]):
+    # (Re)creates the dataset with all its rows at once, what the synchronous endpoint does at the end
+    table_name = create_dataset(dataset_id, schema_config_str, input_columns, output_schema)
+    insert_rows(db_engine, rows, results_table_columns(input_columns, output_schema.model), job_id=dataset_id, table_name=table_name)
 
-    df_filtered = df_filtered.replace({np.nan: None}) 
 
-    df_filtered['id'] = range(1, len(df_filtered) + 1)
+DATASET_ID_FORM_DESCRIPTION = "Existing dataset to re-enrich: only new or changed rows are sent to the LLM. A new id creates the dataset."
+ROW_KEY_FORM_DESCRIPTION = "Natural key of the rows: a CSV column (e.g. sku), 'hash' of the product fields, 'position' or 'auto' (default)."
+
+
+def start_dataset(dataset_id: str, schema_config_str: str, input_columns: List[str], output_schema,
+                  previous_dataset: Optional[Dict[str, Any]]):
+    # A new dataset gets its table now, so the grid can poll it right away. An existing one keeps
+    # showing its current rows until the incremental job swaps the table when it starts
+    if previous_dataset is None:
+        create_dataset(dataset_id, schema_config_str, input_columns, output_schema)
+    else:
+        register_dataset(db_engine, dataset_id, schema_config_str)
+
+
+# Datasets an upload has claimed but not handed to the job manager yet (still spooling, or a
+# synchronous run). Queued and running jobs are found through the job manager
+claimed_datasets = set()
+
+
+def find_dataset_for_upload(dataset_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    # Uploading into an existing dataset re-enriches it incrementally, an unknown id starts a new dataset under that id
+    if dataset_id is None:
+        return None
     try:
-        items_for_processing = [EnrichRequestItem(**row) for row in df_filtered.to_dict(orient='records')]
-    except Exception as e:
-         raise HTTPException(status_code=422, detail=f"Data validation error in CSV rows: {str(e)}")
+        results_table_name(dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if dataset_id in claimed_datasets or any(
+            job.dataset_id == dataset_id and job.status in ("queued", "running") for job in job_manager.jobs.values()):
+        raise HTTPException(status_code=409, detail=f"Dataset {dataset_id} is already being enriched.")
+    return get_dataset(db_engine, dataset_id)
+
+
+@contextmanager
+def claim_dataset(dataset_id: Optional[str]):
+    # Other uploads into the dataset get a 409 while the claim is held: for the whole of a synchronous
+    # run, or until a job is submitted (the queued job blocks them from then on). Taken right after
+    # find_dataset_for_upload with no await in between, so nothing can slip in
+    if dataset_id is not None:
+        claimed_datasets.add(dataset_id)
+    try:
+        yield
+    finally:
+        claimed_datasets.discard(dataset_id)
 
-    enriched_results = await process_data_api_concurrently_async(items_for_processing, output_schema)
 
+async def spool_job_upload(file: UploadFile, row_key: Optional[str]) -> Tuple[str, List[str], str, int]:
+    # Spools and checks an upload for a job: (csv path, columns to keep, row key, estimated rows)
+    csv_path = await spool_upload_to_disk(file)
+    try:
+        columns_to_keep, row_key = validate_csv_upload(csv_path, row_key)
+        total_rows = await asyncio.to_thread(estimate_csv_rows, csv_path)
+    except BaseException:
+        remove_spooled_upload(csv_path)
+        raise
+    return csv_path, columns_to_keep, row_key, total_rows
 
 
+def output_column_names(output_schema) -> List[str]:
+    # Columns an enrichment run writes: the schema's fields and the row status
+    return [column for column in output_schema.model.model_fields if column != 'id'] + list(ROW_STATUS_COLUMNS)
 
-    df_enriched = pd.DataFrame(enriched_results)
 
-    df_original_and_enriched = pd.merge(df_filtered, df_enriched, left_on='id', right_on='id', how='left')
+class RowIdAssigner:
+    """
+    Numbers an upload's rows by their row key: a key the dataset already had keeps its id, new keys
+    are numbered after the highest previous id, so ids mean the same row across uploads.
+    Called once per CSV chunk, returns the previous run's rows of the chunk by id.
+    """
+    def __init__(self, previous_table: Optional[str], output_columns: List[str]):
+        self.previous_table = previous_table
+        self.output_columns = output_columns
+        self._next_ids = itertools.count(max_row_id(db_engine, previous_table) + 1 if previous_table else 1)
+
+    def __call__(self, df_chunk: pd.DataFrame) -> Dict[int, Dict[str, Any]]:
+        row_keys = list(df_chunk[ROW_KEY_COLUMN])
+        previous_rows = {}
+        if self.previous_table is not None:
+            previous_rows = fetch_rows_by_key(db_engine, self.previous_table, row_keys, self.output_columns)
+        df_chunk['id'] = [previous_rows[key]['id'] if key in previous_rows else next(self._next_ids) for key in row_keys]
+        return {row['id']: row for row in previous_rows.values()}
+
+
+def address_rows_by_key(table_name: str, rows: List[dict]) -> List[dict]:
+    # Rows can be addressed by row_key instead of id (e.g. by a system that only knows the sku).
+    # The key itself is never written back, it can't be edited
+    keyed_rows = [row for row in rows if row.get('id') is None and row.get(ROW_KEY_COLUMN) is not None]
+    if keyed_rows:
+        stored = fetch_rows_by_key(db_engine, table_name, [str(row[ROW_KEY_COLUMN]) for row in keyed_rows])
+        for row in keyed_rows:
+            if str(row[ROW_KEY_COLUMN]) in stored:
+                row['id'] = stored[str(row[ROW_KEY_COLUMN])]['id']
+    return [{column: value for column, value in row.items() if column != ROW_KEY_COLUMN} for row in rows]
+
+
+def resolve_dataset(dataset_id: Optional[str]) -> Dict[str, Any]:
+    # Endpoints are scoped to a dataset, falling back to the latest one for older clients
+    try:
+        dataset = get_dataset(db_engine, dataset_id)
+    except Exception as e:
+        logger.error(f"Dataset lookup failed: {e}")
+        raise HTTPException(status_code=500, detail="Failed to look up dataset.")
+    if dataset is None:
+        raise HTTPException(status_code=404, detail=f"Dataset {dataset_id or '(latest)'} not found.")
+    return dataset
 
-    logger.info(f"DEBUG: Processed {len(df_original_and_enriched)} items.") 
 
-    # In case user had some "bad" rows, replace NaNs introduced by the LEFT MERGE w/ NONE
-    df_original_and_enriched = df_original_and_enriched.replace({np.nan: None})
+@app.post("/enrich-products", summary="Enrich a list of product items")
+async def upload_and_enrich_csv_endpoint(response: Response, file: UploadFile = File(...), schema_config_str: str = Form(...),
+                                         dataset_id: Optional[str] = Form(None, description=DATASET_ID_FORM_DESCRIPTION),
+                                         row_key: Optional[str] = Form(None, description=ROW_KEY_FORM_DESCRIPTION)):
 
+    logger.info("Receiving post from Dash inside fastapi")
 
-    # Write the DataFrame to the SQLite database
-    df_original_and_enriched.to_sql(
-        name="enrichment_results", 
-        con=db_engine, 
-        if_exists='replace',
-        index=False
+    output_schema = build_output_schema(schema_config_str)
+    output_columns = output_column_names(output_schema)
+    previous_dataset = find_dataset_for_upload(dataset_id)
+
+    with claim_dataset(dataset_id), run_summary() as timings:
+        csv_path = await spool_upload_to_disk(file)
+        previous_rows = {}
+        try:
+            # Parsing and the previous rows' lookups hit the disk, kept off the event loop
+            assign_ids = await asyncio.to_thread(RowIdAssigner, previous_dataset['table_name'] if previous_dataset else None, output_columns)
+            df_filtered, items_for_processing, rejected_rows = await asyncio.to_thread(
+                parse_csv_upload, csv_path, row_key, lambda df_chunk: previous_rows.update(assign_ids(df_chunk))
+            )
+        finally:
+            remove_spooled_upload(csv_path)
+
+        # Rows that are unchanged since the dataset's last run keep their stored (possibly hand-edited) results
+        fingerprints = {item.id: row_fingerprint(item, output_schema) for item in items_for_processing}
+        reused_rows = {}
+        for item in items_for_processing:
+            reused_row = reusable_result(previous_rows.get(item.id), fingerprints[item.id], output_columns)
+            if reused_row is not None:
+                reused_rows[item.id] = reused_row
+        items_to_enrich = [item for item in items_for_processing if item.id not in reused_rows]
+
+        # Duplicate rows are only sent to the model once and fanned back out by id
+        enriched_results, dedup_stats = await process_data_deduplicated_async(items_to_enrich, output_schema)
+        enriched_rows = {item.id: result_row(item.id, result) for item, result in zip(items_to_enrich, enriched_results)}
+
+        # Failed rows still get a row, with their enrich_status / enrich_error filled in. So do the
+        # rows that weren't valid input, they never reached the model
+        df_enriched = pd.DataFrame([
+            {**(reused_rows.get(item.id) or enriched_rows[item.id]), 'id': item.id, FINGERPRINT_COLUMN: fingerprints[item.id]}
+            for item in items_for_processing
+        ] + [LLMCallFailed(error, 0, row_id).as_row() for row_id, error in rejected_rows.items()])
+
+        with timed("merge"):
+            df_original_and_enriched = pd.merge(df_filtered, df_enriched, left_on='id', right_on='id', how='left')
+
+        logger.info(f"Processed {len(df_original_and_enriched)} items.") 
+
+        # In case user had some "bad" rows, replace NaNs introduced by the LEFT MERGE w/ NONE
+        df_original_and_enriched = df_original_and_enriched.replace({np.nan: None})
+
+
+        # Write the rows to this upload's own results table with batched inserts
+        rows_to_write = df_original_and_enriched.to_dict(orient='records')
+        dataset_id = dataset_id or uuid.uuid4().hex
+        await asyncio.to_thread(write_dataset, dataset_id, schema_config_str, list(df_filtered.columns), output_schema, rows_to_write)
+
+    # The body stays a plain list of rows for the Dash grid, so the dedup stats travel as headers
+    response.headers["X-Total-Items"] = str(dedup_stats["total_items"])
+    response.headers["X-Unique-Items"] = str(dedup_stats["unique_items"])
+    response.headers["X-Dedup-Ratio"] = str(dedup_stats["dedup_ratio"])
+    response.headers["X-Reused-Items"] = str(len(reused_rows))
+    response.headers["X-Dataset-Id"] = dataset_id
+    # Per-stage seconds for this request, same stage names as /metrics
+    response.headers["X-Stage-Timings"] = json.dumps(
+        {stage: summary["total_seconds"] for stage, summary in timings.as_dict().items()}, separators=(',', ':')
     )
 
     # --- For API functionality: Return the data ---
-    return df_original_and_enriched.to_dict(orient='records')
+    return [{column: value for column, value in row.items() if column != FINGERPRINT_COLUMN} for row in rows_to_write]
+
+
+
+# How often a running job writes its finished rows to the database
+JOB_FLUSH_INTERVAL_SECONDS = float(os.getenv("ENRICH_JOB_FLUSH_INTERVAL_SECONDS", "1.0"))
+# Finished rows a streaming client can fall behind by before the workers wait for it
+STREAM_QUEUE_ROWS = int(os.getenv("ENRICH_STREAM_QUEUE_ROWS", "1000"))
+# How long a stream sits without rows before checking whether the client is still there
+STREAM_DISCONNECT_CHECK_SECONDS = float(os.getenv("ENRICH_STREAM_DISCONNECT_CHECK_SECONDS", "1.0"))
+# The event loop only keeps weak references to tasks, fire-and-forget ones are held here until done
+background_tasks = set()
+
+
+async def run_enrichment_job(job: EnrichmentJob, csv_path: str, columns_to_keep: List[str], output_schema,
+                             row_listener: Optional[Callable[[EnrichRequestItem, Any, str], Awaitable[None]]] = None,
+                             previous_dataset: Optional[Dict[str, Any]] = None, row_key: str = 'auto'):
+    # previous_dataset is the registry entry of the dataset being re-enriched, None for a new one
+
+    output_columns = output_column_names(output_schema)
+    table_name = results_table_name(job.dataset_id)
+    table_columns = results_table_columns(columns_to_keep, output_schema.model)
+    pending_rows: List[dict] = []
+    in_flight_items: Dict[int, Tuple[EnrichRequestItem, str]] = {}
+    processing_done = asyncio.Event()
+
+    previous_table = None
+
+    def prepare_chunk(chunks, assign_ids: RowIdAssigner):
+        # Runs in a worker thread: parses the next CSV chunk, numbers and fingerprints its rows, seeds
+        # it into the table (output columns still NULL) and copies over unchanged rows. None at the end
+        df_chunk = next(chunks, None)
+        if df_chunk is None:
+            return None
+        previous_rows = assign_ids(df_chunk)
+        row_keys = dict(zip(df_chunk['id'], df_chunk[ROW_KEY_COLUMN]))
+        items, rejected_rows = items_from_chunk(df_chunk)
+        fingerprints = {item.id: row_fingerprint(item, output_schema) for item in items}
+        records = df_chunk.to_dict(orient='records')
+        for record in records:
+            record[FINGERPRINT_COLUMN] = fingerprints.get(record['id'])
+            # Invalid rows are stored as failed right away, they never reach the model
+            if record['id'] in rejected_rows:
+                record.update(LLMCallFailed(rejected_rows[record['id']], 0, record['id']).as_row())
+        insert_rows(db_engine, records, table_columns, job_id=job.job_id, table_name=table_name)
+
+        # Unchanged rows get their previous results right away and never reach the scheduler
+        reused_rows = {}
+        for item in items:
+            reused_row = reusable_result(previous_rows.get(item.id), fingerprints[item.id], output_columns)
+            if reused_row is not None:
+                reused_rows[item.id] = reused_row
+        if reused_rows:
+            bulk_update_rows(db_engine, [{**row, 'id': row_id} for row_id, row in reused_rows.items()], output_columns, table_name)
+        return items, row_keys, reused_rows, len(rejected_rows)
+
+    async def iter_items():
+        # Pulled lazily by the scheduler. The next chunk is prepared in a thread while the rows of this
+        # one are handed out, so CSV parsing and DB writes never hold up the event loop
+        position = 0
+        chunks = iter_csv_chunks(csv_path, columns_to_keep, row_keys=RowKeys(row_key, columns_to_keep))
+        assign_ids = await asyncio.to_thread(RowIdAssigner, previous_table, output_columns)
+        next_chunk = asyncio.ensure_future(asyncio.to_thread(prepare_chunk, chunks, assign_ids))
+        try:
+            while (prepared := await next_chunk) is not None:
+                next_chunk = asyncio.ensure_future(asyncio.to_thread(prepare_chunk, chunks, assign_ids))
+                items, row_keys, reused_rows, rejected_count = prepared
+                job.record_reused(len(reused_rows))
+                job.record_rejected(rejected_count)
+
+                for item in items:
+                    if item.id in reused_rows:
+                        if row_listener is not None:
+                            await row_listener(item, reused_rows[item.id], row_keys[item.id])
+                        continue
+                    if row_listener is not None:
+                        in_flight_items[position] = (item, row_keys[item.id])
+                    position += 1
+                    yield item
+        finally:
+            # Stopped early (failed or cancelled job): the thread can't be interrupted, let it finish
+            # before the table is restored or dropped under it
+            await asyncio.gather(next_chunk, return_exceptions=True)
+
+    async def on_result(position: int, result):
+        job.record_result(result)
+        # Failures are written too, as their status and error
+        pending_rows.append(result if isinstance(result, dict) else result.as_row())
+        if row_listener is not None:
+            item, item_row_key = in_flight_items.pop(position)
+            await row_listener(item, result, item_row_key)
+
+    async def flush_pending_rows():
+        nonlocal pending_rows
+        if pending_rows and output_columns:
+            rows, pending_rows = pending_rows, []
+            await asyncio.to_thread(bulk_update_rows, db_engine, rows, output_columns, table_name)
+
+    async def periodic_flush():
+        while not processing_done.is_set():
+            try:
+                await asyncio.wait_for(processing_done.wait(), timeout=JOB_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            await flush_pending_rows()
 
+    try:
+        if previous_dataset is not None:
+            # Re-enriching an existing dataset: its current rows move aside and are read back while the new table fills
+            previous_table = await asyncio.to_thread(archive_results_table, db_engine, table_name)
+            await asyncio.to_thread(create_results_table, db_engine, columns_to_keep, output_schema.model, table_name)
+
+        with run_summary() as job.timings:
+            flusher = asyncio.create_task(periodic_flush())
+            try:
+                _, dedup_stats = await process_data_deduplicated_async(iter_items(), output_schema, on_result=on_result)
+                job.stats.update(dedup_stats)
+                job.stats["reused_items"] = job.rows_reused
+                # The row count was an estimate until the whole file was read
+                job.total_rows = dedup_stats["total_items"] + job.rows_reused + job.rows_rejected
+            finally:
+                processing_done.set()
+                await flusher
+                remove_spooled_upload(csv_path)
+    except BaseException:
+        # Keep the dataset as it was rather than half re-enriched, rows and the schema they were enriched with
+        if previous_table is not None:
+            await asyncio.to_thread(restore_results_table, db_engine, table_name, previous_table)
+        if previous_dataset is not None:
+            await asyncio.to_thread(register_dataset, db_engine, job.dataset_id, previous_dataset['schema_config'],
+                                    previous_dataset['created_at'])
+        raise
+    if previous_table is not None:
+        await asyncio.to_thread(drop_results_table, db_engine, previous_table)
+
+    logger.info(f"Job {job.job_id}: processed {job.rows_done} items ({job.rows_reused} unchanged) with {job.failures} failures.")
+
+
+@app.post("/jobs/enrich-products", summary="Queue a background enrichment job and return its id")
+async def submit_enrichment_job(file: UploadFile = File(...), schema_config_str: str = Form(...),
+                                dataset_id: Optional[str] = Form(None, description=DATASET_ID_FORM_DESCRIPTION),
+                                row_key: Optional[str] = Form(None, description=ROW_KEY_FORM_DESCRIPTION)):
+
+    output_schema = build_output_schema(schema_config_str)
+    previous_dataset = find_dataset_for_upload(dataset_id)
+
+    with claim_dataset(dataset_id):
+        csv_path, columns_to_keep, row_key, total_rows = await spool_job_upload(file, row_key)
+        job = EnrichmentJob(total_rows=total_rows, dataset_id=dataset_id)
+        start_dataset(job.dataset_id, schema_config_str, columns_to_keep, output_schema, previous_dataset)
+        job_manager.submit(job, lambda job: run_enrichment_job(job, csv_path, columns_to_keep, output_schema,
+                                                               previous_dataset=previous_dataset, row_key=row_key))
+    return job.progress()
+
+
+@app.post("/enrich-products/stream", summary="Enrich a CSV and stream every row back as soon as it is done")
+async def stream_enrichment_endpoint(request: Request, file: UploadFile = File(...), schema_config_str: str = Form(...),
+                                     dataset_id: Optional[str] = Form(None, description=DATASET_ID_FORM_DESCRIPTION),
+                                     row_key: Optional[str] = Form(None, description=ROW_KEY_FORM_DESCRIPTION),
+                                     format: str = Query("ndjson", description="'ndjson' or 'sse'")):
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=422, detail="format must be 'ndjson' or 'sse'.")
+
+    output_schema = build_output_schema(schema_config_str)
+
+    # Runs as a job, so results are still written to the DB and progress shows on /jobs/{id}, but it starts
+    # right away instead of waiting behind queued jobs, the client is already waiting for rows.
+    # Rows are handed over through a bounded queue: a slow client slows the workers down instead of
+    # rows piling up in memory. Once the client is gone the job carries on for the DB only
+    row_queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_ROWS)
+    stream_detached = asyncio.Event()
+    output_columns = output_column_names(output_schema)
+
+    async def forward_row(item: EnrichRequestItem, result, item_row_key: str):
+        if not stream_detached.is_set():
+            await row_queue.put((item, result, item_row_key))
+
+    async def run_and_signal_end(job: EnrichmentJob):
+        try:
+            await run_enrichment_job(job, csv_path, columns_to_keep, output_schema, forward_row,
+                                     previous_dataset=previous_dataset, row_key=row_key)
+        finally:
+            await row_queue.put(None)
+
+    async def drain_detached_stream():
+        # Unblocks rows that were already waiting for the client, up to the end marker
+        while await row_queue.get() is not None:
+            pass
+
+    previous_dataset = find_dataset_for_upload(dataset_id)
+    with claim_dataset(dataset_id):
+        csv_path, columns_to_keep, row_key, total_rows = await spool_job_upload(file, row_key)
+        job = EnrichmentJob(total_rows=total_rows, dataset_id=dataset_id)
+        start_dataset(job.dataset_id, schema_config_str, columns_to_keep, output_schema, previous_dataset)
+        job_manager.run_now(job, run_and_signal_end)
+
+    def format_event(event: str, payload: dict) -> str:
+        if format == "sse":
+            return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+        return json.dumps(payload, default=str) + "\n"
+
+    async def stream_rows():
+        finished = False
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(row_queue.get(), timeout=STREAM_DISCONNECT_CHECK_SECONDS)
+                except asyncio.TimeoutError:
+                    # Nothing written for a while, so a dropped connection wouldn't show up as a failed send
+                    if await request.is_disconnected():
+                        logger.info(f"Stream client of job {job.job_id} disconnected, the job continues without it")
+                        return
+                    continue
+                if message is None:
+                    finished = True
+                    break
+                item, result, item_row_key = message
+                row = {**item.model_dump(), **{column: None for column in output_columns}}
+                row.update(result_row(item.id, result))
+                row['id'] = item.id
+                row[ROW_KEY_COLUMN] = item_row_key
+                yield format_event("row", row)
+        finally:
+            # Disconnected (or the send failed): stop forwarding and keep the job from blocking on the queue
+            if not finished:
+                stream_detached.set()
+                drain_task = asyncio.create_task(drain_detached_stream())
+                background_tasks.add(drain_task)
+                drain_task.add_done_callback(background_tasks.discard)
+
+        # Closes with the job summary, so clients can tell a finished (or failed) run from a dropped connection.
+        # NDJSON rows have no event name, the summary line is marked with "event": "done"
+        if format == "sse":
+            yield format_event("done", job.progress())
+        else:
+            yield format_event("done", {"event": "done", **job.progress()})
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_rows(), media_type=media_type, headers={"X-Job-Id": job.job_id, "X-Dataset-Id": job.dataset_id})
+
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job.progress()
 
 
 @app.get("/download-results")
-def download_results_csv():
+def download_results_csv(dataset_id: Optional[str] = None,
+                         format: str = Query("csv", description="'csv', 'csv.gz', 'parquet' or 'arrow'")):
 
     if db_engine is None:
         logger.error("Database engine not initialized.")
         return {"error": "Server configuration error."}
-    
-    df_final = pd.read_sql_table(
-        con=db_engine,
-        table_name="enrichment_results"
-    )
-    
-    if df_final.empty:
+
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format {format!r}, use one of {list(EXPORT_FORMATS)}.")
+
+    dataset = resolve_dataset(dataset_id)
+    if not table_has_rows(db_engine, dataset['table_name']):
         return {"error": "No data found in the database to download."}
 
-    csv_string = df_final.to_csv(index=False, encoding='utf-8')
+    # Streamed batch by batch from a DB cursor, the sync generator runs in the threadpool
+    try:
+        content = iter_export(db_engine, dataset['table_name'], format)
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
 
+    extension, media_type = EXPORT_FORMATS[format]
     # Some browsers need this to retain this specific file name
     headers = {
-        "Content-Disposition": "attachment; filename=enrichment_results.csv"
+        "Content-Disposition": f"attachment; filename=enrichment_results.{extension}"
     }
 
-    return Response(
-        content=csv_string,
-        media_type="text/csv",
+    return StreamingResponse(
+        content,
+        media_type=media_type,
         headers=headers
     )
 
 
 @app.put("/update-row")
-def update_row_in_db(row_data: dict):
-    # 'row_data' should contain the ID of the row and the changed column/value
-    row_id = row_data.get('id') 
-
-    # Add a check for the identifier key
-    if not row_id:
-        raise HTTPException(status_code=422, detail="Missing 'id' identifier key in request body.")
-
-    engine = db_engine
+def update_row_in_db(row_data: dict, dataset_id: Optional[str] = None):
+    # 'row_data' should contain the ID (or the row_key) of the row and the changed column/value
+    if row_data.get('id') is None and row_data.get(ROW_KEY_COLUMN) is None:
+        raise HTTPException(status_code=422, detail="Missing 'id' or 'row_key' identifier key in request body.")
+
+    dataset = resolve_dataset(dataset_id)
+    row_data = address_rows_by_key(dataset['table_name'], [row_data])[0]
+    row_id = row_data.get('id')
+    if row_id is None:
+        raise HTTPException(status_code=404, detail="No row with that row_key.")
     logger.info(f"hitting the update row endpoint! product name: {row_id}")
     try:
-        with engine.connect() as connection:
-            # Build the SET clause of the SQL query dynamically
-            set_clauses = []
-            parameters = {'id': row_id}            
-            for column_name, value in row_data.items():
-                if column_name != 'id':
-                    set_clauses.append(f"{column_name} = :{column_name}")
-                    parameters[column_name] = value
-            
-            # Construct the final query string
-            query_sql = f"UPDATE enrichment_results SET {', '.join(set_clauses)} WHERE id = :id"
-
-            # Execute the query
-            connection.execute(text(query_sql), parameters)
-            connection.commit()
+        bulk_update_rows(db_engine, [row_data], list(row_data.keys()), dataset['table_name'])
 
         return {"status": "success", "message": f"Row {row_id} updated."}
     except Exception as e:
@@ -262,9 +673,14 @@ def update_row_in_db(row_data: dict):
 
 
 @app.post("/resynthesize-batch")
-async def resynthesize_batch_rows(rows_data: list[dict] = Body(...)):
+async def resynthesize_batch_rows(rows_data: list[dict] = Body(...), dataset_id: Optional[str] = None):
     if not rows_data:
         raise HTTPException(status_code=422, detail="No rows provided for batch processing.")
+
+    # Re-run with the same schema the dataset was enriched with
+    dataset = resolve_dataset(dataset_id)
+    output_schema = build_output_schema(dataset['schema_config'])
+    rows_data = address_rows_by_key(dataset['table_name'], rows_data)
     
     # 1. Convert incoming list of dicts to Pydantic models (EnrichRequestItem needs the 'id' field)
     try:
@@ -273,7 +689,9 @@ async def resynthesize_batch_rows(rows_data: list[dict] = Body(...)):
          raise HTTPException(status_code=422, detail=f"Data validation error in batch rows: {str(e)}")
 
     # 2. Await the asynchronous processing (this is the long-running step)
-    enriched_results = await process_data_api_concurrently_async(items_for_processing)
+    # The rows are asked for again on purpose, a cached answer would just put the old output back
+    enriched_results = await process_data_api_concurrently_async(items_for_processing, output_schema, use_cache=False)
+    enriched_results = [result_row(item.id, result) for item, result in zip(items_for_processing, enriched_results)]
 
     # 3. Process the results into DataFrames
     df_filtered = pd.DataFrame(rows_data) # Original data with IDs
@@ -282,13 +700,14 @@ async def resynthesize_batch_rows(rows_data: list[dict] = Body(...)):
     # >>> FIX: Use the 'suffixes' parameter in merge <<<
     # We keep the enriched data (_y) which contains the new synthesis results
     # and drop the original data (_x) columns.
-    df_updated_rows = pd.merge(
-        df_filtered, 
-        df_enriched, 
-        on='id', 
-        how='left', 
-        suffixes=('_original', '_new') # Use clear suffixes first
-    )
+    with timed("merge"):
+        df_updated_rows = pd.merge(
+            df_filtered, 
+            df_enriched, 
+            on='id', 
+            how='left', 
+            suffixes=('_original', '_new') # Use clear suffixes first
+        )
 
     # Drop old column, replace with new, then drop the suffix
     # We must explicitly drop the old columns that have the suffix
@@ -303,57 +722,109 @@ async def resynthesize_batch_rows(rows_data: list[dict] = Body(...)):
     df_updated_rows = df_updated_rows.replace({np.nan: None})
 
     # 5. Update the Database
-    # This is slightly tricky, you need to merge these updated rows back into your main DB table.
-    # The simplest method is a series of UPDATE commands for each row ID.
-    engine = db_engine # Get your DB engine
+    # One prepared UPDATE over the union of columns, executed for all rows in a single transaction
+    rows_to_write = df_updated_rows.to_dict(orient='records')
+    # Datasets enriched before the row status columns existed don't have them
+    known_columns = set(table_columns(db_engine, dataset['table_name']))
     try:
-        with engine.connect() as connection:
-            for index, row_series in df_updated_rows.iterrows():
-                # Convert the row Series to a dictionary for easier access
-                row_data = row_series.to_dict()
-                
-                row_id = row_data.get('id')
-                if not row_id:
-                    logger.warning(f"Skipping row {index}: Missing ID.")
-                    continue # Skip this row if ID is missing
-
-                # Build the SQL UPDATE query dynamically for this specific row
-                set_clauses = []
-                parameters = {'id': row_id}            
-                
-                for column_name, value in row_data.items():
-                    if column_name != 'id':
-                        set_clauses.append(f"{column_name} = :{column_name}")
-                        parameters[column_name] = value
-
-                if set_clauses:
-                    query_sql = text(f"UPDATE enrichment_results SET {', '.join(set_clauses)} WHERE id = :id")
-                    # Execute the update for this specific row
-                    connection.execute(query_sql, parameters)
-                
-            # >>> COMMIT THE CHANGES AFTER THE LOOP FINISHES <<<
-            connection.commit()
-            logger.info(f"Batch update committed successfully for {len(df_updated_rows)} rows.")
-
+        rows_written = bulk_update_rows(db_engine, rows_to_write, [column for column in df_updated_rows.columns if column in known_columns], dataset['table_name'])
+        logger.info(f"Batch update committed successfully for {rows_written} rows.")
     except Exception as e:
         logger.error(f"Batch DB update failed: {e}")
-        # Rollback the transaction in case of error
-        # connection.rollback() 
         raise HTTPException(status_code=500, detail="Failed to update database with batch results.")
 
     # >>> Return statement must be outside the try/except block and use the final data <<<
-    return df_updated_rows.to_dict(orient='records')
+    return rows_to_write
 
 
 @app.get("/get-all-data-json")
-def get_all_data_from_db():
+def get_all_data_from_db(dataset_id: Optional[str] = None):
     logger.info("Fetching all data from database for UI refresh.")
+    dataset = resolve_dataset(dataset_id)
     try:
         df_all_data = pd.read_sql_table(
             con=db_engine,
-            table_name="enrichment_results"
-        )
+            table_name=dataset['table_name']
+        ).drop(columns=list(HIDDEN_COLUMNS), errors='ignore')
+        # Rows still waiting on a running job have NULL outputs, which pandas reads back as NaN
+        df_all_data = df_all_data.replace({np.nan: None})
         return df_all_data.to_dict(orient='records')
     except Exception as e:
         logger.error(f"Error fetching all data from DB: {e}")
-        raise HTTPException(status_code=500, detail="Failed to retrieve data for UI refresh.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to retrieve data for UI refresh.")
+
+
+# Upper bound on one page, the grid asks for page_size rows at a time
+ROWS_MAX_LIMIT = int(os.getenv("ROWS_MAX_LIMIT", "1000"))
+
+
+@app.get("/rows", summary="One page of a dataset's rows, sorted and filtered in SQL")
+def get_rows_page(dataset_id: Optional[str] = None, offset: int = Query(0, ge=0),
+                  limit: int = Query(20, ge=1), sort: List[str] = Query([]), filter: Optional[str] = None):
+    # sort is repeatable: sort=-quality_score&sort=product_name. filter uses the DataTable filter_query syntax
+    dataset = resolve_dataset(dataset_id)
+    limit = min(limit, ROWS_MAX_LIMIT)
+    try:
+        page = query_rows(db_engine, dataset['table_name'], offset=offset, limit=limit, sort=sort, filter_query=filter)
+    except RowQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error fetching rows page from DB: {e}")
+        raise HTTPException(status_code=500, detail="Failed to retrieve rows.")
+    return {"offset": offset, "limit": limit, **page}
+
+
+@app.patch("/rows", summary="Apply cell-level edits and return only the rows they changed")
+def patch_rows(deltas: list[dict] = Body(...), dataset_id: Optional[str] = None):
+    # Each delta is the row id (or row_key) plus only the cells that were edited, e.g. {"id": 3, "insight": "..."}.
+    # The grid coalesces a burst of edits into one call and patches the returned rows in place
+    if not deltas:
+        raise HTTPException(status_code=422, detail="No row edits provided.")
+    if any(delta.get('id') is None and delta.get(ROW_KEY_COLUMN) is None for delta in deltas):
+        raise HTTPException(status_code=422, detail="Missing 'id' or 'row_key' identifier key in row edit.")
+
+    dataset = resolve_dataset(dataset_id)
+    # Edits for keys the dataset doesn't have are dropped, like edits for unknown ids
+    deltas = address_rows_by_key(dataset['table_name'], deltas)
+    editable_columns = set(table_columns(db_engine, dataset['table_name'])) - {'id', ROW_KEY_COLUMN, *HIDDEN_COLUMNS}
+    unknown_columns = {column for delta in deltas for column in delta if column != 'id'} - editable_columns
+    if unknown_columns:
+        raise HTTPException(status_code=400, detail=f"Unknown or read-only columns: {sorted(unknown_columns)}")
+
+    try:
+        updated_ids = apply_row_deltas(db_engine, deltas, dataset['table_name'])
+        return {"rows": fetch_rows_by_id(db_engine, dataset['table_name'], sorted(set(updated_ids)))}
+    except Exception as e:
+        logger.error(f"Row edit failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Database update failed: {str(e)}")
+
+
+@app.get("/datasets")
+def get_datasets():
+    return list_datasets(db_engine)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus text format metrics")
+def get_metrics():
+    # Point-in-time values are refreshed on scrape, everything else is updated on the hot path
+    for status, count in job_manager.status_counts().items():
+        JOBS.set(count, status=status)
+    cache = get_result_cache()
+    if cache is not None:
+        CACHE_LOOKUPS.set(cache.hits, result="hit")
+        CACHE_LOOKUPS.set(cache.misses, result="miss")
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache-stats")
+def get_cache_stats():
+    cache = get_result_cache()
+    if cache is None:
+        return {"enabled": False, "schema_registry": schema_registry.stats(), "llm_usage": llm_usage_totals.as_dict()}
+    return {"enabled": True, **cache.stats(), "schema_registry": schema_registry.stats(), "llm_usage": llm_usage_totals.as_dict()}
+
+
+@app.get("/backend-stats")
+def get_backend_stats():
+    # Inference backend with per-endpoint load and throughput when several are pooled, plus the concurrency limiter
+    return {**get_backend().stats(), "concurrency": get_limiter().stats()}
@@ -0,0 +1,218 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, Tuple, List
+import threading
+import time
+'''
+In-process metrics for the enrichment hot path, rendered in the Prometheus text format on /metrics.
+
+Stage timings go to a process-wide histogram and, when a run is being summarized, to that run's
+RunSummary as well (jobs attach it to their stats). The run is found through a context variable,
+so code deep in the pipeline doesn't need it passed in; asyncio tasks and to_thread inherit it.
+'''
+
+# Stage durations range from sub-millisecond (validation) to minutes (a slow generation)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _label_string(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{_label_string(self.label_names, key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+        # labels -> (per-bucket counts, sum, count)
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._series.items():
+                cumulative = 0
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    bucket_labels = _label_string(self.label_names, key, 'le="' + str(upper_bound) + '"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                bucket_labels = _label_string(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                lines.append(f"{self.name}_sum{_label_string(self.label_names, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_label_string(self.label_names, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "enrich_stage_seconds", "Time spent per pipeline stage (csv_parse, item_build, llm_wait, validation, merge, db_write).", ("stage",)))
+LLM_IN_FLIGHT = registry.register(Gauge(
+    "enrich_llm_in_flight", "LLM requests currently waiting on the backend."))
+LLM_CONCURRENCY_LIMIT = registry.register(Gauge(
+    "enrich_llm_concurrency_limit", "Current adaptive limit on LLM requests in flight."))
+LLM_OVERLOADS = registry.register(Counter(
+    "enrich_llm_overloads_total", "LLM calls that failed with a timeout, 5xx/429 or out of memory error."))
+LLM_REQUESTS = registry.register(Counter(
+    "enrich_llm_requests_total", "LLM requests by outcome (ok, repaired, error, invalid).", ("mode", "outcome")))
+LLM_RETRIES = registry.register(Counter(
+    "enrich_llm_retries_total", "LLM calls that were a retry of a failed or invalid one.", ("mode",)))
+VALIDATION_FAILURES = registry.register(Counter(
+    "enrich_validation_failures_total", "LLM outputs (or packed elements) that failed schema validation.", ("mode",)))
+LLM_TOKENS = registry.register(Counter(
+    "enrich_llm_tokens_total", "Tokens reported by the backend, prompt = evaluated prompt tokens, eval = generated tokens.", ("kind",)))
+LLM_TOKEN_SECONDS = registry.register(Counter(
+    "enrich_llm_token_seconds_total", "Backend-reported time spent on prompt evaluation and generation.", ("kind",)))
+ROWS_PROCESSED = registry.register(Counter(
+    "enrich_rows_total", "Rows finished by enrichment runs, by outcome.", ("outcome",)))
+ENDPOINT_REQUESTS = registry.register(Counter(
+    "enrich_endpoint_requests_total", "Requests per inference endpoint of the pool, by outcome.", ("endpoint", "outcome")))
+ENDPOINT_IN_FLIGHT = registry.register(Gauge(
+    "enrich_endpoint_in_flight", "Requests outstanding per inference endpoint.", ("endpoint",)))
+ENDPOINT_TOKENS = registry.register(Counter(
+    "enrich_endpoint_eval_tokens_total", "Generated tokens per inference endpoint.", ("endpoint",)))
+ENDPOINT_UP = registry.register(Gauge(
+    "enrich_endpoint_up", "1 while the endpoint is in rotation, 0 while its circuit breaker is open.", ("endpoint",)))
+JOBS = registry.register(Gauge(
+    "enrich_jobs", "Background jobs known to the job manager, by status.", ("status",)))
+CACHE_LOOKUPS = registry.register(Gauge(
+    "enrich_result_cache_lookups", "Result cache lookups since startup.", ("result",)))
+
+
+class RunSummary:
+    """
+    Per-run totals of the stage timings, attached to a job's stats as 'timings'.
+    """
+    def __init__(self):
+        self.stages: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                stage: {
+                    "count": count,
+                    "total_seconds": round(total, 4),
+                    "avg_ms": round(total / count * 1000, 3) if count else 0.0,
+                    "max_ms": round(longest * 1000, 3),
+                }
+                for stage, (count, total, longest) in self.stages.items()
+            }
+
+
+_current_run: ContextVar[Optional[RunSummary]] = ContextVar("enrich_run_summary", default=None)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    summary = _current_run.get()
+    if summary is not None:
+        summary.observe(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def run_summary():
+    # Everything timed inside (including tasks and threads started from here) lands in this summary
+    summary = RunSummary()
+    token = _current_run.set(summary)
+    try:
+        yield summary
+    finally:
+        _current_run.reset(token)
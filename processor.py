@@ -1,8 +1,19 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
-import ollama
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, List, Dict, Any, Callable, Iterable, AsyncIterator, Tuple, Union
+from collections import OrderedDict
+from contextlib import aclosing
 import asyncio
+import inspect
 from loguru import logger
+from cache import get_result_cache, make_cache_key
+from schemas import CompiledSchema, compile_schema
+from backends import get_backend
+from limiter import get_limiter
+from repair import parse_json_lenient, coerce_to_model
+from budget import TokenBudget, MAX_FIELD_TOKENS, estimate_tokens, trim_to_tokens
+from metrics import timed, LLM_IN_FLIGHT, LLM_REQUESTS, LLM_RETRIES, VALIDATION_FAILURES, LLM_TOKENS, LLM_TOKEN_SECONDS, ROWS_PROCESSED
+import random
+import json
 import os
 '''
 CICD is push to docker, wait for build, terminate pod and spin up for latest image
@@ -19,8 +30,6 @@ Run fastapi local + dash:
 
 '''
 
-
-
 # Received from user. Only product_name is required
 class EnrichRequestItem(BaseModel):
     id: int = Field(description="[INTERNAL] Stable integer ID for database operations.")
@@ -33,93 +42,634 @@ class EnrichRequestItem(BaseModel):
 
 
 
-def build_prompt_key_value(item: EnrichRequestItem):
-    prompt_text = "Analyze the following product data:\n"
+PROMPT_HEADER = "Analyze the following product data:\n"
+PROMPT_FOOTER = "Return a JSON object describing its attributes based on your schema.\n"
+
+# Bounded retries, the per-call timeout is backends.LLM_TIMEOUT_SECONDS. Attempts after the first use a
+# little temperature, at 0 the model would repeat the same invalid answer, and more num_predict when
+# the answer was cut off
+LLM_MAX_RETRIES = int(os.getenv("ENRICH_LLM_RETRIES", "2"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("ENRICH_RETRY_BACKOFF_SECONDS", "0.5"))
+RETRY_MAX_BACKOFF_SECONDS = float(os.getenv("ENRICH_RETRY_MAX_BACKOFF_SECONDS", "8"))
+RETRY_TEMPERATURE = float(os.getenv("ENRICH_RETRY_TEMPERATURE", "0.3"))
+
+
+class LLMCallFailed(Exception):
+    """
+    Returned (not raised) in place of a result dict when a row couldn't be enriched, so it travels
+    the same way as exceptions from gather(return_exceptions=True). Keeps what went wrong for the
+    row's enrich_status / enrich_error columns.
+    """
+    def __init__(self, error: str, attempts: int = 0, item_id: Any = None):
+        super().__init__(error)
+        self.error = error
+        self.attempts = attempts
+        self.item_id = item_id
+
+    @classmethod
+    def from_result(cls, result: Any, item_id: Any) -> "LLMCallFailed":
+        # Also wraps a None or an unexpected exception, every failure ends up with the same fields
+        if isinstance(result, LLMCallFailed):
+            return cls(result.error, result.attempts, item_id)
+        error = describe_error(result) if isinstance(result, BaseException) else "No result"
+        return cls(error, 0, item_id)
+
+    def as_row(self) -> Dict[str, Any]:
+        return {"id": self.item_id, "enrich_status": "failed", "enrich_attempts": self.attempts, "enrich_error": self.error[:500]}
+
+
+def with_status(result: Dict[str, Any], status: str, attempts: int) -> Dict[str, Any]:
+    # Bookkeeping columns of the results table (storage.ROW_STATUS_COLUMNS), never part of the cached result
+    return {**result, "enrich_status": status, "enrich_attempts": attempts, "enrich_error": None}
+
+
+def result_row(item_id: Any, result: Any) -> Dict[str, Any]:
+    # A result dict as it is, any kind of failure as a row that records it
+    if isinstance(result, dict):
+        return result
+    return LLMCallFailed.from_result(result, item_id).as_row()
+
+
+async def retry_delay(attempt: int):
+    # Exponential backoff with full jitter, so rows that failed together don't retry together
+    await asyncio.sleep(random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))))
+
+
+def describe_error(error: BaseException) -> str:
+    # One line per failure for logs and the enrich_error column, pydantic's own message spans several
+    if isinstance(error, ValidationError):
+        details = "; ".join(f"{'.'.join(map(str, detail['loc'])) or 'output'}: {detail['msg']}" for detail in error.errors())
+        return f"ValidationError: {details}"
+    return f"{type(error).__name__}: {' '.join(str(error).split())}"
+
+
+def is_retryable(error: Exception) -> bool:
+    # A 4xx (other than 429) is the request's fault, sending it again won't help
+    status_code = getattr(error, 'status_code', None)
+    return not (isinstance(status_code, int) and 400 <= status_code < 500 and status_code != 429)
+
+
+class LLMUsage:
+    """
+    Token counters from backend responses. prompt_eval_count only counts prompt tokens the server
+    actually evaluated, so when the shared system prompt prefix is served from the KV cache it stays
+    well below estimated_prompt_tokens.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.prompt_eval_count = 0
+        self.prompt_eval_duration_ns = 0
+        self.eval_count = 0
+        self.eval_duration_ns = 0
+        self.estimated_prompt_tokens = 0
+
+    def record(self, response, estimated_prompt_tokens: int):
+        self.calls += 1
+        self.prompt_eval_count += response.get('prompt_eval_count') or 0
+        self.prompt_eval_duration_ns += response.get('prompt_eval_duration') or 0
+        self.eval_count += response.get('eval_count') or 0
+        self.eval_duration_ns += response.get('eval_duration') or 0
+        self.estimated_prompt_tokens += estimated_prompt_tokens
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "prompt_eval_count": self.prompt_eval_count,
+            "prompt_eval_ms": round(self.prompt_eval_duration_ns / 1e6, 1),
+            "avg_prompt_eval_count": round(self.prompt_eval_count / self.calls, 1) if self.calls else 0.0,
+            "estimated_prompt_tokens": self.estimated_prompt_tokens,
+            # Share of the (estimated) prompt that didn't need evaluating, i.e. came from the KV cache
+            "prefix_reuse_estimate": round(max(0.0, 1 - self.prompt_eval_count / self.estimated_prompt_tokens), 4)
+                                     if self.estimated_prompt_tokens else 0.0,
+            "eval_count": self.eval_count,
+            "eval_ms": round(self.eval_duration_ns / 1e6, 1),
+            # Generation throughput as the backend measured it, per parallel slot
+            "eval_tokens_per_sec": round(self.eval_count / (self.eval_duration_ns / 1e9), 1) if self.eval_duration_ns else 0.0,
+        }
+
+
+# Totals since startup, every run also keeps its own LLMUsage
+llm_usage_totals = LLMUsage()
+
+
+def record_llm_usage(response, usage: Optional[LLMUsage], messages: List[Dict[str, str]]):
+    estimated_prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+    llm_usage_totals.record(response, estimated_prompt_tokens)
+    if usage is not None:
+        usage.record(response, estimated_prompt_tokens)
+    LLM_TOKENS.inc(response.get('prompt_eval_count') or 0, kind="prompt")
+    LLM_TOKENS.inc(response.get('eval_count') or 0, kind="eval")
+    LLM_TOKEN_SECONDS.inc((response.get('prompt_eval_duration') or 0) / 1e9, kind="prompt")
+    LLM_TOKEN_SECONDS.inc((response.get('eval_duration') or 0) / 1e9, kind="eval")
+
+
+async def chat_with_metrics(backend, messages: List[Dict[str, str]], json_schema: Dict[str, Any], options: Dict[str, Any]):
+    # Every backend call goes through the adaptive limiter, which learns the right concurrency from
+    # these latencies (timeouts count as overload). The in-flight gauge + llm_wait timing only cover time spent on the backend
+    async with get_limiter().slot() as sample:
+        LLM_IN_FLIGHT.inc()
+        try:
+            with timed("llm_wait"):
+                response = await asyncio.wait_for(backend.chat(messages, json_schema, options), backend.call_timeout)
+        finally:
+            LLM_IN_FLIGHT.dec()
+        sample.output_tokens = response.get('eval_count')
+        return response
+
+
+def build_prompt_key_value(item: EnrichRequestItem, exclude: Optional[set] = None):
+    prompt_text = PROMPT_HEADER
 
-    # Use item.dict(exclude_none=True) to dynamically include only provided fields
-    for key, value in item.model_dump(exclude_none=True).items():
+    # Use item.dict(exclude_none=True) to dynamically include only provided fields.
+    # Oversized values are trimmed so every prompt fits the run's num_ctx (see budget.py)
+    for key, value in item.model_dump(exclude_none=True, exclude=exclude).items():
         if str(value).strip(): 
-            prompt_text += f"   '{key}': '{value}'\n"
+            prompt_text += f"   '{key}': '{trim_to_tokens(str(value))}'\n"
 
-    prompt_text += "Return a JSON object describing its attributes based on your schema.\n"
+    prompt_text += PROMPT_FOOTER
     return prompt_text
 
 
-async def call_llm_api_async(item: EnrichRequestItem, output_schema) -> Optional[Dict[str, Any]]:
-    # ... (imports needed: from pydantic import BaseModel, Field, etc.)
-    client = ollama.AsyncClient(host='http://localhost:11434')
-    prompt = build_prompt_key_value(item)
-    content = ""
+def token_budget(output_schema: CompiledSchema) -> TokenBudget:
+    # Worked out on first use and kept on the compiled schema, so num_ctx is the same for every call of a run
+    if output_schema.budget is None:
+        # Text fields can take up to their trimmed maximum, the integer id only a few tokens
+        input_fields = {name: 8 if name == 'id' else MAX_FIELD_TOKENS for name in EnrichRequestItem.model_fields}
+        output_schema.budget = TokenBudget(output_schema.system_prompt, output_schema.json_schema, input_fields,
+                                           PROMPT_HEADER + PROMPT_FOOTER)
+    return output_schema.budget
 
-    # 2. Embed the schema into your System Prompt
-    system_prompt_content = (
-        'You are a ultra-concise data formatting AI.'
-        'Your ONLY task is to generate a VALID and COMPLETE JSON object'
-        'based on the user request and schema provided. Use only the exact keys from the schema.'
-        'No conversational filler or extra words.'
-        'The "price" field must be a raw number (float/integer format only), with no currency symbols, commas, or words like "USD".'
-        'The insight field must be under 15 words and provide only one key observation'
-        'Always use short, direct language'
-        'Ensure "currency" field is a 3-letter code.'
-        '\n\n### JSON Schema to follow:\n'
-        f'{output_schema.model_json_schema()}'
+
+def result_cache_key(item: EnrichRequestItem, output_schema: CompiledSchema) -> str:
+    # Identical product data + prompt + schema + model always yields the same output (temperature 0).
+    # The positional id is left out of the key and restored on the way out
+    return make_cache_key(
+        build_prompt_key_value(item, exclude={'id'}),
+        output_schema.fingerprint,
+        get_backend().model_key,
     )
 
+
+async def lookup_cached_result(item: EnrichRequestItem, output_schema: CompiledSchema) -> Optional[Dict[str, Any]]:
+    cache = get_result_cache()
+    if cache is None:
+        return None
+    key = result_cache_key(item, output_schema)
+    # Memory hits are answered on the loop, only a lookup that has to go to disk takes a thread
+    cached_product_dict = cache.get_from_memory(key)
+    if cached_product_dict is None:
+        cached_product_dict = await asyncio.to_thread(cache.get, key)
+    if cached_product_dict is None:
+        return None
+    if 'id' in cached_product_dict:
+        cached_product_dict['id'] = item.id
+    return with_status(cached_product_dict, "cached", 0)
+
+
+async def store_cached_result(item: EnrichRequestItem, output_schema: CompiledSchema, validated_product_dict: Dict[str, Any]):
+    cache = get_result_cache()
+    if cache is not None and cache.set(result_cache_key(item, output_schema), validated_product_dict):
+        await asyncio.to_thread(cache.flush)
+
+
+async def flush_result_cache():
+    # End of a run: whatever is still pending goes to disk, so a restart doesn't lose it
+    cache = get_result_cache()
+    if cache is not None:
+        await asyncio.to_thread(cache.flush)
+
+
+def validate_or_repair(content: str, output_schema: CompiledSchema, item_id: Any = None) -> Tuple[Dict[str, Any], str]:
+    # Returns (validated dict, row status): ok, repaired when values were fixed up, or partial when the
+    # answer was cut off and its unfinished fields dropped. The repair step (repair.py) only runs when
+    # the raw answer fails, and if it doesn't help the original validation error is raised
     try:
+        return output_schema.validate_json(content), "ok"
+    except Exception as validation_error:
+        data, truncated = parse_json_lenient(content)
+        if not isinstance(data, dict):
+            raise validation_error
+        data = coerce_to_model(data, output_schema.model)
+        if item_id is not None and 'id' in output_schema.model.model_fields:
+            data['id'] = item_id
+        try:
+            return output_schema.validate(data), "partial" if truncated else "repaired"
+        except Exception:
+            raise validation_error
 
-        if 'APP_ENV' in os.environ and os.environ['APP_ENV'] == 'local':
-            MODEL = "phi3"
-        else:
-            MODEL = "local-phi3-quantized"
-
-        response = await client.chat(
-            model=MODEL,
-            messages=[
-                {'role': 'system', 'content': system_prompt_content}, # Use the new prompt
-                {'role': 'user', 'content': prompt},
-            ],
-            options={
+
+async def call_llm_api_async(item: EnrichRequestItem, output_schema, usage: Optional[LLMUsage] = None,
+                             num_ctx: Optional[int] = None, use_cache: bool = True) -> Union[Dict[str, Any], LLMCallFailed]:
+    # use_cache=False skips the lookup (resynthesis wants a fresh answer), the new result is still cached
+    backend = get_backend()
+    output_schema = compile_schema(output_schema)
+    prompt = build_prompt_key_value(item)
+
+    # Byte-identical for every row of a run (see schemas.py), so the server can reuse its KV cache for it
+    system_prompt_content = output_schema.system_prompt
+
+    cached_product_dict = await lookup_cached_result(item, output_schema) if use_cache else None
+    if cached_product_dict is not None:
+        return cached_product_dict
+
+    messages = [
+        {'role': 'system', 'content': system_prompt_content}, # Use the new prompt
+        {'role': 'user', 'content': prompt},
+    ]
+
+    budget = token_budget(output_schema)
+    num_ctx = num_ctx or budget.num_ctx
+    num_predict = budget.num_predict
+    last_error = ""
+    attempts = 0
+    for attempt in range(1, LLM_MAX_RETRIES + 2):
+        attempts = attempt
+        if attempt > 1:
+            LLM_RETRIES.inc(mode="single")
+            await retry_delay(attempt - 1)
+
+        outcome = "error"
+        content = ""
+        response = {}
+        try:
+            response = await chat_with_metrics(
+                backend,
+                messages,
+                output_schema.json_schema,
+                {
+                    'temperature': 0 if attempt == 1 else RETRY_TEMPERATURE,
+                    # num_ctx stays the same on retries, changing it makes ollama reload the model
+                    'num_ctx': num_ctx,
+                    'num_predict': num_predict
+                },
+            )
+            record_llm_usage(response, usage, messages)
+
+            content = response['content'].strip()
+
+            # Validate the LLM output using Pydantic, repairing it if that's cheap
+            outcome = "invalid"
+            with timed("validation"):
+                validated_product_dict, status = validate_or_repair(content, output_schema, item.id)
+            outcome = "ok" if status == "ok" else "repaired"
+
+            # A cut-off answer is kept for this row but never cached, the next run should get a complete one
+            if status != "partial":
+                await store_cached_result(item, output_schema, validated_product_dict)
+
+            return with_status(validated_product_dict, status, attempt)
+
+        except Exception as e:
+            last_error = describe_error(e)
+            if outcome == "invalid":
+                VALIDATION_FAILURES.inc(mode="single")
+                logger.debug(f"Invalid output for item {item.id}: ---{content}---")
+                # Ran into num_predict, the retry gets more room to finish the JSON (as much as fits in num_ctx)
+                if (response.get('eval_count') or 0) >= num_predict:
+                    num_predict = min(num_predict * 2, budget.max_num_predict(prompt, num_ctx))
+            logger.warning(f"LLM call for item {item.id} failed (attempt {attempt}/{LLM_MAX_RETRIES + 1}): {last_error[:300]}")
+            if not is_retryable(e):
+                break
+        finally:
+            LLM_REQUESTS.inc(mode="single", outcome=outcome)
+
+    return LLMCallFailed(last_error, attempts, item.id)
+
+
+# --- Packed mode: several products per LLM call ---
+# The system prompt and schema are evaluated once per pack instead of once per row.
+# Off by default (pack size 1), turn it on with ENRICH_PACK_SIZE or the pack_size argument
+PACK_SIZE = int(os.getenv("ENRICH_PACK_SIZE", "1"))
+PACKED_NUM_CTX = int(os.getenv("ENRICH_PACKED_NUM_CTX", "4096"))
+# 0 = the schema's own output estimate (budget.py)
+PACKED_OUTPUT_TOKENS_PER_ITEM = int(os.getenv("ENRICH_PACKED_OUTPUT_TOKENS_PER_ITEM", "0"))
+
+
+def packed_output_tokens_per_item(output_schema: CompiledSchema) -> int:
+    return PACKED_OUTPUT_TOKENS_PER_ITEM or token_budget(output_schema).num_predict
+
+
+def build_packed_prompt(items: List[EnrichRequestItem]) -> str:
+    prompt_text = f"Analyze each of the following {len(items)} products separately:\n"
+    for item in items:
+        prompt_text += build_prompt_key_value(item).replace(PROMPT_HEADER, "Product:\n").replace(PROMPT_FOOTER, "")
+    prompt_text += (
+        f'Return a JSON object with an "items" array holding exactly {len(items)} objects, '
+        "one per product, each with the same 'id' as its product.\n"
+    )
+    return prompt_text
+
+
+async def aiter_items(items) -> AsyncIterator[Any]:
+    # Lists and generators, and async generators (a job that reads its CSV off the event loop), look the same downstream
+    if hasattr(items, '__aiter__'):
+        # Closed explicitly so an early stop runs the source's cleanup now, not whenever it is collected
+        async with aclosing(items):
+            async for item in items:
+                yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def iter_packs(indexed_items, output_schema, max_pack_size: int) -> AsyncIterator[Tuple[List[int], List[EnrichRequestItem]]]:
+    # Greedily fill each pack until the context window (prompt + expected output) would overflow.
+    # Works on a lazy stream of (position, item), sync or async, and yields (positions, pack)
+    output_schema = compile_schema(output_schema)
+    context_budget = PACKED_NUM_CTX - estimate_tokens(output_schema.packed.system_prompt)
+    output_tokens_per_item = packed_output_tokens_per_item(output_schema)
+    positions, current_pack, current_tokens = [], [], 0
+    async with aclosing(aiter_items(indexed_items)) as source:
+        async for position, item in source:
+            item_tokens = estimate_tokens(build_prompt_key_value(item)) + output_tokens_per_item
+            if current_pack and (len(current_pack) >= max_pack_size or current_tokens + item_tokens > context_budget):
+                yield positions, current_pack
+                positions, current_pack, current_tokens = [], [], 0
+            positions.append(position)
+            current_pack.append(item)
+            current_tokens += item_tokens
+    if current_pack:
+        yield positions, current_pack
+
+
+async def call_llm_api_packed_async(items: List[EnrichRequestItem], output_schema, usage: Optional[LLMUsage] = None,
+                                    use_cache: bool = True) -> List[Optional[Dict[str, Any]]]:
+    backend = get_backend()
+    output_schema = compile_schema(output_schema)
+    packed_schema = output_schema.packed
+    results: Dict[int, Tuple[Dict[str, Any], str]] = {}
+    content = ""
+
+    messages = [
+        {'role': 'system', 'content': packed_schema.system_prompt},
+        {'role': 'user', 'content': build_packed_prompt(items)},
+    ]
+
+    outcome = "error"
+    try:
+        response = await chat_with_metrics(
+            backend,
+            messages,
+            packed_schema.json_schema,
+            {
                 'temperature': 0,
-                'num_ctx': 1000,
-                'num_predict': 300
+                'num_ctx': PACKED_NUM_CTX,
+                'num_predict': packed_output_tokens_per_item(output_schema) * len(items) + 50
             },
-            format=output_schema.model_json_schema(), 
         )
-  
-        # FIX 4: Access content safely (adjust if SDK structure is different)
-        content = response['message']['content'].strip() 
-
-        # Validate the LLM output using Pydantic
-        validated_product = output_schema.model_validate_json(content)
-        validated_product_dict = validated_product.model_dump()
+        record_llm_usage(response, usage, messages)
+        content = response['content'].strip()
 
-        
-        return validated_product_dict
-    
+        # Validate element by element so one bad object doesn't throw away the whole pack.
+        # A pack cut off by num_predict still yields the objects that were finished
+        outcome = "invalid"
+        with timed("validation"):
+            packed_data, truncated = parse_json_lenient(content)
+            if not isinstance(packed_data, dict):
+                raise ValueError("No JSON object in packed output")
+            elements = packed_data.get('items', [])
+            for index, element in enumerate(elements):
+                try:
+                    validated_product_dict, status = output_schema.validate(element), "ok"
+                except Exception:
+                    try:
+                        validated_product_dict, status = output_schema.validate(coerce_to_model(element, output_schema.model)), "repaired"
+                    except Exception:
+                        VALIDATION_FAILURES.inc(mode="packed")
+                        continue
+                # Only the last object can have been cut off, the ones before it were finished
+                if truncated and index == len(elements) - 1:
+                    status = "partial"
+                results[validated_product_dict.get('id')] = (validated_product_dict, status)
+        outcome = "ok"
     except Exception as e:
-        # Log the problematic content if validation fails for debugging Pydantic errors
-        print(f"Ollama API call failed for item '{validated_product_dict['id']}'. Error: {e}")
-        print(f"Problematic content was: ---{content}---")
-        return None # Or raise the exception if you prefer
-
-
-# Function to chunk a list into smaller batches
-def chunk_list(data_list, batch_size):
-    for i in range(0, len(data_list), batch_size):
-        yield data_list[i:i + batch_size]
-
-async def process_data_api_concurrently_async(all_items: List[EnrichRequestItem], output_schema):
-    
-    # Use a BATCH_SIZE that you know won't crash (e.g., 20 items for A5000)
-    # THIS WILL CHANGE DEPENDING ON PYDANTIC SCHEMA OUTPUT LENGTH
-    BATCH_SIZE = 30
-    all_results = []
-    
-    for batch in chunk_list(all_items, BATCH_SIZE):
-        # Process this small batch
-        tasks = [call_llm_api_async(item, output_schema) for item in batch]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        all_results.extend(results)
-        
-    return all_results
\ No newline at end of file
+        if outcome == "invalid":
+            VALIDATION_FAILURES.inc(mode="packed")
+        logger.warning(f"Packed call for {len(items)} items failed, falling back to single calls. Error: {e}")
+    LLM_REQUESTS.inc(mode="packed", outcome=outcome)
+
+    # Anything missing or invalid is retried with the regular one-item call
+    packed_results = []
+    for item in items:
+        if item.id in results:
+            validated_product_dict, status = results[item.id]
+            if status != "partial":
+                await store_cached_result(item, output_schema, validated_product_dict)
+            packed_results.append(with_status(validated_product_dict, status, 1))
+        else:
+            # Same num_ctx as the packed calls, switching it would make ollama reload the model
+            packed_results.append(await call_llm_api_async(item, output_schema, usage, num_ctx=PACKED_NUM_CTX, use_cache=use_cache))
+    return packed_results
+
+
+async def notify(callback: Callable[..., Any], *args):
+    # Result callbacks can be plain functions or coroutine functions. An async one is awaited by the
+    # worker that produced the result, so a slow consumer holds back new work instead of piling it up
+    outcome = callback(*args)
+    if inspect.isawaitable(outcome):
+        await outcome
+
+
+async def _run_sliding_window(work_items, handler, concurrency: int, on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
+
+    # Sliding window instead of fixed batches: a pool of workers pulls the next item as soon as
+    # its previous request finishes, so one slow generation never stalls the other slots.
+    # With on_result the results are handed over one by one and not kept, so memory stays flat
+    source = aiter_items(work_items)
+    # An async generator can't be advanced by two workers at once
+    source_lock = asyncio.Lock()
+    next_index = 0
+    results = {}
+
+    async def next_work_item() -> Optional[Tuple[int, Any]]:
+        nonlocal next_index
+        async with source_lock:
+            try:
+                work_item = await source.__anext__()
+            except StopAsyncIteration:
+                return None
+            next_index += 1
+            return next_index - 1, work_item
+
+    async def worker():
+        # All workers share the same source, each pull hands out a different item
+        while (entry := await next_work_item()) is not None:
+            index, work_item = entry
+            try:
+                result = await handler(work_item)
+            except Exception as e:
+                # Same contract as asyncio.gather(return_exceptions=True)
+                result = e
+            if on_result is not None:
+                await notify(on_result, index, result)
+            else:
+                results[index] = result
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        # Workers still running after a failure see an exhausted source from here on
+        async with source_lock:
+            await source.aclose()
+
+    if on_result is not None:
+        return None
+
+    # Return results in input order
+    return [results[index] for index in range(len(results))]
+
+
+async def process_data_api_concurrently_async(all_items: Iterable[EnrichRequestItem], output_schema, max_concurrency: Optional[int] = None,
+                                              pack_size: Optional[int] = None, on_result: Optional[Callable[[int, Any], None]] = None,
+                                              usage: Optional[LLMUsage] = None, use_cache: bool = True):
+    # all_items can be a lazy iterator (sync or async), rows are only pulled when a worker has a free slot.
+    # on_result(position, result) fires as soon as each row is done, for progress reporting and streaming.
+    # It can be a coroutine function, see notify(). When it is given results are only delivered through it and None is returned.
+    # use_cache=False always asks the model, fresh results still go into the cache
+
+    # Enough workers for the limiter's ceiling, the limiter decides how many of them actually call the backend
+    concurrency = max_concurrency or get_limiter().max_limit
+    pack_size = pack_size or PACK_SIZE
+    output_schema = compile_schema(output_schema)
+
+    if pack_size <= 1:
+        results = await _run_sliding_window(all_items, lambda item: call_llm_api_async(item, output_schema, usage, use_cache=use_cache), concurrency, on_result)
+        await flush_result_cache()
+        return results
+
+    collected: Dict[int, Any] = {}
+
+    async def deliver(position: int, result):
+        if on_result is not None:
+            await notify(on_result, position, result)
+        else:
+            collected[position] = result
+
+    # Packed mode: serve cache hits directly and only pack the misses
+    async def iter_uncached_items():
+        position = 0
+        async with aclosing(aiter_items(all_items)) as source:
+            async for item in source:
+                position += 1
+                result = await lookup_cached_result(item, output_schema) if use_cache else None
+                if result is None:
+                    yield position - 1, item
+                else:
+                    await deliver(position - 1, result)
+
+    # Remember which original positions every pack covers until its result is in
+    pack_positions: Dict[int, List[int]] = {}
+
+    async def iter_work():
+        pack_index = 0
+        async with aclosing(iter_packs(iter_uncached_items(), output_schema, pack_size)) as packs:
+            async for positions, pack in packs:
+                pack_positions[pack_index] = positions
+                pack_index += 1
+                yield pack
+
+    async def on_pack_result(pack_index: int, results):
+        positions = pack_positions.pop(pack_index)
+        if isinstance(results, Exception):
+            results = [results] * len(positions)
+        # Flatten the pack back onto the positions it came from
+        for position, result in zip(positions, results):
+            await deliver(position, result)
+
+    await _run_sliding_window(iter_work(), lambda pack: call_llm_api_packed_async(pack, output_schema, usage, use_cache), concurrency, on_pack_result)
+    await flush_result_cache()
+
+    if on_result is not None:
+        return None
+    return [collected[position] for position in range(len(collected))]
+
+
+# Finished results kept for duplicates later in the same run
+DEDUP_MEMO_ITEMS = int(os.getenv("ENRICH_DEDUP_MEMO_ITEMS", "10000"))
+
+
+def prompt_fingerprint(item: EnrichRequestItem) -> str:
+    # Rows that would produce the same prompt (ignoring the id) share one fingerprint
+    return make_cache_key(build_prompt_key_value(item, exclude={'id'}))
+
+
+def row_fingerprint(item: EnrichRequestItem, output_schema) -> str:
+    # What an incremental re-upload compares: the row's own fields (untrimmed, id left out) and the
+    # schema it was enriched with. A changed field or a schema edit both mean the row runs again
+    return make_cache_key(item.model_dump(exclude={'id'}), compile_schema(output_schema).fingerprint)
+
+
+async def process_data_deduplicated_async(all_items: Iterable[EnrichRequestItem], output_schema, max_concurrency: Optional[int] = None,
+                                          pack_size: Optional[int] = None, on_result: Optional[Callable[[int, Any], None]] = None):
+
+    # Only the first row of every distinct prompt is sent to the model. Works on a lazy stream:
+    # duplicates that show up while their prompt is in flight wait for it, later ones reuse the finished result
+    output_schema = compile_schema(output_schema)
+    usage = LLMUsage()
+    waiting: Dict[str, List[Tuple[int, Any]]] = {}
+    # Recently finished results by fingerprint, a bounded working set: older duplicates are served
+    # by the result cache (or run again with it off) instead of memory growing with the file
+    finished: "OrderedDict[str, Any]" = OrderedDict()
+    # Unique index -> fingerprint, only while that representative is in flight
+    representative_fingerprints: Dict[int, str] = {}
+    collected: Dict[int, Any] = {}
+    total_items = 0
+    unique_items = 0
+
+    async def deliver(position: int, item_id, result):
+        ROWS_PROCESSED.inc(outcome="ok" if isinstance(result, dict) else "failed")
+        # Fan the shared result out to this row, with its own id. Failures too, so the row can record them
+        if isinstance(result, dict):
+            result = dict(result)
+            if 'id' in result:
+                result['id'] = item_id
+        else:
+            result = LLMCallFailed.from_result(result, item_id)
+        if on_result is not None:
+            await notify(on_result, position, result)
+        else:
+            collected[position] = result
+
+    async def iter_representatives():
+        nonlocal total_items, unique_items
+        async with aclosing(aiter_items(all_items)) as source:
+            async for item in source:
+                position = total_items
+                total_items += 1
+                fingerprint = prompt_fingerprint(item)
+                if fingerprint in finished:
+                    finished.move_to_end(fingerprint)
+                    await deliver(position, item.id, finished[fingerprint])
+                elif fingerprint in waiting:
+                    waiting[fingerprint].append((position, item.id))
+                else:
+                    waiting[fingerprint] = [(position, item.id)]
+                    representative_fingerprints[unique_items] = fingerprint
+                    unique_items += 1
+                    yield item
+
+    async def on_unique_result(unique_index: int, result):
+        fingerprint = representative_fingerprints.pop(unique_index)
+        # Failed rows are not reused, a later duplicate gets its own attempt
+        if isinstance(result, dict):
+            finished[fingerprint] = result
+            if len(finished) > DEDUP_MEMO_ITEMS:
+                finished.popitem(last=False)
+        for position, item_id in waiting.pop(fingerprint):
+            await deliver(position, item_id, result)
+
+    logger.info(f"Token budget for this run: {token_budget(output_schema).as_dict()}")
+    await process_data_api_concurrently_async(iter_representatives(), output_schema, max_concurrency, pack_size, on_unique_result, usage)
+
+    dedup_stats = {
+        "total_items": total_items,
+        "unique_items": unique_items,
+        "dedup_ratio": round(1 - unique_items / total_items, 4) if total_items else 0.0,
+        "llm_usage": usage.as_dict(),
+        "token_budget": token_budget(output_schema).as_dict(),
+    }
+    logger.info(f"Deduplicated {total_items} items down to {unique_items} LLM calls")
+    logger.info(f"LLM usage for this run: {dedup_stats['llm_usage']}")
+
+    all_results = [collected[position] for position in range(len(collected))] if on_result is None else None
+    return all_results, dedup_stats
@@ -0,0 +1,173 @@
+from typing import Optional, Dict, Any, Tuple, Union, get_origin, get_args
+import json
+import re
+'''
+Cheap fixes for LLM output that failed schema validation, tried before paying for a retry.
+
+    truncated JSON   num_predict cut the answer off: open brackets are closed, a dangling key or
+                     half-written value (a string or number that was still being written) is dropped
+    numbers          "$1,299.99 USD" -> 1299.99, "4/5" -> 4, 4.0 -> 4, clamped to ge/le bounds
+    prices           price fields get the bare number, a currency symbol fills an empty currency
+    missing fields   Optional fields the model left out are set to None
+Anything still invalid after this goes back to the model.
+'''
+
+# Symbols seen in prices, mapped to the 3-letter code the system prompt asks for
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY", "₹": "INR", "₩": "KRW", "₽": "RUB", "₺": "TRY"}
+NUMBER_PATTERN = re.compile(r"-?\d[\d,]*(?:\.\d+)?|-?\.\d+")
+# A number the text stops on, possibly mid-way ("4", "-", "1.", "2e-")
+NUMBER_AT_END = re.compile(r"[-\d.]$|\d[eE][-+]?$")
+# How many earlier cut points (commas) to try when closing truncated JSON
+MAX_TRUNCATION_CUTS = 64
+
+
+def _open_containers(text: str) -> Tuple[bool, list]:
+    # Whether the text ends inside a string, and the closers for every still-open object/array
+    closers = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            closers.append('}')
+        elif char == '[':
+            closers.append(']')
+        elif char in '}]' and closers:
+            closers.pop()
+    return in_string, closers
+
+
+def parse_json_lenient(content: str) -> Tuple[Optional[Any], bool]:
+    """
+    Parses the first JSON object in content, closing it if it was cut off.
+    Returns (data, repaired), data is None when nothing usable was found.
+    """
+    start = content.find('{')
+    if start < 0:
+        return None, False
+    # Code fences or chatter around the object are ignored by raw_decode
+    content = content[start:].rstrip()
+    decoder = json.JSONDecoder()
+    try:
+        return decoder.raw_decode(content)[0], False
+    except ValueError:
+        pass
+
+    # Cut back to the end, then to each earlier comma, until closing what's open gives valid JSON
+    cut_points = [len(content)] + [index for index in range(len(content) - 1, 0, -1) if content[index] == ','][:MAX_TRUNCATION_CUTS]
+    for cut in cut_points:
+        candidate = content[:cut].rstrip().rstrip(',')
+        in_string, closers = _open_containers(candidate)
+        # A string that is still open (or a comma inside one) or a number at the very end may be
+        # missing characters, "abc" could have been "abcdef" and 4 could have been 45. Cut further
+        if in_string or (cut == len(content) and NUMBER_AT_END.search(candidate)):
+            continue
+        candidate += ''.join(reversed(closers))
+        try:
+            return decoder.raw_decode(candidate)[0], True
+        except ValueError:
+            continue
+    return None, False
+
+
+def _base_type(annotation) -> Any:
+    # Optional[int] -> int, anything else as is
+    if get_origin(annotation) is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def _is_optional(annotation) -> bool:
+    return get_origin(annotation) is Union and type(None) in get_args(annotation)
+
+
+def _bounds(field) -> Tuple[Optional[float], Optional[float]]:
+    # Field(ge=..., le=...) ends up as annotated_types Ge/Le entries in the metadata
+    lower = upper = None
+    for constraint in field.metadata:
+        if getattr(constraint, 'ge', None) is not None:
+            lower = constraint.ge
+        if getattr(constraint, 'le', None) is not None:
+            upper = constraint.le
+    return lower, upper
+
+
+def parse_number(value: Any) -> Optional[float]:
+    # First number in text like "$1,299.99", "USD 12", "4/5" or "score: 3"
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = NUMBER_PATTERN.search(value)
+        if match:
+            return float(match.group().replace(',', ''))
+    return None
+
+
+def currency_code(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    for symbol, code in CURRENCY_SYMBOLS.items():
+        if symbol in value:
+            return code
+    match = re.search(r"\b([A-Za-z]{3})\b", value)
+    return match.group(1).upper() if match else None
+
+
+def _is_price_field(name: str) -> bool:
+    return name == 'price' or name.endswith('_price')
+
+
+def coerce_to_model(data: Dict[str, Any], model) -> Dict[str, Any]:
+    """
+    Best-effort conversion of an LLM answer towards the model's field types. Values that can't
+    be converted are left alone for validation to reject.
+    """
+    data = dict(data)
+    for name, field in model.model_fields.items():
+        if name not in data:
+            if _is_optional(field.annotation):
+                data[name] = None
+            continue
+
+        value = data[name]
+        target = _base_type(field.annotation)
+        if value is None:
+            continue
+        if _is_price_field(name) and 'currency' in model.model_fields and not data.get('currency'):
+            # Keep the currency the model put into the price, it is stripped from the price below
+            data['currency'] = currency_code(value)
+
+        if target in (int, float):
+            number = parse_number(value)
+            if number is None:
+                continue
+            lower, upper = _bounds(field)
+            if lower is not None:
+                number = max(number, lower)
+            if upper is not None:
+                number = min(number, upper)
+            data[name] = int(round(number)) if target is int else number
+        elif target is str:
+            if _is_price_field(name):
+                # The system prompt wants a raw number, no symbols, commas or words
+                number = parse_number(value)
+                if number is not None:
+                    data[name] = str(int(number)) if number.is_integer() else str(number)
+            elif name == 'currency':
+                data[name] = currency_code(value) or value
+            elif isinstance(value, (dict, list)):
+                data[name] = json.dumps(value)
+            elif not isinstance(value, str):
+                data[name] = str(value)
+    return data
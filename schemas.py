@@ -0,0 +1,102 @@
+from pydantic import create_model
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Callable
+from cache import make_cache_key
+import threading
+import json
+import os
+'''
+Compiled output schemas.
+
+Everything the per-row path needs from an output schema (JSON schema for format=, system prompt,
+cache fingerprint, packed wrapper model) is worked out once per schema instead of once per row.
+Schemas built from a SchemaPayload are kept in a small LRU keyed by a hash of the payload, so
+repeat uploads with the same custom fields reuse the same compiled schema.
+'''
+
+SCHEMA_REGISTRY_SIZE = int(os.getenv("ENRICH_SCHEMA_REGISTRY_SIZE", "128"))
+
+SYSTEM_PROMPT_RULES = (
+    'You are a ultra-concise data formatting AI.'
+    'Your ONLY task is to generate a VALID and COMPLETE JSON object'
+    'based on the user request and schema provided. Use only the exact keys from the schema.'
+    'No conversational filler or extra words.'
+    'The "price" field must be a raw number (float/integer format only), with no currency symbols, commas, or words like "USD".'
+    'The insight field must be under 15 words and provide only one key observation'
+    'Always use short, direct language'
+    'Ensure "currency" field is a 3-letter code.'
+)
+
+
+def build_system_prompt(json_schema: Dict[str, Any]) -> str:
+    # 2. Embed the schema into your System Prompt.
+    # Canonical JSON (sorted keys, no extra whitespace) makes the prompt the exact same bytes for the
+    # same schema in every run and process. Ollama/llama.cpp only reuse a cached prefix on an exact match
+    return (
+        SYSTEM_PROMPT_RULES +
+        '\n\n### JSON Schema to follow:\n' +
+        json.dumps(json_schema, sort_keys=True, separators=(',', ':'))
+    )
+
+
+class CompiledSchema:
+    def __init__(self, model):
+        self.model = model
+        self.json_schema = model.model_json_schema()
+        self.system_prompt = build_system_prompt(self.json_schema)
+        # Identifies the prompt + schema pair in result cache keys
+        self.fingerprint = make_cache_key(self.system_prompt, self.json_schema)
+        self._packed: Optional["CompiledSchema"] = None
+        # TokenBudget (budget.py), set by the processor on first use
+        self.budget = None
+
+    @property
+    def packed(self) -> "CompiledSchema":
+        # Ollama's structured output wants an object at the top level, so the list is wrapped in one
+        if self._packed is None:
+            self._packed = CompiledSchema(create_model(f'Packed{self.model.__name__}', items=(List[self.model], ...)))
+        return self._packed
+
+    def validate_json(self, content: str) -> Dict[str, Any]:
+        return self.model.model_validate_json(content).model_dump()
+
+    def validate(self, data: Any) -> Dict[str, Any]:
+        return self.model.model_validate(data).model_dump()
+
+
+def compile_schema(output_schema) -> CompiledSchema:
+    # Accepts a plain pydantic model too, for scripts and benchmarks. Compile once per run, not per row
+    if isinstance(output_schema, CompiledSchema):
+        return output_schema
+    return CompiledSchema(output_schema)
+
+
+class SchemaRegistry:
+    def __init__(self, max_items: int = SCHEMA_REGISTRY_SIZE):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._schemas: "OrderedDict[str, CompiledSchema]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compile(self, key: str, build_model: Callable[[], Any]) -> CompiledSchema:
+        with self._lock:
+            compiled = self._schemas.get(key)
+            if compiled is not None:
+                self._schemas.move_to_end(key)
+                self.hits += 1
+                return compiled
+
+            self.misses += 1
+            compiled = CompiledSchema(build_model())
+            self._schemas[key] = compiled
+            while len(self._schemas) > self.max_items:
+                self._schemas.popitem(last=False)
+            return compiled
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "schemas": len(self._schemas)}
+
+
+schema_registry = SchemaRegistry()
@@ -0,0 +1,472 @@
+from sqlalchemy import text, event, inspect
+from sqlalchemy.engine import Engine
+from typing import List, Dict, Any, Optional, Tuple, Union, get_origin, get_args
+from metrics import timed
+import time
+import re
+import os
+'''
+Managed schema and set-based writes for the enrichment results.
+
+Every dataset (one upload) gets its own results table, enrichment_results_<dataset_id>, so
+concurrent runs never replace each other's rows. The enrichment_datasets registry remembers
+each dataset's table and the schema config it was enriched with.
+
+Results tables are declared by us instead of pandas' to_sql: `id` is the INTEGER PRIMARY KEY
+(so WHERE id = :id is a rowid lookup), `job_id` is indexed, and output columns are typed from
+the pydantic output schema. Rows go in through batched executemany INSERTs.
+
+Every row has a natural key, row_key (a CSV column like sku, or a hash of the input fields, see
+ingest.py), unique within its table. The integer id stays the rowid the grid and the processor
+work with, but it belongs to the key: re-uploading into a dataset keeps each known key's id.
+
+Re-uploading into an existing dataset is incremental: every row stores a fingerprint of its
+input fields plus the output schema, and finished rows whose key comes back with the same
+fingerprint are copied over from the previous table (manual edits included) instead of being
+sent to the LLM.
+'''
+
+RESULTS_TABLE = "enrichment_results"
+DATASETS_TABLE = "enrichment_datasets"
+DATASET_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+
+# Per-row outcome of the enrichment run, after the output columns: ok / repaired / partial / cached / failed,
+# how many LLM attempts it took and the last error. Failed rows can be found with {enrich_status} = failed.
+# partial means the answer was cut off and its unfinished fields were dropped
+ROW_STATUS_COLUMNS = {"enrich_status": "TEXT", "enrich_attempts": "INTEGER", "enrich_error": "TEXT"}
+# Natural key of the row, what re-uploads and edits can address it by instead of its id
+ROW_KEY_COLUMN = "row_key"
+# Hash of the row's input fields + output schema, what an incremental re-upload compares against
+FINGERPRINT_COLUMN = "input_fingerprint"
+# Bookkeeping columns the grid and the exports never show
+HIDDEN_COLUMNS = ('job_id', FINGERPRINT_COLUMN)
+# Rows in these states are kept by an incremental re-upload, failed, partial or unfinished rows run again
+REUSABLE_STATUSES = ('ok', 'repaired', 'cached')
+# Suffix of the table an incremental run reads the previous rows from
+PREVIOUS_TABLE_SUFFIX = "__previous"
+
+# Dash DataTable filter_query operators -> SQL. Both the symbol and word forms are sent by the grid
+FILTER_OPERATORS = {
+    '=': '=', 'eq': '=', 's=': '=',
+    '!=': '!=', 'ne': '!=', 's!=': '!=',
+    '<': '<', 'lt': '<', 's<': '<',
+    '<=': '<=', 'le': '<=', 's<=': '<=',
+    '>': '>', 'gt': '>', 's>': '>',
+    '>=': '>=', 'ge': '>=', 's>=': '>=',
+}
+FILTER_PART_PATTERN = re.compile(
+    r'^\{(?P<column>[^}]+)\}\s+(?P<operator>is not blank|is blank|contains|datestartswith|s?[!<>]?=|s?[<>]|eq|ne|lt|le|gt|ge)'
+    r'(?:\s+(?P<value>.*))?$'
+)
+
+
+def configure_sqlite(engine: Engine):
+    # WAL lets the grid read while a job writes, NORMAL sync is safe under WAL and much cheaper
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+
+def quote_column(column_name: str) -> str:
+    # Column names can come from user-defined custom fields, so quote them for SQL
+    return '"' + column_name.replace('"', '""') + '"'
+
+
+def results_table_name(dataset_id: str) -> str:
+    # Dataset ids end up in a table name, so only allow a safe character set
+    if not DATASET_ID_PATTERN.match(dataset_id):
+        raise ValueError(f"Invalid dataset id: {dataset_id!r}")
+    return f"{RESULTS_TABLE}_{dataset_id}"
+
+
+def ensure_datasets_table(engine: Engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {DATASETS_TABLE} ("
+            "dataset_id TEXT PRIMARY KEY, table_name TEXT NOT NULL, schema_config TEXT NOT NULL, created_at REAL NOT NULL)"
+        ))
+
+
+def register_dataset(engine: Engine, dataset_id: str, schema_config: str, created_at: Optional[float] = None) -> Dict[str, Any]:
+    # created_at is only passed to put a previous registration back as it was
+    dataset = {
+        "dataset_id": dataset_id,
+        "table_name": results_table_name(dataset_id),
+        "schema_config": schema_config,
+        "created_at": created_at or time.time(),
+    }
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"INSERT OR REPLACE INTO {DATASETS_TABLE} (dataset_id, table_name, schema_config, created_at) "
+            "VALUES (:dataset_id, :table_name, :schema_config, :created_at)"
+        ), dataset)
+    return dataset
+
+
+def get_dataset(engine: Engine, dataset_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Looks up a dataset by id, or the most recently created one when no id is given.
+    """
+    with engine.connect() as connection:
+        if dataset_id is None:
+            row = connection.execute(text(
+                f"SELECT * FROM {DATASETS_TABLE} ORDER BY created_at DESC LIMIT 1"
+            )).mappings().first()
+        else:
+            row = connection.execute(text(
+                f"SELECT * FROM {DATASETS_TABLE} WHERE dataset_id = :dataset_id"
+            ), {"dataset_id": dataset_id}).mappings().first()
+    return dict(row) if row is not None else None
+
+
+def list_datasets(engine: Engine) -> List[Dict[str, Any]]:
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            f"SELECT dataset_id, created_at FROM {DATASETS_TABLE} ORDER BY created_at DESC"
+        )).mappings().all()
+    return [dict(row) for row in rows]
+
+
+def bulk_update_rows(engine: Engine, rows: List[Dict[str, Any]], columns: List[str], table_name: str = RESULTS_TABLE) -> int:
+    """
+    Applies many row updates with one prepared UPDATE over the given columns, executed for
+    every row (executemany) in a single transaction. Rows without an id are skipped.
+    Returns the number of rows sent to the database.
+    """
+    columns = [column for column in columns if column != 'id']
+    rows = [row for row in rows if row.get('id') is not None]
+    if not rows or not columns:
+        return 0
+
+    # Positional bind names, custom column names may contain spaces or quotes
+    set_clause = ', '.join(f"{quote_column(column)} = :c{index}" for index, column in enumerate(columns))
+    parameters = [
+        {'id': row['id'], **{f"c{index}": row.get(column) for index, column in enumerate(columns)}}
+        for row in rows
+    ]
+    with timed("db_write"), engine.begin() as connection:
+        connection.execute(text(f"UPDATE {quote_column(table_name)} SET {set_clause} WHERE id = :id"), parameters)
+    return len(rows)
+
+
+def apply_row_deltas(engine: Engine, deltas: List[Dict[str, Any]], table_name: str = RESULTS_TABLE) -> List[int]:
+    """
+    Applies partial row edits ({'id': 3, 'insight': '...'}), only touching the columns each
+    delta carries. Deltas are grouped by their column set, so every group is one executemany
+    UPDATE, all in a single transaction. Returns the ids that were updated.
+    """
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for delta in deltas:
+        columns = tuple(sorted(column for column in delta if column not in ('id', 'job_id')))
+        if delta.get('id') is not None and columns:
+            groups.setdefault(columns, []).append(delta)
+
+    with timed("db_write"), engine.begin() as connection:
+        for columns, rows in groups.items():
+            set_clause = ', '.join(f"{quote_column(column)} = :c{index}" for index, column in enumerate(columns))
+            parameters = [
+                {'id': row['id'], **{f"c{index}": row[column] for index, column in enumerate(columns)}}
+                for row in rows
+            ]
+            connection.execute(text(f"UPDATE {quote_column(table_name)} SET {set_clause} WHERE id = :id"), parameters)
+    return [row['id'] for rows in groups.values() for row in rows]
+
+
+def fetch_rows_by_id(engine: Engine, table_name: str, row_ids: List[int],
+                     exclude_columns: Tuple[str, ...] = HIDDEN_COLUMNS) -> List[Dict[str, Any]]:
+    if not row_ids:
+        return []
+    columns = [column for column in table_columns(engine, table_name) if column not in exclude_columns]
+    select_list = ', '.join(quote_column(column) for column in columns)
+    placeholders = ', '.join(f":r{index}" for index in range(len(row_ids)))
+    with engine.connect() as connection:
+        rows = connection.execute(
+            text(f"SELECT {select_list} FROM {quote_column(table_name)} WHERE id IN ({placeholders}) ORDER BY id"),
+            {f"r{index}": row_id for index, row_id in enumerate(row_ids)},
+        ).mappings().all()
+    return [dict(row) for row in rows]
+
+
+def sql_type_for(annotation) -> str:
+    # Optional[X] -> X, anything that isn't a plain number ends up as TEXT
+    if get_origin(annotation) is Union:
+        non_null = [arg for arg in get_args(annotation) if arg is not type(None)]
+        annotation = non_null[0] if len(non_null) == 1 else str
+    if annotation in (int, bool):
+        return "INTEGER"
+    if annotation is float:
+        return "REAL"
+    return "TEXT"
+
+
+def results_table_columns(input_columns: List[str], output_schema) -> Dict[str, str]:
+    # The row key, the input columns, then the typed output columns, in the order the grid shows them, then the row status
+    columns = {ROW_KEY_COLUMN: "TEXT NOT NULL"}
+    columns.update({column: "TEXT" for column in input_columns if column not in ('id', ROW_KEY_COLUMN, *HIDDEN_COLUMNS, *ROW_STATUS_COLUMNS)})
+    for name, field in output_schema.model_fields.items():
+        if name != 'id' and name not in columns:
+            columns[name] = sql_type_for(field.annotation)
+    columns.update(ROW_STATUS_COLUMNS)
+    columns[FINGERPRINT_COLUMN] = "TEXT"
+    return columns
+
+
+def create_results_indexes(connection, table_name: str):
+    connection.execute(text(
+        f"CREATE INDEX IF NOT EXISTS {quote_column('idx_' + table_name + '_job_id')} ON {quote_column(table_name)} (job_id)"
+    ))
+    # Tables from before fingerprints were stored don't have the column
+    if FINGERPRINT_COLUMN not in [column['name'] for column in inspect(connection).get_columns(table_name)]:
+        return
+    connection.execute(text(
+        f"CREATE INDEX IF NOT EXISTS {quote_column('idx_' + table_name + '_fingerprint')} "
+        f"ON {quote_column(table_name)} ({quote_column(FINGERPRINT_COLUMN)})"
+    ))
+
+
+def drop_results_indexes(connection, table_name: str):
+    # Indexes keep their name when their table is renamed, so they are dropped and recreated around renames
+    for suffix in ('_job_id', '_fingerprint'):
+        connection.execute(text(f"DROP INDEX IF EXISTS {quote_column('idx_' + table_name + suffix)}"))
+
+
+def create_results_table(engine: Engine, input_columns: List[str], output_schema, table_name: str = RESULTS_TABLE) -> List[str]:
+    """
+    (Re)creates a dataset's results table and returns its data columns.
+    """
+    columns = results_table_columns(input_columns, output_schema)
+    column_definitions = ', '.join(f"{quote_column(column)} {sql_type}" for column, sql_type in columns.items())
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {quote_column(table_name)}"))
+        connection.execute(text(
+            f"CREATE TABLE {quote_column(table_name)} (id INTEGER PRIMARY KEY, job_id TEXT NOT NULL, {column_definitions}, "
+            f"UNIQUE ({quote_column(ROW_KEY_COLUMN)}))"
+        ))
+        create_results_indexes(connection, table_name)
+    return list(columns)
+
+
+def archive_results_table(engine: Engine, table_name: str) -> Optional[str]:
+    """
+    Moves a dataset's results table aside (to <table>__previous) so an incremental run can build
+    the new one next to it. Returns the archived table's name, None if there was no table.
+    """
+    previous_table = table_name + PREVIOUS_TABLE_SUFFIX
+    with engine.begin() as connection:
+        if not inspect(connection).has_table(table_name):
+            return None
+        # Left over from a run that died without cleaning up
+        drop_results_indexes(connection, previous_table)
+        connection.execute(text(f"DROP TABLE IF EXISTS {quote_column(previous_table)}"))
+        drop_results_indexes(connection, table_name)
+        connection.execute(text(f"ALTER TABLE {quote_column(table_name)} RENAME TO {quote_column(previous_table)}"))
+        create_results_indexes(connection, previous_table)
+    return previous_table
+
+
+def restore_results_table(engine: Engine, table_name: str, previous_table: str):
+    # A failed incremental run puts the previous rows back instead of leaving a half-built table
+    with engine.begin() as connection:
+        drop_results_indexes(connection, table_name)
+        connection.execute(text(f"DROP TABLE IF EXISTS {quote_column(table_name)}"))
+        drop_results_indexes(connection, previous_table)
+        connection.execute(text(f"ALTER TABLE {quote_column(previous_table)} RENAME TO {quote_column(table_name)}"))
+        create_results_indexes(connection, table_name)
+
+
+def drop_results_table(engine: Engine, table_name: str):
+    with engine.begin() as connection:
+        drop_results_indexes(connection, table_name)
+        connection.execute(text(f"DROP TABLE IF EXISTS {quote_column(table_name)}"))
+
+
+def fetch_rows_by_key(engine: Engine, table_name: str, row_keys: List[str], columns: Optional[List[str]] = None,
+                      batch_size: int = 500) -> Dict[str, Dict[str, Any]]:
+    """
+    Looks rows up by their natural key. Returns row_key -> the row's id, fingerprint and the
+    given columns, keys that aren't in the table are left out.
+    """
+    stored_columns = table_columns(engine, table_name)
+    if ROW_KEY_COLUMN not in stored_columns or not row_keys:
+        # Tables from before row keys were stored can't be matched, every row counts as new
+        return {}
+    columns = [column for column in columns or [] if column in stored_columns and column not in ('id', ROW_KEY_COLUMN, *HIDDEN_COLUMNS)]
+    if FINGERPRINT_COLUMN in stored_columns:
+        columns.append(FINGERPRINT_COLUMN)
+    select_list = ', '.join(['id', quote_column(ROW_KEY_COLUMN)] + [quote_column(column) for column in columns])
+
+    distinct_keys = list(set(row_keys))
+    rows_by_key = {}
+    with engine.connect() as connection:
+        for start in range(0, len(distinct_keys), batch_size):
+            batch = distinct_keys[start:start + batch_size]
+            placeholders = ', '.join(f":k{index}" for index in range(len(batch)))
+            rows = connection.execute(
+                text(f"SELECT {select_list} FROM {quote_column(table_name)} WHERE {quote_column(ROW_KEY_COLUMN)} IN ({placeholders})"),
+                {f"k{index}": row_key for index, row_key in enumerate(batch)},
+            ).mappings().all()
+            for row in rows:
+                rows_by_key[row[ROW_KEY_COLUMN]] = dict(row)
+    return rows_by_key
+
+
+def reusable_result(previous_row: Optional[Dict[str, Any]], fingerprint: str, columns: List[str]) -> Optional[Dict[str, Any]]:
+    # A finished row whose inputs and schema are unchanged keeps its stored (possibly hand-edited) values
+    if previous_row is None or previous_row.get(FINGERPRINT_COLUMN) != fingerprint:
+        return None
+    if previous_row.get('enrich_status') not in REUSABLE_STATUSES:
+        return None
+    return {column: previous_row.get(column) for column in columns}
+
+
+def max_row_id(engine: Engine, table_name: str) -> int:
+    with engine.connect() as connection:
+        return connection.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {quote_column(table_name)}")).scalar_one()
+
+
+def insert_rows(engine: Engine, rows: List[Dict[str, Any]], columns: List[str], job_id: str, table_name: str = RESULTS_TABLE) -> int:
+    """
+    Inserts rows with one prepared INSERT executed for every row in a single transaction.
+    """
+    if not rows:
+        return 0
+    columns = [column for column in columns if column not in ('id', 'job_id')]
+    column_list = ', '.join(['id', 'job_id'] + [quote_column(column) for column in columns])
+    placeholders = ', '.join([':id', ':job_id'] + [f":c{index}" for index in range(len(columns))])
+    parameters = [
+        {'id': row['id'], 'job_id': job_id, **{f"c{index}": row.get(column) for index, column in enumerate(columns)}}
+        for row in rows
+    ]
+    with timed("db_write"), engine.begin() as connection:
+        connection.execute(text(f"INSERT INTO {quote_column(table_name)} ({column_list}) VALUES ({placeholders})"), parameters)
+    return len(rows)
+
+
+class RowQueryError(ValueError):
+    pass
+
+
+def table_columns(engine: Engine, table_name: str) -> List[str]:
+    return [column['name'] for column in inspect(engine).get_columns(table_name)]
+
+
+def parse_filter_value(raw_value: str):
+    # Quoted values are strings, bare values are numbers when they look like one
+    if len(raw_value) >= 2 and raw_value[0] == raw_value[-1] and raw_value[0] in ('"', "'", '`'):
+        return raw_value[1:-1].replace('\\' + raw_value[0], raw_value[0])
+    try:
+        return int(raw_value)
+    except ValueError:
+        pass
+    try:
+        return float(raw_value)
+    except ValueError:
+        return raw_value
+
+
+def split_filter_query(filter_query: str) -> List[str]:
+    # Splits on ' && ' outside of quoted values, so a value like "salt && pepper" stays one part
+    parts, start, quote = [], 0, None
+    index = 0
+    while index < len(filter_query):
+        char = filter_query[index]
+        if quote is not None:
+            if char == '\\':
+                index += 1
+            elif char == quote:
+                quote = None
+        elif char in ('"', "'", '`') and (index == 0 or filter_query[index - 1] == ' '):
+            # Only a quote that opens a value counts, not the apostrophe in a bare it's
+            quote = char
+        elif filter_query.startswith(' && ', index):
+            parts.append(filter_query[start:index])
+            start = index + len(' && ')
+            index = start
+            continue
+        index += 1
+    parts.append(filter_query[start:])
+    return parts
+
+
+def build_filter_clause(filter_query: str, columns: List[str]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Turns a Dash DataTable filter_query ('{col} contains "x" && {score} > 3') into a WHERE
+    clause with bound parameters. Only columns of the table are accepted.
+    """
+    conditions = []
+    parameters = {}
+    for index, part in enumerate(split_filter_query(filter_query)):
+        part = part.strip()
+        if not part:
+            continue
+        match = FILTER_PART_PATTERN.match(part)
+        if match is None or match.group('column') not in columns:
+            raise RowQueryError(f"Unsupported filter expression: {part!r}")
+
+        column = quote_column(match.group('column'))
+        operator = match.group('operator')
+        if operator == 'is blank':
+            conditions.append(f"({column} IS NULL OR {column} = '')")
+            continue
+        if operator == 'is not blank':
+            conditions.append(f"({column} IS NOT NULL AND {column} != '')")
+            continue
+
+        if match.group('value') is None:
+            raise RowQueryError(f"Missing filter value: {part!r}")
+        parameters[f"f{index}"] = parse_filter_value(match.group('value').strip())
+        if operator == 'contains':
+            # Case-sensitive like the grid's own filtering, and no LIKE wildcards to escape
+            conditions.append(f"instr(CAST({column} AS TEXT), :f{index}) > 0")
+        elif operator == 'datestartswith':
+            conditions.append(f"CAST({column} AS TEXT) LIKE :f{index} || '%'")
+        else:
+            conditions.append(f"{column} {FILTER_OPERATORS[operator]} :f{index}")
+
+    return ' AND '.join(conditions), parameters
+
+
+def build_order_clause(sort: List[str], columns: List[str]) -> str:
+    # 'column' sorts ascending, '-column' descending. id always breaks ties so pages are stable
+    terms = []
+    for sort_key in sort:
+        descending = sort_key.startswith('-')
+        column = sort_key[1:] if descending else sort_key
+        if column not in columns:
+            raise RowQueryError(f"Unknown sort column: {column!r}")
+        terms.append(f"{quote_column(column)} {'DESC' if descending else 'ASC'}")
+    terms.append("id ASC")
+    return ', '.join(terms)
+
+
+def query_rows(engine: Engine, table_name: str, offset: int = 0, limit: int = 20,
+               sort: Optional[List[str]] = None, filter_query: Optional[str] = None,
+               exclude_columns: Tuple[str, ...] = HIDDEN_COLUMNS) -> Dict[str, Any]:
+    """
+    Reads one page of a results table with the sort, filter, LIMIT and OFFSET done in SQL.
+    Returns the page rows, the total number of rows matching the filter and the column names.
+    """
+    columns = [column for column in table_columns(engine, table_name) if column not in exclude_columns]
+    where_clause, parameters = build_filter_clause(filter_query or '', columns)
+    where_sql = f" WHERE {where_clause}" if where_clause else ""
+    order_sql = build_order_clause(sort or [], columns)
+    select_list = ', '.join(quote_column(column) for column in columns)
+
+    with engine.connect() as connection:
+        total = connection.execute(
+            text(f"SELECT COUNT(*) FROM {quote_column(table_name)}{where_sql}"), parameters
+        ).scalar_one()
+        rows = connection.execute(
+            text(f"SELECT {select_list} FROM {quote_column(table_name)}{where_sql} ORDER BY {order_sql} LIMIT :limit OFFSET :offset"),
+            {**parameters, 'limit': limit, 'offset': offset},
+        ).mappings().all()
+    return {"rows": [dict(row) for row in rows], "total": total, "columns": columns}
@@ -0,0 +1,28 @@
+import budget
+from budget import NUM_CTX_STEP, TokenBudget, estimate_tokens
+
+JSON_SCHEMA = {'type': 'object', 'properties': {'id': {'type': 'integer'}, 'insight': {'type': 'string'}}}
+
+
+def test_num_ctx_is_the_need_rounded_to_a_fine_step():
+    small = TokenBudget("system", JSON_SCHEMA, {'product_name': 40}, "prompt")
+    needed = (small.system_tokens + small.max_prompt_tokens) * budget.PROMPT_SAFETY_FACTOR + small.num_predict
+    assert small.num_ctx % NUM_CTX_STEP == 0
+    assert needed <= small.num_ctx < needed + NUM_CTX_STEP
+    assert small.num_ctx <= 512
+
+
+def test_larger_inputs_get_a_larger_context():
+    small = TokenBudget("system", JSON_SCHEMA, {'product_name': 40}, "prompt")
+    larger = TokenBudget("system " * 50, JSON_SCHEMA, {'product_name': 160, 'product_description': 160}, "prompt")
+    assert larger.num_ctx > small.num_ctx
+
+
+def test_prompt_safety_factor_leaves_headroom(monkeypatch):
+    fields = {f'field_{index}': 160 for index in range(8)}
+    plain = TokenBudget("system", JSON_SCHEMA, fields, "prompt")
+    needed = plain.system_tokens + plain.max_prompt_tokens + plain.num_predict
+    monkeypatch.setattr(budget, 'PROMPT_SAFETY_FACTOR', 2.0)
+    padded = TokenBudget("system", JSON_SCHEMA, fields, "prompt")
+    assert padded.num_ctx >= needed * 1.5
+    assert padded.max_num_predict("x" * 400) <= padded.num_ctx - 2 * estimate_tokens("x" * 400)
@@ -0,0 +1,48 @@
+import io
+
+import pytest
+from pydantic import BaseModel
+from sqlalchemy import create_engine, text
+from typing import Optional
+
+from export import iter_export
+from storage import create_results_table, insert_rows
+
+
+class Output(BaseModel):
+    id: int
+    insight: Optional[str] = None
+    quality_score: Optional[int] = None
+
+
+def results_engine(tmp_path, quality_scores):
+    engine = create_engine(f"sqlite:///{tmp_path / 'export.db'}")
+    columns = create_results_table(engine, ['product_name'], Output, table_name='results')
+    rows = [{'id': index + 1, 'row_key': str(index + 1), 'product_name': f'p{index}'} for index in range(len(quality_scores))]
+    insert_rows(engine, rows, columns, job_id='job', table_name='results')
+    with engine.begin() as connection:
+        for index, score in enumerate(quality_scores):
+            connection.execute(text("UPDATE results SET quality_score = :score WHERE id = :id"), {'score': score, 'id': index + 1})
+    return engine
+
+
+def test_parquet_nulls_values_that_dont_fit_the_column_type(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    engine = results_engine(tmp_path, [3, 'n/a', '4', None])
+    table = pq.read_table(io.BytesIO(b''.join(iter_export(engine, 'results', 'parquet'))))
+    assert table.column('quality_score').to_pylist() == [3, None, 4, None]
+    assert table.column('product_name').to_pylist() == ['p0', 'p1', 'p2', 'p3']
+
+
+def test_export_errors_before_the_response_starts(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    engine = results_engine(tmp_path, [1])
+    import export
+
+    def broken_batches(*args, **kwargs):
+        raise RuntimeError("cursor broke")
+        yield
+
+    monkeypatch.setattr(export, 'iter_row_batches', broken_batches)
+    with pytest.raises(RuntimeError, match="cursor broke"):
+        iter_export(engine, 'results', 'arrow')
@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from storage import RowQueryError, build_filter_clause, build_order_clause, parse_filter_value, query_rows, split_filter_query
+
+COLUMNS = ['id', 'product_name', 'quality_score', 'insight']
+
+
+def test_filter_values():
+    assert parse_filter_value('3') == 3
+    assert parse_filter_value('2.5') == 2.5
+    assert parse_filter_value('"3"') == '3'
+    assert parse_filter_value("'it\\'s'") == "it's"
+    assert parse_filter_value('blue') == 'blue'
+
+
+def test_values_are_bound_not_spliced():
+    clause, parameters = build_filter_clause('{product_name} = 1; DROP TABLE x', COLUMNS)
+    assert clause == '"product_name" = :f0'
+    assert parameters == {'f0': '1; DROP TABLE x'}
+
+
+def test_operators_map_to_bound_sql():
+    clause, parameters = build_filter_clause('{product_name} contains "Box" && {quality_score} >= 3 && {insight} ne x', COLUMNS)
+    assert clause == ('instr(CAST("product_name" AS TEXT), :f0) > 0 AND "quality_score" >= :f1 AND "insight" != :f2')
+    assert parameters == {'f0': 'Box', 'f1': 3, 'f2': 'x'}
+
+
+def test_blank_operators_take_no_value():
+    clause, parameters = build_filter_clause('{insight} is blank && {product_name} is not blank', COLUMNS)
+    assert clause == '("insight" IS NULL OR "insight" = \'\') AND ("product_name" IS NOT NULL AND "product_name" != \'\')'
+    assert parameters == {}
+
+
+def test_and_inside_a_quoted_value_is_not_a_separator():
+    assert split_filter_query('{product_name} contains "salt && pepper" && {id} > 1') == ['{product_name} contains "salt && pepper"', '{id} > 1']
+    assert split_filter_query("{product_name} contains it's && {id} > 1") == ["{product_name} contains it's", '{id} > 1']
+    _, parameters = build_filter_clause('{product_name} contains "salt && pepper"', COLUMNS)
+    assert parameters == {'f0': 'salt && pepper'}
+
+
+@pytest.mark.parametrize('filter_query', [
+    '{secret} = 1',
+    '{product_name" OR 1=1 --} = 1',
+    '{product_name} like "x"',
+    '{quality_score} >',
+    'product_name = 1',
+])
+def test_rejected_filters(filter_query):
+    with pytest.raises(RowQueryError):
+        build_filter_clause(filter_query, COLUMNS)
+
+
+def test_order_clause():
+    assert build_order_clause(['-quality_score', 'product_name'], COLUMNS) == '"quality_score" DESC, "product_name" ASC, id ASC'
+    with pytest.raises(RowQueryError):
+        build_order_clause(['nope'], COLUMNS)
+
+
+def test_query_rows_pages_filters_and_hides_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'rows.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE results (id INTEGER PRIMARY KEY, job_id TEXT, product_name TEXT, quality_score INTEGER)"))
+        for index in range(1, 11):
+            connection.execute(text("INSERT INTO results VALUES (:id, 'job', :name, :score)"),
+                               {'id': index, 'name': f"box {index}", 'score': index % 5})
+    page = query_rows(engine, 'results', offset=1, limit=2, sort=['-quality_score'], filter_query='{quality_score} >= 3')
+    assert page['columns'] == ['id', 'product_name', 'quality_score']
+    assert page['total'] == 4
+    assert [row['id'] for row in page['rows']] == [9, 3]
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+
+from ingest import items_from_chunk, parse_csv_upload
+
+
+def write_csv(tmp_path, content):
+    path = tmp_path / 'upload.csv'
+    path.write_text(content)
+    return str(path)
+
+
+def test_invalid_rows_come_back_with_their_error():
+    df_chunk = pd.DataFrame([{'id': 1, 'product_name': 'box'}, {'id': 2, 'product_name': None}])
+    items, rejected = items_from_chunk(df_chunk)
+    assert [item.id for item in items] == [1]
+    assert rejected == {2: 'Invalid CSV row: product_name: Input should be a valid string'}
+
+
+def test_upload_keeps_invalid_rows_as_rejected(tmp_path):
+    df_filtered, items, rejected = parse_csv_upload(write_csv(tmp_path, "product_name,product_description\nbox,d1\n,d2\n"))
+    assert list(df_filtered['id']) == [1, 2]
+    assert [item.id for item in items] == [1]
+    assert list(rejected) == [2]
+
+
+def test_upload_without_a_single_valid_row_is_a_422(tmp_path):
+    with pytest.raises(HTTPException) as error:
+        parse_csv_upload(write_csv(tmp_path, "product_name,product_description\n,d1\n,d2\n"))
+    assert error.value.status_code == 422
@@ -0,0 +1,51 @@
+import asyncio
+
+from jobs import EnrichmentJob, JobManager
+
+
+def test_run_now_does_not_wait_behind_queued_jobs():
+    async def scenario():
+        manager = JobManager(max_workers=1)
+        await manager.start()
+        release = asyncio.Event()
+
+        async def blocking_run(job):
+            await release.wait()
+
+        async def quick_run(job):
+            pass
+
+        busy, waiting, direct = EnrichmentJob(total_rows=1), EnrichmentJob(total_rows=1), EnrichmentJob(total_rows=1)
+        manager.submit(busy, blocking_run)
+        manager.submit(waiting, quick_run)
+        manager.run_now(direct, quick_run)
+        await asyncio.sleep(0.05)
+        statuses = busy.status, waiting.status, direct.status
+
+        release.set()
+        await asyncio.sleep(0.05)
+        await manager.stop()
+        return statuses, waiting.status
+
+    statuses, waiting_status = asyncio.run(scenario())
+    assert statuses == ("running", "queued", "completed")
+    assert waiting_status == "completed"
+
+
+def test_run_now_records_failures_like_queued_jobs():
+    async def scenario():
+        manager = JobManager(max_workers=1)
+        await manager.start()
+
+        async def broken_run(job):
+            raise RuntimeError("backend gone")
+
+        job = manager.run_now(EnrichmentJob(total_rows=1), broken_run)
+        await asyncio.sleep(0.05)
+        await manager.stop()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == "failed"
+    assert job.error == "backend gone"
+    assert job.finished_at is not None
@@ -0,0 +1,28 @@
+import pytest
+
+from backends import LLMBackendError
+from limiter import is_overload_error
+
+
+@pytest.mark.parametrize("message", [
+    "CUDA out of memory. Tried to allocate 2.00 GiB",
+    "llama runner process has terminated: OOM",
+    "ggml_cuda: CUDA error: an illegal memory access",
+    "failed to allocate buffer for the KV cache",
+])
+def test_out_of_memory_errors_count_as_overload(message):
+    assert is_overload_error(RuntimeError(message))
+
+
+@pytest.mark.parametrize("message", [
+    "no room left in the context for the prompt",
+    "unknown field 'zoom_level' in the answer",
+    "model 'bloom' not found, try pulling it first",
+])
+def test_words_containing_oom_are_not_overload(message):
+    assert not is_overload_error(RuntimeError(message))
+
+
+def test_server_errors_count_as_overload_but_bad_requests_dont():
+    assert is_overload_error(LLMBackendError("busy", status_code=503))
+    assert not is_overload_error(LLMBackendError("bad schema", status_code=400))
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import backends
+from backends import LLMBackend, LLMBackendError, PooledBackend
+
+RESPONSE = {'content': '{}', 'prompt_eval_count': 1, 'prompt_eval_duration': 0, 'eval_count': 1, 'eval_duration': 0}
+
+
+class StubBackend(LLMBackend):
+    name = "stub"
+
+    def __init__(self, label, error=None, hang=False):
+        super().__init__("model")
+        self.base_url = label
+        self.error = error
+        self.hang = hang
+        self.calls = 0
+
+    async def chat(self, messages, json_schema, options):
+        self.calls += 1
+        if self.hang:
+            await asyncio.sleep(3600)
+        if self.error is not None:
+            raise self.error
+        return RESPONSE
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture(autouse=True)
+def first_endpoint_wins_ties(monkeypatch):
+    # Ties between idle endpoints are broken at random, always taking the first keeps the tests deterministic
+    monkeypatch.setattr(backends.random, 'choice', lambda candidates: candidates[0])
+
+
+async def chat_many(pool, count):
+    results = []
+    for _ in range(count):
+        try:
+            results.append(await pool.chat([{'role': 'user', 'content': 'x'}], {}, {}))
+        except Exception as e:
+            results.append(e)
+    await pool.close()
+    return results
+
+
+def test_client_errors_are_raised_without_rerouting_or_tripping():
+    endpoints = [StubBackend("a", LLMBackendError("bad schema", status_code=400)),
+                 StubBackend("b", LLMBackendError("bad schema", status_code=400))]
+    pool = PooledBackend(endpoints, retries=1)
+    results = run(chat_many(pool, 10))
+    assert all(isinstance(result, LLMBackendError) and result.status_code == 400 for result in results)
+    # One endpoint per request, never the second one for the same request
+    assert sum(endpoint.calls for endpoint in endpoints) == 10
+    assert all(endpoint.state == "closed" and endpoint.failed == 0 for endpoint in pool.endpoints)
+
+
+def test_server_errors_reroute_and_trip_the_endpoint():
+    broken = StubBackend("broken", LLMBackendError("overloaded", status_code=503))
+    healthy = StubBackend("healthy")
+    pool = PooledBackend([broken, healthy], retries=1)
+    results = run(chat_many(pool, 10))
+    assert all(result == RESPONSE for result in results)
+    assert pool.endpoints[0].state == "open"
+    assert pool.endpoints[1].failed == 0
+
+
+def test_a_hung_endpoint_times_out_and_counts_as_failed():
+    hung = StubBackend("hung", hang=True)
+    healthy = StubBackend("healthy")
+    pool = PooledBackend([hung, healthy], retries=1, timeout=0.05)
+    results = run(chat_many(pool, 6))
+    assert all(result == RESPONSE for result in results)
+    assert pool.endpoints[0].failed >= 1
+    assert pool.endpoints[0].in_flight == 0
+    assert pool.call_timeout == pytest.approx(0.1)
+
+
+def test_connection_errors_count_as_failures():
+    pool = PooledBackend([StubBackend("down", ConnectionRefusedError("refused"))], retries=0)
+    results = run(chat_many(pool, 3))
+    assert all(isinstance(result, ConnectionRefusedError) for result in results)
+    assert pool.endpoints[0].failed == 3 and pool.endpoints[0].state == "open"
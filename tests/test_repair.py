@@ -0,0 +1,79 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+from processor import validate_or_repair
+from repair import parse_json_lenient, coerce_to_model
+from schemas import compile_schema
+from storage import reusable_result
+
+
+def test_complete_json_is_not_repaired():
+    assert parse_json_lenient('```json\n{"id": 1, "insight": "abc"}\n```') == ({'id': 1, 'insight': 'abc'}, False)
+
+
+def test_nothing_usable():
+    assert parse_json_lenient('no json here') == (None, False)
+    assert parse_json_lenient('{"insi') == (None, False)
+
+
+def test_string_cut_off_mid_value_is_dropped():
+    assert parse_json_lenient('{"id": 1, "insight": "abc') == ({'id': 1}, True)
+
+
+def test_comma_inside_a_cut_off_string_is_not_a_cut_point():
+    assert parse_json_lenient('{"id": 1, "insight": "red, green, bl') == ({'id': 1}, True)
+
+
+def test_number_at_the_end_is_dropped():
+    assert parse_json_lenient('{"id": 1, "quality_score": 4') == ({'id': 1}, True)
+    assert parse_json_lenient('{"id": 1, "price": 12.') == ({'id': 1}, True)
+    assert parse_json_lenient('{"id": 1, "ratio": 2e-') == ({'id': 1}, True)
+
+
+def test_complete_values_before_the_cut_are_kept():
+    assert parse_json_lenient('{"id": 1, "insight": "abc"') == ({'id': 1, 'insight': 'abc'}, True)
+    assert parse_json_lenient('{"id": 1, "flag": true') == ({'id': 1, 'flag': True}, True)
+    assert parse_json_lenient('{"id": 1, "tags": ["a", "b"') == ({'id': 1, 'tags': ['a', 'b']}, True)
+
+
+def test_dangling_key_is_dropped():
+    assert parse_json_lenient('{"id": 1, "insight":') == ({'id': 1}, True)
+    assert parse_json_lenient('{"id": 1, "insight"') == ({'id': 1}, True)
+
+
+def test_cut_off_array_element_is_dropped():
+    content = '{"items": [{"id": 1, "insight": "a"}, {"id": 2, "insight": "b'
+    assert parse_json_lenient(content) == ({'items': [{'id': 1, 'insight': 'a'}, {'id': 2}]}, True)
+
+
+class Output(BaseModel):
+    id: int
+    quality_score: Optional[int] = Field(None, ge=1, le=5)
+    price: Optional[str] = None
+    currency: Optional[str] = None
+    insight: Optional[str] = None
+
+
+def test_coerce_numbers_prices_and_missing_fields():
+    data = coerce_to_model({'id': '7', 'quality_score': '4/5', 'price': '$1,299.99 USD'}, Output)
+    assert data == {'id': 7, 'quality_score': 4, 'price': '1299.99', 'currency': 'USD', 'insight': None}
+
+
+def test_coerce_clamps_to_bounds_and_leaves_garbage_for_validation():
+    assert coerce_to_model({'id': 1, 'quality_score': 9}, Output)['quality_score'] == 5
+    assert coerce_to_model({'id': 'abc'}, Output)['id'] == 'abc'
+
+
+def test_validate_or_repair_marks_cut_off_answers_partial():
+    schema = compile_schema(Output)
+    assert validate_or_repair('{"id": 1, "quality_score": 3}', schema, 1)[1] == 'ok'
+    assert validate_or_repair('{"id": 1, "quality_score": "4/5"}', schema, 1)[1] == 'repaired'
+    data, status = validate_or_repair('{"id": 1, "quality_score": 3, "insight": "abc', schema, 1)
+    assert status == 'partial'
+    assert data['insight'] is None
+
+
+def test_partial_rows_are_not_reused():
+    row = {'input_fingerprint': 'f', 'insight': None}
+    assert reusable_result({**row, 'enrich_status': 'repaired'}, 'f', ['insight']) == {'insight': None}
+    assert reusable_result({**row, 'enrich_status': 'partial'}, 'f', ['insight']) is None
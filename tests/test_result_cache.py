@@ -0,0 +1,111 @@
+import asyncio
+import sqlite3
+
+import pytest
+from pydantic import BaseModel
+from typing import Optional
+
+import cache
+from backends import FakeBackend, set_backend
+from cache import ResultCache
+from processor import EnrichRequestItem, process_data_api_concurrently_async
+
+
+def disk_keys(path):
+    with sqlite3.connect(path) as connection:
+        return {row[0] for row in connection.execute("SELECT key FROM llm_result_cache")}
+
+
+def test_writes_reach_disk_in_batches(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = ResultCache(path, write_batch=3)
+    assert cache.set('a', {'id': 1}) is False
+    assert cache.set('b', {'id': 2}) is False
+    assert disk_keys(path) == set()
+    assert cache.set('c', {'id': 3}) is True
+    cache.flush()
+    assert disk_keys(path) == {'a', 'b', 'c'}
+    cache.set('d', {'id': 4})
+    cache.close()
+    assert disk_keys(path) == {'a', 'b', 'c', 'd'}
+
+
+def test_lookups_across_tiers(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = ResultCache(path, max_memory_items=1, write_batch=10)
+    cache.set('a', {'id': 1})
+    cache.set('b', {'id': 2})
+    # 'a' fell out of memory but is still waiting to be written
+    assert cache.get_from_memory('a') is None
+    assert cache.get('a') == {'id': 1}
+    cache.close()
+
+    reopened = ResultCache(path)
+    assert reopened.get_from_memory('b') is None
+    assert reopened.get('b') == {'id': 2}
+    assert reopened.get_from_memory('b') == {'id': 2}
+    assert reopened.get('missing') is None
+    assert (reopened.hits, reopened.misses) == (2, 1)
+    reopened.close()
+
+
+class Output(BaseModel):
+    id: int
+    insight: Optional[str] = None
+
+
+class CountingBackend(FakeBackend):
+    def __init__(self):
+        super().__init__(latency_ms=0, error_rate=0, invalid_rate=0)
+        self.calls = 0
+
+    async def chat(self, messages, json_schema, options):
+        self.calls += 1
+        return await super().chat(messages, json_schema, options)
+
+
+@pytest.fixture
+def cached_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_ENABLED', True)
+    monkeypatch.setattr(cache, '_result_cache', ResultCache(str(tmp_path / 'cache.db')))
+    backend = CountingBackend()
+    previous = set_backend(backend)
+    yield backend
+    set_backend(previous)
+    cache.close_result_cache()
+
+
+@pytest.mark.parametrize('pack_size', [1, 4])
+def test_use_cache_false_asks_the_model_again(cached_run, pack_size):
+    items = [EnrichRequestItem(id=1, product_name="box")]
+    first = asyncio.run(process_data_api_concurrently_async(items, Output, pack_size=pack_size))
+    cached = asyncio.run(process_data_api_concurrently_async(items, Output, pack_size=pack_size))
+    assert cached_run.calls == 1
+    assert cached[0]['enrich_status'] == 'cached'
+
+    fresh = asyncio.run(process_data_api_concurrently_async(items, Output, pack_size=pack_size, use_cache=False))
+    assert cached_run.calls == 2
+    assert fresh[0]['enrich_status'] == first[0]['enrich_status'] != 'cached'
+
+
+class TruncatingBackend(CountingBackend):
+    async def chat(self, messages, json_schema, options):
+        response = await super().chat(messages, json_schema, options)
+        return {**response, 'content': '{"id": 1, "insight": "cut of'}
+
+
+def test_cut_off_answers_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_ENABLED', True)
+    monkeypatch.setattr(cache, '_result_cache', ResultCache(str(tmp_path / 'cache.db')))
+    backend = TruncatingBackend()
+    previous = set_backend(backend)
+    try:
+        items = [EnrichRequestItem(id=1, product_name="box")]
+        for _ in range(2):
+            result = asyncio.run(process_data_api_concurrently_async(items, Output, pack_size=1))[0]
+            assert result['enrich_status'] == 'partial' and result['insight'] is None
+        assert backend.calls == 2
+        assert cache.get_result_cache().stats()['memory_items'] == 0
+    finally:
+        set_backend(previous)
+        cache.close_result_cache()
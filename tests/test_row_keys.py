@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from pydantic import BaseModel
+from typing import Optional
+
+from ingest import RowKeys, resolve_row_key
+from storage import create_results_table, insert_rows, ROW_KEY_COLUMN
+
+
+def chunk(rows, first_id=1):
+    df_chunk = pd.DataFrame(rows)
+    df_chunk['id'] = range(first_id, first_id + len(df_chunk))
+    return df_chunk
+
+
+def test_column_keys_are_taken_as_is():
+    row_keys = RowKeys('sku', ['product_name', 'sku'])
+    assert row_keys.keys_for(chunk([{'product_name': 'a', 'sku': 'S1'}, {'product_name': 'b', 'sku': ' S2 '}])) == ['S1', 'S2']
+
+
+def test_repeated_keys_get_a_suffix_across_chunks():
+    row_keys = RowKeys('sku', ['product_name', 'sku'])
+    first = row_keys.keys_for(chunk([{'product_name': 'a', 'sku': 'A'}, {'product_name': 'b', 'sku': 'A'}]))
+    second = row_keys.keys_for(chunk([{'product_name': 'c', 'sku': 'A'}], first_id=3))
+    assert first + second == ['A', 'A#2', 'A#3']
+
+
+def test_suffix_never_clashes_with_a_real_key():
+    row_keys = RowKeys('sku', ['product_name', 'sku'])
+    keys = row_keys.keys_for(chunk([{'product_name': p, 'sku': s} for p, s in
+                                    [('a', 'A'), ('b', 'A'), ('c', 'A#2'), ('d', 'A#3'), ('e', 'A')]]))
+    assert len(set(keys)) == len(keys)
+    assert keys[:2] == ['A', 'A#2']
+
+
+def test_real_key_first_then_duplicates_skip_it():
+    row_keys = RowKeys('sku', ['product_name', 'sku'])
+    keys = row_keys.keys_for(chunk([{'product_name': p, 'sku': s} for p, s in [('a', 'A#2'), ('b', 'A'), ('c', 'A')]]))
+    assert keys == ['A#2', 'A', 'A#3']
+
+
+def test_blank_key_falls_back_to_the_hash():
+    row_keys = RowKeys('sku', ['product_name', 'sku'])
+    keys = row_keys.keys_for(chunk([{'product_name': 'a', 'sku': None}, {'product_name': 'a', 'sku': ''}]))
+    assert keys[0] == row_keys.hash_key({'product_name': 'a'})
+    assert keys[1] == keys[0] + '#2'
+
+
+def test_hash_ignores_the_key_column_and_position():
+    row_keys = RowKeys('hash', ['product_name', 'product_description', 'sku'])
+    keys = row_keys.keys_for(chunk([
+        {'product_name': 'a', 'product_description': 'x', 'sku': '1'},
+        {'product_name': 'a', 'product_description': 'x', 'sku': '2'},
+        {'product_name': 'b', 'product_description': 'x', 'sku': '3'},
+    ]))
+    assert keys[1] == keys[0] + '#2'
+    assert keys[2] != keys[0]
+
+
+def test_position_keys():
+    assert RowKeys('position', ['product_name']).keys_for(chunk([{'product_name': 'a'}, {'product_name': 'b'}], first_id=5)) == ['5', '6']
+
+
+def test_resolve_row_key():
+    assert resolve_row_key(['product_name', 'sku'], 'auto') == 'sku'
+    assert resolve_row_key(['product_name'], 'auto') == 'hash'
+    assert resolve_row_key(['product_name'], 'position') == 'position'
+    with pytest.raises(HTTPException) as error:
+        resolve_row_key(['product_name'], 'ean')
+    assert error.value.status_code == 400
+
+
+class Output(BaseModel):
+    id: int
+    insight: Optional[str] = None
+
+
+def test_generated_keys_fit_the_unique_constraint():
+    engine = create_engine("sqlite://")
+    columns = create_results_table(engine, ['product_name', 'sku'], Output, 'results')
+    df_chunk = chunk([{'product_name': str(index), 'sku': sku} for index, sku in enumerate(['A', 'A', 'A#2', 'A#2', 'A'])])
+    df_chunk[ROW_KEY_COLUMN] = RowKeys('sku', ['product_name', 'sku']).keys_for(df_chunk)
+    assert insert_rows(engine, df_chunk.to_dict(orient='records'), columns, job_id='job', table_name='results') == 5
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+from pydantic import BaseModel
+from typing import Optional
+
+import cache
+from backends import FakeBackend, set_backend
+from processor import EnrichRequestItem, process_data_deduplicated_async
+
+
+class Output(BaseModel):
+    id: int
+    insight: Optional[str] = None
+
+
+@pytest.fixture(autouse=True)
+def fake_backend(monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_ENABLED', False)
+    previous = set_backend(FakeBackend(latency_ms=0, error_rate=0, invalid_rate=0))
+    yield
+    set_backend(previous)
+
+
+def test_a_slow_async_consumer_holds_back_the_workers():
+    async def scenario():
+        queue = asyncio.Queue(maxsize=2)
+        delivered = 0
+
+        async def on_result(position, result):
+            nonlocal delivered
+            delivered += 1
+            await queue.put(result)
+
+        items = [EnrichRequestItem(id=index, product_name=f"product {index}") for index in range(50)]
+        run = asyncio.create_task(process_data_deduplicated_async(items, Output, max_concurrency=4, pack_size=1, on_result=on_result))
+        await asyncio.sleep(0.2)
+        # Nobody reads the queue: only what fits in it plus one blocked result per worker got through
+        stalled_at = delivered
+        received = [await queue.get() for _ in range(len(items))]
+        await run
+        return stalled_at, received
+
+    stalled_at, received = asyncio.run(scenario())
+    assert stalled_at <= 2 + 4
+    assert sorted(result['id'] for result in received) == list(range(50))